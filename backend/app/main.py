@@ -1,21 +1,61 @@
 from fastapi import FastAPI, File, UploadFile, Form, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from typing import List
+from typing import List, Optional
 import uvicorn
-import sys
+import json
 from pydantic import BaseModel
 from datetime import date
 import os
 from dotenv import load_dotenv
-from app.services.bill_analyzer import analyze_medical_bill
+from app.services.bill_analyzer import analyze_uploads, analyze_medical_bill_stream
 from app.services.ocr import extract_text_from_document
+from app.services.ocr_cache import ocr_cache
+from app.services.perplexity import perplexity_service
+from app.services.regions import normalize_region
+from app.services.tokens import start_request_budget, get_usage_stats, get_encoder
+from app.services.rate_warmup import start_refresh_job, stop_refresh_job
+from app.services.jobs import job_queue, encode_payload, QueueFull
+from app.worker import start_inprocess_workers, stop_inprocess_workers
+from app.services.preprocess import shutdown_executor
+from app.services.text_layer import FAST_PATH_STATS
+from app.services.tracing import span, trace, metrics_payload
+from app.services.log import get_logger, get_log_stats, new_request_id, set_request_id, reset_request_id
+from app.services.database import load_all as load_reference_data
 from fastapi.exceptions import RequestValidationError
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse, Response
 import time
+import asyncio
 load_dotenv()
 
+log = get_logger(__name__)
+
 app = FastAPI(title="Medical Bill Analyzer API")
 
+class RequestIdMiddleware:
+    """Tag every log line of a request with its id (the caller's X-Request-ID, or a new one)"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        request_id = dict(scope["headers"]).get(b"x-request-id", b"").decode("latin-1")[:64] or new_request_id()
+        token = set_request_id(request_id)
+
+        async def send_with_request_id(message):
+            if message["type"] == "http.response.start":
+                message["headers"] = list(message.get("headers", [])) + [(b"x-request-id", request_id.encode("latin-1"))]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_request_id)
+        finally:
+            reset_request_id(token)
+
+app.add_middleware(RequestIdMiddleware)
+
 # Configure CORS
 app.add_middleware(
     CORSMiddleware,
@@ -30,47 +70,193 @@ class AnalysisRequest(BaseModel): #entire class doesn't exist
     last_name: str
     date_of_birth: date
 
+@app.on_event("startup")
+async def startup():
+    # Parse the CPT/HCPCS/Medicare tables once, before the first request needs them
+    await asyncio.to_thread(load_reference_data)
+    # Load the token encoder off the event loop (tiktoken may download it on first use)
+    await asyncio.to_thread(get_encoder)
+    perplexity_service.cache_service.start_write_behind()
+    start_refresh_job()
+    start_inprocess_workers()
+
+@app.on_event("shutdown")
+async def shutdown():
+    await stop_inprocess_workers()
+    await stop_refresh_job()
+    # Flush queued rate cache writes before the process exits
+    await perplexity_service.cache_service.stop_write_behind()
+    shutdown_executor()
+
 @app.get("/")
 async def root():
     return {"message": "Advocare API is running"}
 
+# Prometheus scrape endpoint: stage latency histograms, token/byte/cache counters, queue depth
+@app.get("/metrics")
+async def metrics():
+    payload = metrics_payload(await job_queue.get_stats())
+    if payload is None:
+        raise HTTPException(status_code=503, detail="prometheus_client is not installed")
+    body, content_type = payload
+    return Response(content=body, media_type=content_type)
+
+@app.get("/api/stats")
+async def service_stats():
+    return {
+        "ocr_cache": ocr_cache.get_stats() if ocr_cache else None,
+        "rate_cache": perplexity_service.cache_service.get_stats(),
+        "rate_search": perplexity_service.get_stats(),
+        "llm_usage": get_usage_stats(),
+        "pdf_text_layer": FAST_PATH_STATS,
+        "jobs": await job_queue.get_stats(),
+        "logging": get_log_stats()
+    }
+
 # Receive info from ffrontend
 @app.post("/api/analyze")
 async def analyze_bill(
     files: List[UploadFile] = File(...),
     firstName: str = Form(...),
     lastName: str = Form(...),
-    dateOfBirth: str = Form(...)
+    dateOfBirth: str = Form(...),
+    location: Optional[str] = Form(None),
+    zipCode: Optional[str] = Form(None)
 ):
 
     try:
-        print(f"Processing request for {firstName} {lastName}", file=sys.stdout)
-        start_time = time.time()
-        # Get Claude's analysis first
-        claude_results = []
+        log.info("Processing request", files=len(files))
+        budget = start_request_budget()
+        with trace("analyze") as (request_trace, _):
+            # Read and validate every upload before starting any OCR work
+            uploads = []
+            with span("upload_read") as upload_read:
+                for file in files:
+                    if not file.content_type.startswith(('application/pdf', 'image/')):
+                        raise HTTPException(status_code=400, detail=f"Unsupported file type: {file.content_type}")
+                    uploads.append((await file.read(), file.content_type))
+                upload_read.set(files=len(uploads), bytes=sum(len(content) for content, _ in uploads))
+
+            # OCR all files concurrently, then analyze the merged bill
+            analysis_result = await analyze_uploads(uploads, location, zipCode)
+        log.debug("Analysis result", payload=analysis_result)
+        _log_trace(request_trace, budget)
+        return {"analysis": analysis_result}
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        log.error("Error processing request", error=str(e))
+        raise HTTPException(status_code=500, detail=str(e))
+
+def _log_trace(request_trace, budget):
+    summary = request_trace.summary()
+    log.info("Request finished", duration_ms=summary["duration_ms"], stages=summary["stages"], tokens=budget.spent)
+    log.debug("Request spans", spans=summary["spans"])
+
+def _ndjson(stage: str, data, started: float) -> bytes:
+    event = {"stage": stage, "elapsed": round(time.time() - started, 3), "data": data}
+    return (json.dumps(event, default=str) + "\n").encode("utf-8")
+
+# Same analysis as /api/analyze, streamed as NDJSON: one {"stage", "elapsed", "data"} line per
+# result as soon as it is ready (ocr per file, line_items, code_validation, rates, explanation)
+@app.post("/api/analyze/stream")
+async def analyze_bill_stream(
+    files: List[UploadFile] = File(...),
+    firstName: str = Form(...),
+    lastName: str = Form(...),
+    dateOfBirth: str = Form(...),
+    location: Optional[str] = Form(None),
+    zipCode: Optional[str] = Form(None)
+):
+    log.info("Processing streaming request", files=len(files))
+    # Uploads are read up front; they are closed once this handler returns the response
+    uploads = []
+    with span("upload_read") as upload_read:
         for file in files:
-            content = await file.read()
-            
             if not file.content_type.startswith(('application/pdf', 'image/')):
                 raise HTTPException(status_code=400, detail=f"Unsupported file type: {file.content_type}")
-            # OCR time
-            claude_analysis = await extract_text_from_document(content, file.content_type)
-            claude_results.append(claude_analysis)
-            # print(f"Time taken: {end_time - start_time} seconds")
-            
-        # Pass Claude's results to analyze_medical_bill for additional processing
-        print(f"Claude's results: {claude_results}")
-        analysis_result = await analyze_medical_bill({
-            "claude_analyses": claude_results
-        })
-        print(f"Analysis result: {analysis_result}")
-        end_time = time.time()
-        print(f"Time taken: {end_time - start_time} seconds")
-        return {"analysis": analysis_result}
+            uploads.append((file.filename, await file.read(), file.content_type))
+        upload_read.set(files=len(uploads), bytes=sum(len(content) for _, content, _ in uploads))
+    region = normalize_region(location, zipCode)
+
+    async def events():
+        start_time = time.time()
+        budget = start_request_budget()
+        with trace("analyze_stream") as (request_trace, _):
+            async for event in _stream_stages(uploads, region, budget, start_time):
+                yield event
+        _log_trace(request_trace, budget)
+
+    return StreamingResponse(
+        events(),
+        media_type="application/x-ndjson",
+        # Ask reverse proxies not to buffer, so each line reaches the client as it is written
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+async def _stream_stages(uploads, region, budget, start_time):
+    """The NDJSON events of one streamed analysis: ocr per file, then each analysis stage"""
+    try:
+        async def ocr(index, content, content_type):
+            return index, await extract_text_from_document(content, content_type)
+
+        claude_results = [None] * len(uploads)
+        for finished in asyncio.as_completed([
+            ocr(index, content, content_type) for index, (_, content, content_type) in enumerate(uploads)
+        ]):
+            index, result = await finished
+            claude_results[index] = result
+            yield _ndjson("ocr", {
+                "file": uploads[index][0],
+                "success": result.get("success", False),
+                "line_items": len(result.get("extracted_text", {}).get("billing_details", {}).get("procedure_codes", [])),
+                "error": result.get("error")
+            }, start_time)
 
+        async for stage, data in analyze_medical_bill_stream(claude_results, region):
+            yield _ndjson(stage, data, start_time)
+        yield _ndjson("done", {"location": region.key, "tokens": budget.summary()}, start_time)
+    except Exception as e:
+        log.error("Error processing streaming request", error=str(e))
+        yield _ndjson("error", {"detail": str(e)}, start_time)
+
+# Queue the analysis instead of holding the connection; a worker (python -m app.worker) runs it
+# and the client polls GET /api/jobs/{job_id} for the result
+@app.post("/api/jobs", status_code=202)
+async def submit_job(
+    files: List[UploadFile] = File(...),
+    firstName: str = Form(...),
+    lastName: str = Form(...),
+    dateOfBirth: str = Form(...),
+    location: Optional[str] = Form(None),
+    zipCode: Optional[str] = Form(None)
+):
+    uploads = []
+    for file in files:
+        if not file.content_type.startswith(('application/pdf', 'image/')):
+            raise HTTPException(status_code=400, detail=f"Unsupported file type: {file.content_type}")
+        uploads.append((await file.read(), file.content_type))
+    try:
+        job_id = await job_queue.submit(encode_payload(uploads, location, zipCode))
+    except QueueFull as e:
+        raise HTTPException(status_code=503, detail=f"Analysis queue is full ({str(e)}), try again later")
+    except Exception as e:
+        log.error("Error queueing job", error=str(e))
+        raise HTTPException(status_code=503, detail="Analysis queue is unavailable")
+    log.info("Queued job", job_id=job_id, files=len(uploads))
+    return {"job_id": job_id, "status": "queued", "status_url": f"/api/jobs/{job_id}"}
+
+@app.get("/api/jobs/{job_id}")
+async def job_status(job_id: str):
+    try:
+        job = await job_queue.get(job_id)
     except Exception as e:
-        print(f"Error processing request: {str(e)}", file=sys.stderr)
-        # raise HTTPException(status_code=500, detail=str(e))
+        log.error("Error reading job", job_id=job_id, error=str(e))
+        raise HTTPException(status_code=503, detail="Analysis queue is unavailable")
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found or expired")
+    return job
 
 @app.exception_handler(RequestValidationError)
 async def validation_exception_handler(request: Request, exc: RequestValidationError):
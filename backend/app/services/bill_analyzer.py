@@ -4,12 +4,52 @@ import json
 from .claude import analyze_with_claude_haiku
 from .perplexity import search_ucr_rates
 from .database import load_medicare_database  
+from .ocr import merge_ocr_results, extract_text_from_document
+from .regions import normalize_region
+from .code_index import validate_procedures
+from .pricing import price_procedures, LOCAL_PRICING_ENABLED
+from .prompts import build_explanation_report
+from .tokens import TokenBudgetExceeded
+from .log import get_logger
 import asyncio
-import aiohttp
+
+log = get_logger(__name__)
+
+
+class PermanentAnalysisError(Exception):
+    """An analysis failure that would recur on every attempt (exhausted token budget, unreadable bill)"""
+
+
+def merged_bill(claude_results):
+    """Merge the OCR results, raising if no page yielded billing details"""
+    merged = merge_ocr_results(claude_results)
+    if not merged.get("success"):
+        message = "No billing details could be extracted from the uploaded files"
+        raise Exception(message) if merged.get("retryable", True) else PermanentAnalysisError(message)
+    return merged
 
 # app/services/bill_analyzer.py
 
-async def ucr_validation(bill):
+def local_rates(bill):
+    """Price what we can from the local Medicare tables; returns (priced, still unpriced)"""
+    procedures = [
+        procedure for procedure in bill["billing_details"]["procedure_codes"]
+        if not procedure.get("is_subtotal")
+    ]
+    if LOCAL_PRICING_ENABLED:
+        return price_procedures(procedures)
+    return [], procedures
+
+async def searched_rates(unpriced, location=None):
+    """Rates for the procedures the local tables couldn't price, via the rate cache / LLM search"""
+    if not unpriced:
+        return []
+    ucr_result = await search_ucr_rates(
+        {"billing_details": {"procedure_codes": unpriced}}, location=location
+    )
+    return json.loads(ucr_result).get("ucr_validation", {}).get("procedure_analysis", [])
+
+async def ucr_validation(bill, location=None):
     # medicare_rates = await load_medicare_database()
     # discrepancies = []
 
@@ -38,7 +78,9 @@ async def ucr_validation(bill):
     #             "code_found": False
     #         })
 
-    ucr_result = await search_ucr_rates(bill)
+    priced, unpriced = local_rates(bill)
+    searched = await searched_rates(unpriced, location)
+    ucr_result = json.dumps({"ucr_validation": {"procedure_analysis": priced + searched}})
     # prompt = f"""
     # Analyze the following medical bill information:
 
@@ -89,10 +131,8 @@ async def ucr_validation(bill):
     return {"ucr_validation": ucr_result}
 
 async def explanation_handler(results):
-    report = "Explanation Summary:\n"
-    for result in results:
-        for key, value in result.items():
-            report += f"{key}: {value}\n"
+    code_result, ucr_result = results
+    report = build_explanation_report(code_result, ucr_result)
     prompt = (
         f"Please analyze the following report and provide a structured response in JSON format:\n\n{report}\n\n"
         "Your response should be in the following JSON structure:\n"
@@ -130,11 +170,28 @@ async def explanation_handler(results):
         "5. Sort procedures by percentage_difference in descending order"
     )
 
-    return await analyze_with_claude_haiku(prompt)
+    return flag_stale_rates(await analyze_with_claude_haiku(prompt), ucr_result)
+
+def flag_stale_rates(report, ucr_result):
+    """
+    Carry the "stale" flag of rates served past their cache lifetime into the explanation,
+    which the model regenerates without it; stale_rates lists them even if it dropped the line.
+    """
+    rates = json.loads(ucr_result["ucr_validation"]).get("ucr_validation", {}).get("procedure_analysis", [])
+    stale_codes = list(dict.fromkeys(str(rate.get("code")) for rate in rates if rate.get("stale")))
+    if not isinstance(report, dict) or not stale_codes:
+        return report
+    for procedure in report.get("ucr_validation", {}).get("procedure_analysis", []):
+        if isinstance(procedure, dict) and str(procedure.get("code")) in stale_codes:
+            procedure["stale"] = True
+    report["stale_rates"] = stale_codes
+    return report
 
 async def analyze_medical_bill(user_input):
     try:
-        claude_results = user_input['claude_analyses'][0]['extracted_text'] 
+        # Combine every uploaded file into one bill
+        merged = merged_bill(user_input['claude_analyses'])
+        claude_results = merged['extracted_text']
 
         # Filter only needed data for each validation
         # validation_data = {
@@ -157,7 +214,7 @@ async def analyze_medical_bill(user_input):
         # Run the analyses using the structured bill
         code_result, ucr_result = await asyncio.gather(
             code_validation(claude_results),
-            ucr_validation(claude_results)
+            ucr_validation(claude_results, user_input.get('location'))
         )
         results = [code_result, ucr_result]
         # print(f"results: {ucr_resu}")
@@ -177,10 +234,58 @@ async def analyze_medical_bill(user_input):
         except json.JSONDecodeError:
             return {"summary": final_report}
 
+    except PermanentAnalysisError as e:
+        log.error("Error in analyze_medical_bill", error=str(e), retryable=False)
+        raise
+    except TokenBudgetExceeded as e:
+        log.error("Error in analyze_medical_bill", error=str(e), retryable=False)
+        raise PermanentAnalysisError(f"Analysis failed: {str(e)}") from e
     except Exception as e:
-        print(f"Error in analyze_medical_bill: {str(e)}")
+        log.error("Error in analyze_medical_bill", error=str(e))
         raise Exception(f"Analysis failed: {str(e)}")
 
+async def analyze_uploads(uploads, location=None, zip_code=None):
+    """OCR every (content, content_type) upload concurrently, then analyze the merged bill"""
+    # Pages are bounded by the OCR semaphore
+    claude_results = list(await asyncio.gather(*(
+        extract_text_from_document(content, content_type) for content, content_type in uploads
+    )))
+    log.debug("Claude's results", payload=claude_results)
+    region = normalize_region(location, zip_code)
+    log.info("Rate region", region=region.key, region_level=region.level)
+    return await analyze_medical_bill({
+        "claude_analyses": claude_results,
+        "location": region
+    })
+
+async def analyze_medical_bill_stream(claude_results, location=None):
+    """
+    Same pipeline as analyze_medical_bill, yielding (stage, data) as each stage finishes:
+    line_items, code_validation, rates (local first, then searched), explanation.
+    """
+    merged = merged_bill(claude_results)
+    bill = merged['extracted_text']
+    yield "line_items", {
+        "procedure_codes": bill["billing_details"]["procedure_codes"],
+        "total_cost": bill["billing_details"].get("total_cost"),
+        "pages": merged.get("pages")
+    }
+
+    # The rate search is the slow part; start it before the local stages are sent
+    priced, unpriced = local_rates(bill)
+    search = asyncio.create_task(searched_rates(unpriced, location))
+    try:
+        code_result = await code_validation(bill)
+        yield "code_validation", code_result
+        yield "rates", {"source": "local", "procedure_analysis": priced}
+        searched = await search
+    finally:
+        search.cancel()
+    yield "rates", {"source": "search", "procedure_analysis": searched}
+
+    ucr_result = {"ucr_validation": json.dumps({"ucr_validation": {"procedure_analysis": priced + searched}})}
+    yield "explanation", await explanation_handler([code_result, ucr_result])
+
 # # original code_validation
 # async def code_validation(bill):
 #     """Validate all procedure codes in parallel"""
@@ -233,66 +338,22 @@ async def analyze_medical_bill(user_input):
 
 #new code_validation
 async def code_validation(bill):
-    """Validate all procedure codes in parallel"""
+    """Validate every procedure code against the local CPT/HCPCS index (no network calls)"""
     try:
-        validation_tasks = []
-        
-        # # Create tasks for each procedure code
-        # for procedure in bill["billing_details"]["procedure_codes"]:
-        #     validation_tasks.append(validate_single_code(procedure))
+        procedures = [
+            procedure for procedure in bill["billing_details"]["procedure_codes"]
+            if not procedure.get("is_subtotal")
+        ]
+        validation_results = validate_procedures(procedures)
+        invalid_codes = [result["code"] for result in validation_results if not result["is_valid"]]
         
-        # # Run all validations concurrently
-        # validation_results = await asyncio.gather(*validation_tasks)
-        # print(f"code done")
-        # Combine results
         return {
-            "validation_results": "validated",
-            "summary": "Code validation completed",
-            # "total_codes_checked": len("Validate")
+            "validation_results": validation_results,
+            "summary": f"{len(validation_results) - len(invalid_codes)} of {len(validation_results)} codes found in the CPT/HCPCS index",
+            "total_codes_checked": len(validation_results),
+            "invalid_codes": invalid_codes
         }
         
     except Exception as e:
-        print(f"Error in code validation: {str(e)}")
+        log.error("Error in code validation", error=str(e))
         return {"error": str(e)}
-
-async def validate_single_code(procedure):
-    """Validate a single procedure code"""
-    code = procedure["code"]
-    cost = procedure["cost"]
-    
-    try:
-        # Check both ICD and HCPCS APIs
-        async with aiohttp.ClientSession() as session:
-            # ICD API call
-            icd_url = f"https://clinicaltables.nlm.nih.gov/api/icd10cm/v3/search?sf=code&df=code,name&terms={code}"
-            async with session.get(icd_url) as icd_response:
-                icd_data = await icd_response.json()
-
-            # HCPCS API call
-            hcpcs_url = f"https://hcpcs.codes/api/v1/codes/{code}"
-            async with session.get(hcpcs_url) as hcpcs_response:
-                hcpcs_data = await hcpcs_response.json()
-
-        # Process responses
-        is_valid_icd = len(icd_data[3]) > 0 if isinstance(icd_data, list) and len(icd_data) > 3 else False
-        is_valid_hcpcs = 'code' in hcpcs_data and hcpcs_data['code'] == code
-
-        # Combine validation results
-        return {
-            "code": code,
-            "cost": cost,
-            "is_valid": is_valid_icd or is_valid_hcpcs,
-            "icd_details": icd_data[3][0] if is_valid_icd else None,
-            "hcpcs_details": hcpcs_data if is_valid_hcpcs else None,
-            "validation_source": "ICD-10" if is_valid_icd else "HCPCS" if is_valid_hcpcs else "Unknown"
-        }
-        
-    except Exception as e:
-        return {
-            "code": code,
-            "cost": cost,
-            "is_valid": False,
-            "error": str(e)
-        }
-
-
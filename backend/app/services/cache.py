@@ -1,9 +1,17 @@
 from supabase import create_client, Client
 import os
-from datetime import datetime, timedelta
-from typing import Optional, Dict, Any
+import asyncio
+import hashlib
+import random
+import time
+from collections import Counter, OrderedDict
+from datetime import datetime, timedelta, timezone
+from typing import Optional, Dict, Any, List, Tuple
 from dotenv import load_dotenv
 from pathlib import Path
+from app.services.log import get_logger
+
+log = get_logger(__name__)
 
 # Define paths globally so they can be used in error messages
 CURRENT_DIR = Path(__file__).resolve().parent
@@ -20,87 +28,432 @@ def load_env_files():
 # Load environment variables at module level
 load_env_files()
 
+# In-process tier in front of Supabase
+RATE_MEMORY_ENTRIES = int(os.getenv("RATE_MEMORY_ENTRIES", "5000"))
+RATE_MEMORY_TTL_SECONDS = int(os.getenv("RATE_MEMORY_TTL_SECONDS", "3600"))
+# How long to remember that Supabase has no row / the search found no rate for a code
+RATE_NEGATIVE_TTL_SECONDS = int(os.getenv("RATE_NEGATIVE_TTL_SECONDS", "300"))
+RATE_NO_RATE_TTL_SECONDS = int(os.getenv("RATE_NO_RATE_TTL_SECONDS", str(24 * 3600)))
+# Most (code, location) lookup counts kept; beyond this only the most requested half survive
+RATE_LOOKUP_COUNTS_MAX = int(os.getenv("RATE_LOOKUP_COUNTS_MAX", "20000"))
+
+# Write-behind: queue Supabase upserts and flush them in batches off the request path
+RATE_CACHE_WRITE_BEHIND = os.getenv("RATE_CACHE_WRITE_BEHIND", "1") == "1"
+RATE_CACHE_FLUSH_SIZE = int(os.getenv("RATE_CACHE_FLUSH_SIZE", "100"))
+RATE_CACHE_FLUSH_INTERVAL_SECONDS = float(os.getenv("RATE_CACHE_FLUSH_INTERVAL_SECONDS", "2"))
+# Most rows waiting to be written; beyond this the oldest queued rows (and new failures) are dropped
+RATE_CACHE_MAX_PENDING = int(os.getenv("RATE_CACHE_MAX_PENDING", "10000"))
+
+# Spread expiry so entries written together don't all expire together: each entry's
+# lifetime is shortened by a stable per-(code, location) fraction of up to this much
+RATE_TTL_JITTER = float(os.getenv("RATE_TTL_JITTER", "0.1"))
+
+# Stale-while-revalidate: expired entries are still served (flagged "stale") and refreshed in
+# the background, until they reach this hard max age
+RATE_STALE_WHILE_REVALIDATE = os.getenv("RATE_STALE_WHILE_REVALIDATE", "1") == "1"
+RATE_STALE_MAX_AGE_SECONDS = int(os.getenv("RATE_STALE_MAX_AGE_SECONDS", str(90 * 24 * 3600)))
+
+# Negative-cache markers stored in the memory tier
+NOT_IN_SUPABASE = "not_in_supabase"
+NO_RATE = "no_rate"
+
+
+class MemoryLRU:
+    """Small in-process LRU with per-entry expiry"""
+
+    def __init__(self, max_entries: int, ttl_seconds: int):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries: "OrderedDict[Any, tuple]" = OrderedDict()
+
+    def get(self, key) -> Optional[Any]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at < time.time():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def set(self, key, value: Any, ttl_seconds: Optional[int] = None) -> None:
+        ttl_seconds = self.ttl_seconds if ttl_seconds is None else ttl_seconds
+        self._entries[key] = (time.time() + ttl_seconds, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+def _jitter_fraction(code: str, location: str) -> float:
+    # Stable across processes and restarts, unlike hash()
+    digest = hashlib.md5(f"{code}|{location}".encode("utf-8")).digest()
+    return int.from_bytes(digest[:4], "big") / 2 ** 32
+
+
+def _parse_timestamp(value: str) -> datetime:
+    # Supabase returns ISO timestamps, with or without an offset
+    parsed = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed
+
+
 class CacheService:
     def __init__(self):
+        self.CACHE_DURATION = timedelta(days=30)
+        self.memory = MemoryLRU(RATE_MEMORY_ENTRIES, RATE_MEMORY_TTL_SECONDS)
+        # (code, location) -> future shared by concurrent lookups of the same miss
+        self._inflight: Dict[Tuple[str, str], asyncio.Future] = {}
+        self.stats = {
+            "memory": {"hits": 0, "negative_hits": 0, "misses": 0, "calls": 0, "latency_ms_total": 0.0},
+            "supabase": {"calls": 0, "rows_hit": 0, "rows_missed": 0, "errors": 0, "latency_ms_total": 0.0},
+            "coalesced": 0,
+            "stale_served": 0,
+            "write_behind": {"queued": 0, "flushes": 0, "rows_written": 0, "dropped": 0},
+        }
+        # How often each (code, location) was asked for; ranks warm-up and refresh-ahead work
+        self.lookup_counts: Counter = Counter()
+        # (code, location) -> row waiting to be upserted; a newer rate replaces an older one
+        self._pending: Dict[Tuple[str, str], Dict[str, Any]] = {}
+        self._flush_event: Optional[asyncio.Event] = None
+        self._writer_task: Optional[asyncio.Task] = None
+        self._stopping = False
+
         supabase_url = os.getenv("SUPABASE_URL")
         supabase_key = os.getenv("SUPABASE_KEY")
-        
+
         if not supabase_url or not supabase_key:
-            print("Warning: Running without Supabase - caching disabled")
+            log.warning("Running without Supabase - only the in-process rate cache is used")
             self.supabase = None
             return
-            
+
         self.supabase = create_client(supabase_url, supabase_key)
-        self.CACHE_DURATION = timedelta(days=30)
 
-    async def get_cached_rate(self, code: str, location: str) -> Optional[Dict[str, Any]]:
-        """Retrieve cached rate for a code/location combination"""
+    def expires_at(self, code: str, location: str, created_at: datetime) -> datetime:
+        """When a Supabase entry stops being served: CACHE_DURATION minus its jitter"""
+        return created_at + self.CACHE_DURATION * (1 - RATE_TTL_JITTER * _jitter_fraction(code, location))
+
+    def _memory_ttl(self, code: str, location: str, created_at: datetime) -> float:
+        """
+        About RATE_MEMORY_TTL_SECONDS, but never past the Supabase entry's own expiry, or for
+        a stale entry past RATE_STALE_MAX_AGE_SECONDS, so neither tier serves it longer.
+        """
+        ttl = RATE_MEMORY_TTL_SECONDS * (1 - RATE_TTL_JITTER * random.random())
+        now = datetime.now(timezone.utc)
+        remaining = (self.expires_at(code, location, created_at) - now).total_seconds()
+        if remaining <= 0:
+            remaining = (created_at + timedelta(seconds=RATE_STALE_MAX_AGE_SECONDS) - now).total_seconds()
+        return max(min(ttl, remaining), 0.0)
+
+    def _to_rate(self, row: dict) -> Optional[Dict[str, Any]]:
+        """
+        Convert a Supabase row into a rate. Expired rows are returned flagged "stale" while
+        they are younger than RATE_STALE_MAX_AGE_SECONDS, and as None after that.
+        """
+        cache_date = _parse_timestamp(row['created_at'])
+        now = datetime.now(timezone.utc)
+        rate = {
+            "code": row["code"],
+            "description": row.get("description", ""),
+            "standardized_rate": row["standardized_rate"],
+            "sources": row["sources"]
+        }
+        if now < self.expires_at(row["code"], row["location"], cache_date):
+            return rate
+        if RATE_STALE_WHILE_REVALIDATE and now - cache_date < timedelta(seconds=RATE_STALE_MAX_AGE_SECONDS):
+            return {**rate, "stale": True}
+        return None
+
+    async def _supabase_call(self, query):
+        """Run a blocking Supabase query in a worker thread, recording latency"""
+        start = time.perf_counter()
+        self.stats["supabase"]["calls"] += 1
         try:
-            result = self.supabase.table("standardized_rates").select("*").eq(
-                "code", code
+            return await asyncio.to_thread(query.execute)
+        finally:
+            self.stats["supabase"]["latency_ms_total"] += (time.perf_counter() - start) * 1000
+
+    async def _fetch_rates(self, codes: List[str], location: str) -> Dict[str, Dict[str, Any]]:
+        result = await self._supabase_call(
+            self.supabase.table("standardized_rates").select("*").in_(
+                "code", codes
             ).eq(
                 "location", location
-            ).execute()
-            
-            if result.data:
-                cached_rate = result.data[0]
-                cache_date = datetime.fromisoformat(cached_rate['created_at'])
-                
-                if datetime.now() - cache_date < self.CACHE_DURATION:
-                    return {
-                        "code": cached_rate["code"],
-                        "description": cached_rate.get("description", ""),
-                        "standardized_rate": cached_rate["standardized_rate"],
-                        "sources": cached_rate["sources"]
-                    }
-            return None
-            
-        except Exception as e:
-            print(f"Cache retrieval error: {str(e)}")
-            return None
+            )
+        )
+        rates = {}
+        for row in result.data:
+            rate = self._to_rate(row)
+            if rate is not None:
+                rates[row["code"]] = rate
+                ttl = self._memory_ttl(row["code"], location, _parse_timestamp(row["created_at"]))
+                self.memory.set((row["code"], location), rate, ttl)
+        return rates
+
+    async def get_cached_rate(self, code: str, location: str) -> Optional[Dict[str, Any]]:
+        """Retrieve cached rate for a code/location combination"""
+        rates = await self.bulk_get_cached_rates([code], location)
+        return rates.get(code)
+
+    def is_known_without_rate(self, code: str, location: str) -> bool:
+        """True if a recent search found no usable rate for this code"""
+        return self.memory.get((code, location)) == NO_RATE
+
+    def remember_no_rate(self, code: str, location: str) -> None:
+        """Negative-cache a code the rate search could not price"""
+        # A rate we already hold (e.g. a stale one being revalidated) beats a search that found nothing
+        if isinstance(self.memory.get((code, location)), dict):
+            return
+        self.memory.set((code, location), NO_RATE, RATE_NO_RATE_TTL_SECONDS)
+
+    def _remember_rate(self, code: str, location: str, rate_data: dict) -> Dict[str, Any]:
+        """Put a rate in the memory tier and return the matching Supabase row"""
+        created_at = datetime.now(timezone.utc)
+        self.memory.set((code, location), {
+            "code": code,
+            "description": rate_data.get("description", ""),
+            "standardized_rate": rate_data["standardized_rate"],
+            "sources": rate_data["sources"]
+        }, self._memory_ttl(code, location, created_at))
+        return {
+            "code": code,
+            "location": location,
+            "description": rate_data.get("description", ""),
+            "standardized_rate": rate_data["standardized_rate"],
+            "sources": rate_data["sources"],
+            "created_at": created_at.isoformat(),
+            # Stored so refresh-ahead can select and order entries by when they expire
+            "expires_at": self.expires_at(code, location, created_at).isoformat()
+        }
+
+    async def _upsert_rows(self, rows: List[Dict[str, Any]]) -> None:
+        # One request for the whole batch; rows must be unique per (code, location)
+        await self._supabase_call(
+            self.supabase.table("standardized_rates").upsert(
+                rows,
+                on_conflict="code,location"
+            )
+        )
 
     async def cache_rate(self, code: str, location: str, rate_data: dict) -> bool:
         """Store new rate in cache"""
+        return await self.bulk_cache_rates(location, [dict(rate_data, code=code)])
+
+    async def bulk_cache_rates(self, location: str, procedures: List[dict]) -> bool:
+        """Store many rates for one location with a single Supabase upsert"""
+        rows = {}
+        for procedure in procedures:
+            rows[procedure["code"]] = self._remember_rate(procedure["code"], location, procedure)
+        if self.supabase is None or not rows:
+            return False
         try:
-            data = {
-                "code": code,
-                "location": location,
-                "description": rate_data.get("description", ""),
-                "standardized_rate": rate_data["standardized_rate"],
-                "sources": rate_data["sources"],
-                "created_at": datetime.now().isoformat()
-            }
-            self.supabase.table("standardized_rates").upsert(
-                data, 
-                on_conflict="code,location"
-            ).execute()
+            await self._upsert_rows(list(rows.values()))
             return True
-            
+
         except Exception as e:
-            print(f"Cache storage error: {str(e)}")
+            self.stats["supabase"]["errors"] += 1
+            log.error("Cache storage error", error=str(e))
             return False
 
+    async def save_rates(self, location: str, procedures: List[dict]) -> None:
+        """
+        Store rates without making the caller wait on Supabase when write-behind is running:
+        the memory tier is updated now and the rows are upserted by the background flusher.
+        """
+        if self._writer_task is None:
+            await self.bulk_cache_rates(location, procedures)
+            return
+        for procedure in procedures:
+            code = procedure["code"]
+            # Re-queued keys move to the back, so the oldest row is always first
+            self._pending.pop((code, location), None)
+            self._pending[(code, location)] = self._remember_rate(code, location, procedure)
+            self.stats["write_behind"]["queued"] += 1
+        # A slow or unreachable Supabase must not grow the queue without bound
+        while len(self._pending) > RATE_CACHE_MAX_PENDING:
+            del self._pending[next(iter(self._pending))]
+            self.stats["write_behind"]["dropped"] += 1
+        if len(self._pending) >= RATE_CACHE_FLUSH_SIZE:
+            self._flush_event.set()
+
+    async def flush_pending(self) -> None:
+        """Upsert every queued row, in batches of RATE_CACHE_FLUSH_SIZE"""
+        while self._pending:
+            keys = list(self._pending)[:RATE_CACHE_FLUSH_SIZE]
+            batch = {key: self._pending.pop(key) for key in keys}
+            try:
+                await self._upsert_rows(list(batch.values()))
+                self.stats["write_behind"]["flushes"] += 1
+                self.stats["write_behind"]["rows_written"] += len(batch)
+            except Exception as e:
+                self.stats["supabase"]["errors"] += 1
+                log.error("Cache write-behind error", error=str(e))
+                # Keep the rows for the next flush unless a newer rate was queued meanwhile
+                for key, row in batch.items():
+                    if len(self._pending) < RATE_CACHE_MAX_PENDING:
+                        self._pending.setdefault(key, row)
+                    else:
+                        self.stats["write_behind"]["dropped"] += 1
+                return
+
+    async def _write_behind_loop(self) -> None:
+        # Stopped via a flag rather than cancel() so an in-flight batch is never abandoned
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._flush_event.wait(), RATE_CACHE_FLUSH_INTERVAL_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_event.clear()
+            await self.flush_pending()
+
+    def start_write_behind(self) -> None:
+        """Start the background flusher (call from the app's startup event)"""
+        if not RATE_CACHE_WRITE_BEHIND or self.supabase is None or self._writer_task is not None:
+            return
+        self._stopping = False
+        self._flush_event = asyncio.Event()
+        self._writer_task = asyncio.create_task(self._write_behind_loop())
+
+    async def stop_write_behind(self) -> None:
+        """Stop the flusher and write out whatever is still queued (call on shutdown)"""
+        if self._writer_task is None:
+            return
+        self._stopping = True
+        self._flush_event.set()
+        await self._writer_task
+        self._writer_task = None
+        await self.flush_pending()
+        if self._pending:
+            log.warning("Rate cache rows could not be written on shutdown", rows=len(self._pending))
+
+    def _count_lookup(self, code: str, location: str) -> None:
+        self.lookup_counts[(code, location)] += 1
+        if len(self.lookup_counts) > RATE_LOOKUP_COUNTS_MAX:
+            # Halving (not trimming by one) keeps the pruning cost amortized per lookup
+            self.lookup_counts = Counter(dict(self.lookup_counts.most_common(RATE_LOOKUP_COUNTS_MAX // 2)))
+
     async def bulk_get_cached_rates(self, codes: list[str], location: str) -> dict:
-        """Get cached rates for multiple codes at once"""
-        try:
-            result = self.supabase.table("standardized_rates").select("*").in_(
-                "code", codes
-            ).eq(
-                "location", location
-            ).execute()
-            
-            cached_rates = {}
-            for rate in result.data:
-                cache_date = datetime.fromisoformat(rate['created_at'])
-                if datetime.now() - cache_date < self.CACHE_DURATION:
-                    cached_rates[rate["code"]] = {
-                        "code": rate["code"],
-                        "description": rate.get("description", ""),
-                        "standardized_rate": rate["standardized_rate"],
-                        "sources": rate["sources"]
-                    }
+        """
+        Get cached rates for multiple codes at once.
+        Memory tier first; remaining misses go to Supabase in one query, and concurrent
+        callers missing the same (code, location) share that query instead of repeating it.
+        """
+        cached_rates = {}
+        missing = []
+        start = time.perf_counter()
+        for code in dict.fromkeys(codes):
+            self._count_lookup(code, location)
+            value = self.memory.get((code, location))
+            if isinstance(value, dict):
+                self.stats["memory"]["hits"] += 1
+                if value.get("stale"):
+                    self.stats["stale_served"] += 1
+                cached_rates[code] = value
+            elif value is not None:
+                self.stats["memory"]["negative_hits"] += 1
+            else:
+                self.stats["memory"]["misses"] += 1
+                missing.append(code)
+        self.stats["memory"]["calls"] += 1
+        self.stats["memory"]["latency_ms_total"] += (time.perf_counter() - start) * 1000
+
+        if not missing or self.supabase is None:
             return cached_rates
-            
-        except Exception as e:
-            print(f"Bulk cache retrieval error: {str(e)}")
-            return {}
\ No newline at end of file
+
+        loop = asyncio.get_running_loop()
+        waiting = {}
+        to_fetch = []
+        for code in missing:
+            key = (code, location)
+            if key in self._inflight:
+                self.stats["coalesced"] += 1
+                waiting[code] = self._inflight[key]
+            else:
+                self._inflight[key] = loop.create_future()
+                to_fetch.append(code)
+
+        if to_fetch:
+            fetched = {}
+            try:
+                fetched = await self._fetch_rates(to_fetch, location)
+                for code in to_fetch:
+                    # _fetch_rates puts the rows it finds in the memory tier itself
+                    if code in fetched:
+                        self.stats["supabase"]["rows_hit"] += 1
+                        if fetched[code].get("stale"):
+                            self.stats["stale_served"] += 1
+                    else:
+                        self.stats["supabase"]["rows_missed"] += 1
+                        self.memory.set((code, location), NOT_IN_SUPABASE, RATE_NEGATIVE_TTL_SECONDS)
+            except Exception as e:
+                # Errors are not negative-cached; the next request tries Supabase again
+                self.stats["supabase"]["errors"] += 1
+                log.error("Bulk cache retrieval error", error=str(e))
+            finally:
+                # Pop every key before resolving any, so a failure here can't strand the rest
+                futures = [(code, self._inflight.pop((code, location), None)) for code in to_fetch]
+                for code, future in futures:
+                    if future is not None and not future.done():
+                        future.set_result(fetched.get(code))
+            cached_rates.update(fetched)
+
+        for code, future in waiting.items():
+            # Shielded: a cancelled waiter must not cancel the lookup other callers share
+            rate = await asyncio.shield(future)
+            if rate is not None:
+                cached_rates[code] = rate
+
+        return cached_rates
+
+    async def expiring_rates(self, within_seconds: float, limit: int) -> List[Dict[str, Any]]:
+        """
+        Supabase entries that have not expired yet but will within the next within_seconds,
+        soonest first, then most requested first, for the refresh-ahead job.
+        """
+        if self.supabase is None:
+            return []
+        now = datetime.now(timezone.utc)
+        horizon = now + timedelta(seconds=within_seconds)
+        result = await self._supabase_call(
+            self.supabase.table("standardized_rates").select(
+                "code,location,description,created_at,expires_at"
+            ).gte(
+                "expires_at", now.isoformat()
+            ).lte(
+                "expires_at", horizon.isoformat()
+            ).order("expires_at").limit(limit * 5)
+        )
+        rows = list(result.data)
+        rows.sort(key=lambda row: -self.lookup_counts[(row["code"], row["location"])])
+        return rows[:limit]
+
+    def get_stats(self) -> Dict[str, Any]:
+        memory = self.stats["memory"]
+        supabase = self.stats["supabase"]
+        lookups = memory["hits"] + memory["negative_hits"] + memory["misses"]
+        supabase_rows = supabase["rows_hit"] + supabase["rows_missed"]
+        return {
+            "memory": {
+                **memory,
+                "entries": len(self.memory),
+                "hit_ratio": (memory["hits"] + memory["negative_hits"]) / lookups if lookups else 0.0,
+                "avg_latency_ms": memory["latency_ms_total"] / memory["calls"] if memory["calls"] else 0.0,
+            },
+            "supabase": {
+                **supabase,
+                "hit_ratio": supabase["rows_hit"] / supabase_rows if supabase_rows else 0.0,
+                "avg_latency_ms": supabase["latency_ms_total"] / supabase["calls"] if supabase["calls"] else 0.0,
+            },
+            "coalesced": self.stats["coalesced"],
+            "stale_served": self.stats["stale_served"],
+            "tracked_lookups": len(self.lookup_counts),
+            "write_behind": {
+                **self.stats["write_behind"],
+                "running": self._writer_task is not None,
+                "pending": len(self._pending),
+            },
+        }
@@ -1,4 +1,3 @@
-from anthropic import Client
 import os
 from dotenv import load_dotenv
 import json
@@ -6,25 +5,28 @@ import json
 import base64
 import re
 import asyncio
-import time
+from app.services.llm_clients import anthropic_create
+from app.services.tokens import TokenBudgetExceeded
+from app.services.tracing import span
+from app.services.log import get_logger
 
 # Load environment variables from .env
 load_dotenv()
 
+log = get_logger(__name__)
+
 api_key = os.getenv('ANTHROPIC_API_KEY')
 
 if api_key is None:
-    print("Error: ANTHROPIC_API_KEY is not set.")
-else:
-    # Initialize the client with your API key
-    client = Client(api_key=api_key)
+    log.error("ANTHROPIC_API_KEY is not set")
 
 # Currently not used but u can input text directly here. Use this to optimize code in the future- claude haiku
 async def analyze_with_claude(input_text):
     """
     Analyze the input text using Claude AI and return the response.
     """
-    message = client.messages.create(
+    message = await anthropic_create(
+        purpose="analysis",
         model="claude-3-haiku-20240307",
         max_tokens=4096,
         temperature=0,
@@ -47,16 +49,17 @@ async def analyze_with_claude_haiku(input_text, max_retries=3):
     """
     Analyze the input text using Claude AI and return structured JSON response.
     """
-    start_time = time.time()
     for attempt in range(max_retries):
         try:
-            message = client.messages.create(
-                model="claude-3-haiku-20240307",
-                max_tokens=2300,
-                system="You're a text analyser that outputs only json array objects...",
-                temperature=0,
-                messages=[{"role": "user", "content": input_text}]
-            )
+            with span("explanation", attempt=attempt + 1):
+                message = await anthropic_create(
+                    purpose="explanation",
+                    model="claude-3-haiku-20240307",
+                    max_tokens=2300,
+                    system="You're a text analyser that outputs only json array objects...",
+                    temperature=0,
+                    messages=[{"role": "user", "content": input_text}]
+                )
             
             response_content = message.content[0].text
             
@@ -87,19 +90,22 @@ async def analyze_with_claude_haiku(input_text, max_retries=3):
                 # Copy UCR validation if exists
                 if "ucr_validation" in parsed_json:
                     validated_json["ucr_validation"].update(parsed_json["ucr_validation"])
-                    end_time = time.time()
-                    print(f"Explanation Time taken: {end_time - start_time} seconds")
                 return validated_json
                 
             except json.JSONDecodeError as e:
-                print(f"Attempt {attempt + 1}: JSON Parse Error: {e}")
+                log.warning("Explanation was not valid JSON", attempt=attempt + 1, error=str(e))
                 if attempt == max_retries - 1:  # Last attempt
                     raise
                 await asyncio.sleep(2 ** attempt)  # Exponential backoff
                 continue
                 
+        except TokenBudgetExceeded as e:
+            return {
+                "summary": f"Analysis skipped: {str(e)}",
+                "ucr_validation": {"procedure_analysis": []}
+            }
         except Exception as e:
-            print(f"Attempt {attempt + 1}: API Error: {e}")
+            log.warning("Explanation API error", attempt=attempt + 1, error=str(e))
             if attempt == max_retries - 1:  # Last attempt
                 return {
                     "summary": f"Analysis failed after {max_retries} attempts: {str(e)}",
@@ -113,4 +119,4 @@ def save_response_to_file(response_data, filename='claude-response.json'):
     """
     with open(filename, 'w', encoding='utf-8') as f:
         json.dump(response_data, f, indent=2, ensure_ascii=False)
-    print(f"Data saved to {filename}")
\ No newline at end of file
+    log.info("Data saved", filename=filename)
\ No newline at end of file
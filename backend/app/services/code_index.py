@@ -0,0 +1,154 @@
+# services/code_index.py
+import re
+from bisect import bisect_left
+from types import MappingProxyType
+from typing import Dict, List, Mapping, NamedTuple, Optional, Sequence, Tuple
+import numpy as np
+from app.services.database import cpt_table, hcpcs_table, DATABASES_DIR, DerivedTable, ReferenceArtifact
+from app.services.log import get_logger
+
+"""
+Local CPT/HCPCS code index.
+
+Built from the cpt.txt and addendum_b.csv reference tables in database.py (and rebuilt
+only when those are reloaded): an immutable code -> record mapping for exact lookups and a
+sorted code array for prefix queries. Validating a bill is a handful of dict lookups,
+with no network calls. databases/map.py prebuilds the (code, description) pairs so
+workers start without parsing either file.
+"""
+
+log = get_logger(__name__)
+
+# Prebuilt artifact written by databases/map.py; bump the version whenever CODE_DTYPE changes
+CODE_ARTIFACT_VERSION = 2
+CODE_ARTIFACT_PATH = DATABASES_DIR / f"code_index.v{CODE_ARTIFACT_VERSION}.npy"
+CODE_DTYPE = np.dtype([
+    ("code", "S5"),
+    ("desc_offset", "<i8"),   # into the artifact's UTF-8 descriptions blob
+    ("desc_length", "<i4"),
+])
+code_artifact = ReferenceArtifact("Code index", CODE_ARTIFACT_PATH, CODE_DTYPE, (hcpcs_table, cpt_table))
+
+# CPT: 5 digits, or 4 digits + a letter (Category II F, Category III T, PLA U, vaccines A, MAAA M)
+# HCPCS Level II: a letter A-V followed by 4 digits
+CODE_TOKEN_PATTERN = re.compile(r"(?<![A-Za-z0-9])(\d{4}[0-9A-Z]|[A-V]\d{4})(?![A-Za-z0-9])")
+
+
+class CodeRecord(NamedTuple):
+    code: str
+    description: str
+    code_type: str
+
+
+class CodeIndex(NamedTuple):
+    records: Mapping[str, CodeRecord]
+    sorted_codes: Tuple[str, ...]
+
+
+def classify_code(code: str) -> Optional[str]:
+    """Code system implied by the code's format, or None if it is not a CPT/HCPCS code"""
+    if len(code) != 5:
+        return None
+    if code.isdigit():
+        return "CPT"
+    if code[:4].isdigit() and code[4].isalpha():
+        return {
+            "F": "CPT Category II",
+            "T": "CPT Category III",
+            "U": "CPT PLA",
+        }.get(code[4], "CPT")
+    if code[0] in "ABCDEGHJKLMPQRSTUV" and code[1:].isdigit():
+        return "HCPCS Level II"
+    return None
+
+
+def _index_from_tables() -> CodeIndex:
+    records: Dict[str, CodeRecord] = {}
+    for code, row in hcpcs_table.records().items():
+        code_type = classify_code(code)
+        if code_type:
+            records[code] = CodeRecord(code, row.description, code_type)
+    for code, row in cpt_table.records().items():
+        code_type = classify_code(code)
+        if code_type and code not in records:
+            records[code] = CodeRecord(code, row.description, code_type)
+    return CodeIndex(MappingProxyType(records), tuple(sorted(records)))
+
+
+def _index_from_artifact(rows: np.ndarray, descriptions: Sequence[str]) -> CodeIndex:
+    records = {}
+    for i, raw_code in enumerate(rows["code"].tolist()):
+        code = raw_code.decode("ascii")
+        records[code] = CodeRecord(code, descriptions[i], classify_code(code))
+    return CodeIndex(MappingProxyType(records), tuple(records))
+
+
+def build_code_records() -> Tuple[np.ndarray, List[str]]:
+    """Every indexed code, sorted, and the descriptions aligned with it, for the prebuilt artifact"""
+    index = _index_from_tables()
+    records = np.zeros(len(index.sorted_codes), dtype=CODE_DTYPE)
+    records["code"] = [code.encode("ascii") for code in index.sorted_codes]
+    return records, [index.records[code].description for code in index.sorted_codes]
+
+
+_code_index = DerivedTable(code_artifact, _index_from_artifact, _index_from_tables)
+
+
+def get_code_index() -> CodeIndex:
+    """
+    The code index. Workers normally just load the prebuilt artifact (again when it is
+    rebuilt); without a current artifact it is built from the tables and rebuilt only when
+    they were reloaded.
+    """
+    return _code_index.get()
+
+
+def lookup_code(code: str) -> Optional[CodeRecord]:
+    return get_code_index().records.get(code)
+
+
+def codes_with_prefix(prefix: str, limit: int = 20) -> List[str]:
+    """Known codes starting with prefix, via binary search on the sorted code array"""
+    sorted_codes = get_code_index().sorted_codes
+    prefix = prefix.upper()
+    matches = []
+    for i in range(bisect_left(sorted_codes, prefix), len(sorted_codes)):
+        if not sorted_codes[i].startswith(prefix) or len(matches) >= limit:
+            break
+        matches.append(sorted_codes[i])
+    return matches
+
+
+def extract_code(raw: str) -> Optional[str]:
+    """
+    Pull the procedure code out of an OCR'd code field such as
+    "ER Facility Level 3 - 99283 (CPT®)". Known codes win over merely well-formed ones.
+    """
+    candidates = CODE_TOKEN_PATTERN.findall(str(raw or "").upper())
+    for candidate in candidates:
+        if candidate in get_code_index().records:
+            return candidate
+    for candidate in candidates:
+        if classify_code(candidate):
+            return candidate
+    return None
+
+
+def validate_procedure(procedure: Dict) -> Dict:
+    """Validate one OCR'd line item against the local index"""
+    raw_code = procedure.get("code", "")
+    code = extract_code(raw_code)
+    record = lookup_code(code) if code else None
+    return {
+        "code": code or raw_code,
+        "billed_description": procedure.get("description", ""),
+        "cost": procedure.get("cost"),
+        "is_valid": record is not None,
+        "code_type": record.code_type if record else (classify_code(code) if code else None),
+        "description": record.description if record else None,
+        "reason": None if record else ("Unknown code" if code else "No CPT/HCPCS code found"),
+    }
+
+
+def validate_procedures(procedures: List[Dict]) -> List[Dict]:
+    return [validate_procedure(procedure) for procedure in procedures]
@@ -1,52 +1,349 @@
 # services/database.py
-from typing import Optional, Dict
-import json
+from typing import Optional, Dict, Callable, Mapping, Tuple
 import csv
+import os
+import sys
+import threading
+import time
 from pathlib import Path
+from types import MappingProxyType
+import numpy as np
+from app.services.log import get_logger
+
+"""
+Process-wide reference data (CPT descriptions, Medicare rates, OPPS addenda A and B).
+
+Each table is parsed once, on first use, and then served from memory; load_all() warms
+the indexes built on them at startup. Tables are reloaded when their source file's mtime changes; the check is
+throttled to once every REFERENCE_RELOAD_INTERVAL seconds so lookups stay O(1).
+"""
 
 # Get the base directory of your project
+log = get_logger(__name__)
+
 BASE_DIR = Path(__file__).resolve().parent.parent.parent
+DATABASES_DIR = BASE_DIR / "databases"
+
+REFERENCE_RELOAD_INTERVAL = float(os.getenv("REFERENCE_RELOAD_INTERVAL", "30"))
+
+
+class CptRecord:
+    __slots__ = ("code", "description")
+
+    def __init__(self, code: str, description: str):
+        self.code = code
+        self.description = description
+
+    def to_dict(self) -> Dict:
+        return {"code": self.code, "description": self.description}
+
+
+class MedicareRecord:
+    __slots__ = ("code", "apc", "description", "payment_rate")
+
+    def __init__(self, code: str, apc: str, description: str, payment_rate: str):
+        self.code = code
+        self.apc = apc
+        self.description = description
+        self.payment_rate = payment_rate
+
+    def to_dict(self) -> Dict:
+        return {
+            "code": self.code,
+            "apc": self.apc,
+            "description": self.description,
+            "payment_rate": self.payment_rate
+        }
+
+
+class HcpcsRecord:
+    __slots__ = ("code", "description", "apc", "payment_rate")
+
+    def __init__(self, code: str, description: str, apc: str, payment_rate: str):
+        self.code = code
+        self.description = description
+        self.apc = apc
+        self.payment_rate = payment_rate
+
+    def to_dict(self) -> Dict:
+        return {
+            "code": self.code,
+            "description": self.description,
+            "apc": self.apc,
+            "payment_rate": self.payment_rate
+        }
+
+
+class ApcRecord:
+    __slots__ = ("apc", "title", "payment_rate")
+
+    def __init__(self, apc: str, title: str, payment_rate: str):
+        self.apc = apc
+        self.title = title
+        self.payment_rate = payment_rate
+
+    def to_dict(self) -> Dict:
+        return {"apc": self.apc, "title": self.title, "payment_rate": self.payment_rate}
+
+
+def normalize_table_code(code: str) -> str:
+    # Spreadsheet exports drop leading zeros from anesthesia codes (00100 -> 100)
+    code = code.strip().upper()
+    return code.zfill(5) if code.isdigit() else code
+
+
+def _parse_cpt(path: Path) -> Dict[str, CptRecord]:
+    records = {}
+    with open(path, "r") as file:
+        for line in file:
+            parts = line.strip().split(": ", 1)
+            if len(parts) == 2:
+                code = normalize_table_code(parts[0])
+                records[code] = CptRecord(code, parts[1])
+    return records
+
+
+def _parse_medicare(path: Path) -> Dict[str, MedicareRecord]:
+    # One row per APC with '; '-joined codes and descriptors; index each code separately
+    records = {}
+    with open(path, "r", encoding="utf-8-sig") as file:
+        for row in csv.DictReader(file):
+            codes = row["HCPCS Code"].split("; ")
+            descriptions = row["Description"].split("; ")
+            for i, code in enumerate(codes):
+                code = normalize_table_code(code)
+                description = descriptions[i] if i < len(descriptions) else row["Description"]
+                records[code] = MedicareRecord(code, row["APC"], description, row["Payment Rate"])
+    return records
+
+
+def _parse_hcpcs(path: Path) -> Dict[str, HcpcsRecord]:
+    records = {}
+    with open(path, "r", encoding="utf-8-sig") as file:
+        for row in csv.DictReader(file):
+            code = normalize_table_code(row["HCPCS Code"])
+            records[code] = HcpcsRecord(
+                code,
+                row["Short Descriptor"].strip(),
+                sys.intern(row["APC"]),
+                sys.intern(row["Payment Rate"].strip())
+            )
+    return records
+
+
+def _parse_apc(path: Path) -> Dict[str, ApcRecord]:
+    records = {}
+    with open(path, "r", encoding="utf-8-sig") as file:
+        reader = csv.reader(file)
+        next(reader, None)  # header: APC, Group Title, Payment Rate
+        for row in reader:
+            if len(row) >= 3:
+                apc = row[0].strip()
+                records[apc] = ApcRecord(apc, row[1].strip(), row[2].strip())
+    return records
+
+
+class ReferenceTable:
+    """A parsed file kept in memory and reloaded when the file changes on disk"""
+
+    def __init__(self, name: str, path: Path, parser: Callable[[Path], Dict]):
+        self.name = name
+        self.path = path
+        self.parser = parser
+        self.version = 0  # bumped on every (re)load so derived indexes can rebuild
+        self._records: Optional[Mapping] = None
+        self._mtime: Optional[float] = None
+        self._next_check = 0.0
+        self._lock = threading.Lock()
+
+    def _current_mtime(self) -> Optional[float]:
+        try:
+            return self.path.stat().st_mtime
+        except FileNotFoundError:
+            return None
+
+    def records(self) -> Mapping:
+        now = time.monotonic()
+        if self._records is not None and now < self._next_check:
+            return self._records
+
+        with self._lock:
+            mtime = self._current_mtime()
+            if self._records is None or mtime != self._mtime:
+                try:
+                    self._records = MappingProxyType(self.parser(self.path))
+                except FileNotFoundError:
+                    log.error("Database file not found", database=self.name)
+                    self._records = MappingProxyType({})
+                self._mtime = mtime
+                self.version += 1
+            self._next_check = now + REFERENCE_RELOAD_INTERVAL
+        return self._records
+
+    def get(self, code: str):
+        return self.records().get(code)
+
+
+cpt_table = ReferenceTable("CPT", DATABASES_DIR / "cpt.txt", _parse_cpt)
+medicare_table = ReferenceTable("Medicare rates", DATABASES_DIR / "medicare_rates.csv", _parse_medicare)
+hcpcs_table = ReferenceTable("Addendum B", DATABASES_DIR / "addendum_b.csv", _parse_hcpcs)
+apc_table = ReferenceTable("Addendum A", DATABASES_DIR / "addendum_a.csv", _parse_apc)
+
+
+class Descriptions:
+    """Variable-length UTF-8 strings stored as one byte blob plus per-row offsets and lengths"""
+
+    def __init__(self, blob, offsets, lengths):
+        self._blob = blob
+        self._offsets = offsets
+        self._lengths = lengths
+
+    def __len__(self) -> int:
+        return len(self._offsets)
+
+    def __getitem__(self, i: int) -> str:
+        start = int(self._offsets[i])
+        return bytes(self._blob[start:start + int(self._lengths[i])]).decode("utf-8")
+
+    @staticmethod
+    def encode(texts) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """(blob, offsets, lengths) for a sequence of strings"""
+        encoded = [text.encode("utf-8") for text in texts]
+        lengths = np.array([len(data) for data in encoded], dtype="<i4")
+        offsets = np.zeros(len(encoded), dtype="<i8")
+        if len(encoded):
+            offsets[1:] = np.cumsum(lengths[:-1])
+        return np.frombuffer(b"".join(encoded), dtype=np.uint8), offsets, lengths
+
+
+class ReferenceArtifact:
+    """
+    A prebuilt, memory-mappable form of one or more reference tables (written by
+    databases/map.py). Fixed-width fields live in <name>.npy with desc_offset/desc_length
+    columns pointing into <name>.descriptions.npy, a UTF-8 byte blob. The artifact is only
+    used while it is newer than every source table; like the tables, that is re-checked at
+    most once every REFERENCE_RELOAD_INTERVAL seconds.
+    """
+
+    def __init__(self, name: str, path: Path, dtype, sources):
+        self.name = name
+        self.path = path
+        self.descriptions_path = path.with_name(path.stem + ".descriptions.npy")
+        self.dtype = dtype
+        self.sources = sources
+        self._current: Optional[float] = None
+        self._next_check = 0.0
+        self._lock = threading.Lock()
+
+    def current_mtime(self) -> Optional[float]:
+        """The artifact's mtime if it is present and newer than its sources, else None"""
+        now = time.monotonic()
+        if now < self._next_check:
+            return self._current
+        with self._lock:
+            try:
+                built = self.path.stat().st_mtime
+                newest_source = max(table.path.stat().st_mtime for table in self.sources)
+                self._current = built if built >= newest_source else None
+            except FileNotFoundError:
+                self._current = None
+            self._next_check = now + REFERENCE_RELOAD_INTERVAL
+        return self._current
+
+    def load(self):
+        """(records, Descriptions) memory-mapped from disk, or None if unusable"""
+        try:
+            records = np.load(self.path, mmap_mode="r")
+            blob = np.load(self.descriptions_path, mmap_mode="r")
+        except (FileNotFoundError, ValueError) as e:
+            log.warning("Reference artifact could not be loaded", artifact=self.path.name, error=str(e))
+            return None
+        if records.dtype != self.dtype:
+            log.warning("Reference artifact has an unexpected layout, rebuilding from CSV", artifact=self.path.name)
+            return None
+        if len(records) and int(records["desc_offset"][-1]) + int(records["desc_length"][-1]) != len(blob):
+            # Caught between the two renames of a rebuild; the next check picks up the new pair
+            log.warning("Reference artifact descriptions do not match its records", artifact=self.path.name)
+            return None
+        return records, Descriptions(blob, records["desc_offset"], records["desc_length"])
+
+    def write(self, records, descriptions) -> None:
+        """Atomically replace both files; descriptions first, so records never point past them"""
+        blob, records["desc_offset"], records["desc_length"] = Descriptions.encode(descriptions)
+        for path, array in ((self.descriptions_path, blob), (self.path, records)):
+            tmp_path = path.with_suffix(".tmp.npy")
+            np.save(tmp_path, array)
+            os.replace(tmp_path, path)
+        self._next_check = 0.0
+
+
+class DerivedTable:
+    """
+    A structure derived from reference tables (price table, code index): built from their
+    artifact while it is current, otherwise from the parsed tables, and rebuilt whenever
+    either changes on disk.
+    """
+
+    def __init__(self, artifact: ReferenceArtifact, from_artifact: Callable, from_tables: Callable):
+        self.artifact = artifact
+        self.from_artifact = from_artifact
+        self.from_tables = from_tables
+        self._value = None
+        # ("artifact", mtime) or ("tables", table versions...)
+        self._source: Optional[tuple] = None
+        self._unloadable_mtime: Optional[float] = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        mtime = self.artifact.current_mtime()
+        if self._value is not None and self._source == ("artifact", mtime):
+            return self._value
+        with self._lock:
+            if mtime is not None and mtime != self._unloadable_mtime:
+                if self._source == ("artifact", mtime):
+                    return self._value
+                loaded = self.artifact.load()
+                if loaded is not None:
+                    self._value, self._source = self.from_artifact(*loaded), ("artifact", mtime)
+                    return self._value
+                self._unloadable_mtime = mtime  # don't retry until the artifact is rewritten
+
+            versions = ["tables"]
+            for table in self.artifact.sources:
+                table.records()
+                versions.append(table.version)
+            if self._value is None or self._source != tuple(versions):
+                self._value, self._source = self.from_tables(), tuple(versions)
+            return self._value
+
+
+def load_all() -> None:
+    """
+    Load the reference data the request path uses (called once at startup, off the event loop):
+    the code index and price table, from their prebuilt artifacts when current. Tables those
+    cover are then only parsed if something reads them directly.
+    """
+    # Imported here: both indexes are built on the tables defined above
+    from app.services.code_index import get_code_index
+    from app.services.pricing import get_price_table
+    get_code_index()
+    get_price_table()
+
+
+async def load_cpt_database() -> Mapping[str, CptRecord]:
+    """CPT codes from text file (served from memory after the first load)"""
+    return cpt_table.records()
 
-async def load_cpt_database() -> Dict:
-    """Load CPT codes from text file"""
-    cpt_codes = {}
-    try:
-        with open(BASE_DIR / "databases" / "cpt.txt", 'r') as file:
-            for line in file:
-                parts = line.strip().split(": ")
-                if len(parts) == 2:
-                    code, description = parts
-                    cpt_codes[code] = {
-                        "code": code,
-                        "description": description
-                    }
-    except FileNotFoundError:
-        print(f"Error: CPT database file not found")
-    return cpt_codes
-
-async def load_medicare_database() -> Dict:
-    """Load Medicare rates from CSV file"""
-    medicare_rates = {}
-    try:
-        with open(BASE_DIR / "databases" / "medicare_rates.csv", 'r') as file:
-            csv_reader = csv.DictReader(file)
-            for row in csv_reader:
-                code = row['HCPCS Code']
-                medicare_rates[code] = {
-                    'code': code,
-                    'apc': row['APC'],
-                    'description': row['Description']
-                }
-    except FileNotFoundError:
-        print(f"Error: Medicare rates database file not found")
-    return medicare_rates
+async def load_medicare_database() -> Mapping[str, MedicareRecord]:
+    """Medicare rates from CSV file, one record per HCPCS code (served from memory)"""
+    return medicare_table.records()
 
 async def get_cpt_code(code: str) -> Optional[Dict]:
     """Get a specific CPT code information"""
-    cpt_codes = load_cpt_database()
-    return cpt_codes.get(code)
+    record = cpt_table.get(code)
+    return record.to_dict() if record else None
 
 async def get_medicare_rate(code: str) -> Optional[Dict]:
     """Get a specific Medicare rate information"""
-    medicare_rates = load_medicare_database()
-    return medicare_rates.get(code)
\ No newline at end of file
+    record = medicare_table.get(code)
+    return record.to_dict() if record else None
@@ -0,0 +1,506 @@
+# services/jobs.py
+import asyncio
+import base64
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+from dotenv import load_dotenv
+from app.services.log import get_logger
+
+"""
+Job queue and result store for asynchronous analyses (POST /api/jobs, GET /api/jobs/{id}).
+
+The web tier only enqueues the uploads and reads results back; worker processes
+(python -m app.worker) claim jobs, run the analysis and store the result, so workers scale
+independently of uvicorn. Backed by Redis when REDIS_URL is set, otherwise by a local
+SQLite file shared by every process on the host.
+
+A claimed job holds a lease that its worker renews while the job runs; if the worker dies
+the job is claimed again once the lease expires. Completing, failing or renewing a job is
+fenced on the (worker, attempts) pair of the claim, so a worker whose lease was taken over
+can no longer change the job. Failed jobs are retried with exponential backoff up to JOB_MAX_ATTEMPTS. Results
+(and failures) are kept for JOB_RESULT_TTL_SECONDS.
+"""
+
+load_dotenv()
+
+log = get_logger(__name__)
+
+BASE_DIR = Path(__file__).resolve().parent.parent.parent
+
+JOB_QUEUE_PATH = os.getenv("JOB_QUEUE_PATH", str(BASE_DIR / "jobs.sqlite3"))
+REDIS_URL = os.getenv("REDIS_URL")
+JOB_RESULT_TTL_SECONDS = int(os.getenv("JOB_RESULT_TTL_SECONDS", str(24 * 3600)))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+# Retry n waits JOB_RETRY_BACKOFF_SECONDS * 2**(n-1)
+JOB_RETRY_BACKOFF_SECONDS = float(os.getenv("JOB_RETRY_BACKOFF_SECONDS", "5"))
+# A job whose worker stops renewing its lease for this long is handed to another worker
+JOB_LEASE_SECONDS = int(os.getenv("JOB_LEASE_SECONDS", "60"))
+# How often a worker renews the leases of the jobs it is running
+JOB_LEASE_RENEW_SECONDS = float(os.getenv("JOB_LEASE_RENEW_SECONDS", str(JOB_LEASE_SECONDS / 4)))
+# Submissions are refused (503) while this many jobs are waiting; 0 = unbounded
+JOB_QUEUE_MAX_DEPTH = int(os.getenv("JOB_QUEUE_MAX_DEPTH", "0"))
+# Wait and run times are summarized over jobs finished within this window
+JOB_STATS_WINDOW_SECONDS = int(os.getenv("JOB_STATS_WINDOW_SECONDS", "3600"))
+
+QUEUED, RUNNING, DONE, FAILED = "queued", "running", "done", "failed"
+
+
+class QueueFull(Exception):
+    pass
+
+
+def encode_payload(uploads: List[Tuple[bytes, str]], location: Optional[str] = None,
+                   zip_code: Optional[str] = None) -> str:
+    return json.dumps({
+        "uploads": [
+            {"content_type": content_type, "content": base64.b64encode(content).decode("ascii")}
+            for content, content_type in uploads
+        ],
+        "location": location,
+        "zip_code": zip_code,
+    })
+
+
+def decode_payload(payload: str) -> Dict[str, Any]:
+    data = json.loads(payload)
+    data["uploads"] = [
+        (base64.b64decode(upload["content"]), upload["content_type"]) for upload in data["uploads"]
+    ]
+    return data
+
+
+def retry_delay(attempts: int) -> float:
+    return JOB_RETRY_BACKOFF_SECONDS * 2 ** max(attempts - 1, 0)
+
+
+def _summarize(samples: List[float]) -> Dict[str, float]:
+    if not samples:
+        return {"count": 0, "avg": 0.0, "p50": 0.0, "p95": 0.0, "max": 0.0}
+    samples = sorted(samples)
+    return {
+        "count": len(samples),
+        "avg": round(sum(samples) / len(samples), 3),
+        "p50": round(samples[len(samples) // 2], 3),
+        "p95": round(samples[min(len(samples) - 1, int(len(samples) * 0.95))], 3),
+        "max": round(samples[-1], 3),
+    }
+
+
+def _public(job: Dict[str, Any]) -> Dict[str, Any]:
+    """A job as returned by GET /api/jobs/{id}"""
+    public = {
+        "job_id": job["id"],
+        "status": job["status"],
+        "attempts": int(job.get("attempts") or 0),
+        "created_at": float(job["created_at"]),
+        "started_at": float(job["started_at"]) if job.get("started_at") else None,
+        "finished_at": float(job["finished_at"]) if job.get("finished_at") else None,
+    }
+    if job.get("result"):
+        public["result"] = json.loads(job["result"])
+    if job.get("error"):
+        public["error"] = job["error"]
+    return public
+
+
+class SQLiteJobStore:
+    """Jobs in a local SQLite file. Blocking; call via asyncio.to_thread"""
+
+    def __init__(self, path: str):
+        self._lock = threading.Lock()
+        # Autocommit mode; claim() opens its own BEGIN IMMEDIATE so workers never claim the same job
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            " id TEXT PRIMARY KEY, status TEXT NOT NULL, payload TEXT, result TEXT, error TEXT,"
+            " attempts INTEGER NOT NULL DEFAULT 0, max_attempts INTEGER NOT NULL,"
+            " created_at REAL NOT NULL, available_at REAL NOT NULL, started_at REAL,"
+            " finished_at REAL, lease_expires_at REAL, expires_at REAL,"
+            " wait_seconds REAL, run_seconds REAL, worker TEXT)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_status_available ON jobs(status, available_at)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_expires_at ON jobs(expires_at)")
+
+    def submit(self, job_id: str, payload: str, max_depth: int) -> None:
+        now = time.time()
+        with self._lock:
+            self._conn.execute("DELETE FROM jobs WHERE expires_at < ?", (now,))
+            if max_depth:
+                depth = self._conn.execute("SELECT COUNT(*) FROM jobs WHERE status = ?", (QUEUED,)).fetchone()[0]
+                if depth >= max_depth:
+                    raise QueueFull(f"{depth} jobs waiting")
+            self._conn.execute(
+                "INSERT INTO jobs (id, status, payload, max_attempts, created_at, available_at)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                (job_id, QUEUED, payload, JOB_MAX_ATTEMPTS, now, now)
+            )
+
+    def claim(self, worker: str) -> Optional[Dict[str, Any]]:
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                # Jobs whose worker died with no attempts left fail instead of being claimed again
+                self._conn.execute(
+                    "UPDATE jobs SET status = ?, error = 'Worker lease expired', finished_at = ?,"
+                    " expires_at = ?, payload = NULL"
+                    " WHERE status = ? AND lease_expires_at < ? AND attempts >= max_attempts",
+                    (FAILED, now, now + JOB_RESULT_TTL_SECONDS, RUNNING, now)
+                )
+                row = self._conn.execute(
+                    "SELECT id FROM jobs WHERE (status = ? AND available_at <= ?)"
+                    " OR (status = ? AND lease_expires_at < ?) ORDER BY available_at LIMIT 1",
+                    (QUEUED, now, RUNNING, now)
+                ).fetchone()
+                if row is None:
+                    self._conn.execute("COMMIT")
+                    return None
+                self._conn.execute(
+                    "UPDATE jobs SET status = ?, attempts = attempts + 1, started_at = ?,"
+                    " lease_expires_at = ?, worker = ?, wait_seconds = COALESCE(wait_seconds, ? - created_at)"
+                    " WHERE id = ?",
+                    (RUNNING, now, now + JOB_LEASE_SECONDS, worker, now, row["id"])
+                )
+                job = dict(self._conn.execute("SELECT * FROM jobs WHERE id = ?", (row["id"],)).fetchone())
+                self._conn.execute("COMMIT")
+                return job
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    # Only the claim that holds the job may change it
+    FENCE = " WHERE id = ? AND status = 'running' AND worker = ? AND attempts = ?"
+
+    def renew(self, job_id: str, worker: str, attempts: int) -> bool:
+        with self._lock:
+            cursor = self._conn.execute(
+                "UPDATE jobs SET lease_expires_at = ?" + self.FENCE,
+                (time.time() + JOB_LEASE_SECONDS, job_id, worker, attempts)
+            )
+        return cursor.rowcount == 1
+
+    def complete(self, job_id: str, worker: str, attempts: int, result: str) -> bool:
+        now = time.time()
+        with self._lock:
+            cursor = self._conn.execute(
+                "UPDATE jobs SET status = ?, result = ?, error = NULL, finished_at = ?,"
+                " run_seconds = ? - started_at, expires_at = ?, payload = NULL" + self.FENCE,
+                (DONE, result, now, now, now + JOB_RESULT_TTL_SECONDS, job_id, worker, attempts)
+            )
+        return cursor.rowcount == 1
+
+    def fail(self, job_id: str, worker: str, attempts: int, error: str, retry: bool) -> Optional[str]:
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT max_attempts FROM jobs" + self.FENCE, (job_id, worker, attempts)
+            ).fetchone()
+            if row is None:
+                return None
+            if retry and attempts < row["max_attempts"]:
+                cursor = self._conn.execute(
+                    "UPDATE jobs SET status = ?, error = ?, available_at = ?, lease_expires_at = NULL" + self.FENCE,
+                    (QUEUED, error, now + retry_delay(attempts), job_id, worker, attempts)
+                )
+                return QUEUED if cursor.rowcount == 1 else None
+            cursor = self._conn.execute(
+                "UPDATE jobs SET status = ?, error = ?, finished_at = ?, run_seconds = ? - started_at,"
+                " expires_at = ?, payload = NULL" + self.FENCE,
+                (FAILED, error, now, now, now + JOB_RESULT_TTL_SECONDS, job_id, worker, attempts)
+            )
+            return FAILED if cursor.rowcount == 1 else None
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT id, status, result, error, attempts, created_at, started_at, finished_at, expires_at"
+                " FROM jobs WHERE id = ?", (job_id,)
+            ).fetchone()
+        if row is None or (row["expires_at"] is not None and row["expires_at"] < time.time()):
+            return None
+        return dict(row)
+
+    def stats(self) -> Dict[str, Any]:
+        now = time.time()
+        with self._lock:
+            counts = dict(self._conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+            oldest = self._conn.execute(
+                "SELECT MIN(created_at) FROM jobs WHERE status = ?", (QUEUED,)
+            ).fetchone()[0]
+            recent = self._conn.execute(
+                "SELECT status, wait_seconds, run_seconds, attempts FROM jobs WHERE finished_at >= ?",
+                (now - JOB_STATS_WINDOW_SECONDS,)
+            ).fetchall()
+        return {
+            "depth": counts.get(QUEUED, 0),
+            "running": counts.get(RUNNING, 0),
+            "oldest_queued_seconds": round(now - oldest, 3) if oldest else 0.0,
+            "completed": sum(1 for row in recent if row["status"] == DONE),
+            "failed": sum(1 for row in recent if row["status"] == FAILED),
+            "retried": sum(1 for row in recent if row["attempts"] > 1),
+            "wait_seconds": _summarize([row["wait_seconds"] for row in recent if row["wait_seconds"] is not None]),
+            "run_seconds": _summarize([row["run_seconds"] for row in recent if row["run_seconds"] is not None]),
+        }
+
+
+# Lua scripts run atomically in Redis, so no two workers can claim, expire or finish a job
+# between each other's reads and writes. Job hashes are keyed "job:<id>".
+_REDIS_CLAIM = """
+for _, id in ipairs(redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', ARGV[1])) do
+    redis.call('ZREM', KEYS[2], id)
+    redis.call('LPUSH', KEYS[1], id)
+end
+local id = redis.call('RPOP', KEYS[1])
+if not id then return false end
+local key = 'job:' .. id
+if redis.call('EXISTS', key) == 0 then return false end
+redis.call('ZADD', KEYS[3], ARGV[2], id)
+redis.call('HINCRBY', key, 'attempts', 1)
+redis.call('HSET', key, 'status', 'running', 'started_at', ARGV[1], 'worker', ARGV[3])
+if redis.call('HEXISTS', key, 'wait_seconds') == 0 then
+    local waited = tonumber(ARGV[1]) - tonumber(redis.call('HGET', key, 'created_at'))
+    redis.call('HSET', key, 'wait_seconds', tostring(waited))
+end
+return redis.call('HGETALL', key)
+"""
+
+# Requeue (or fail, once out of attempts) a job whose lease has expired
+_REDIS_EXPIRE = """
+local lease = redis.call('ZSCORE', KEYS[1], ARGV[1])
+if not lease or tonumber(lease) >= tonumber(ARGV[2]) then return false end
+redis.call('ZREM', KEYS[1], ARGV[1])
+local attempts = tonumber(redis.call('HGET', KEYS[3], 'attempts') or 0)
+if attempts >= tonumber(redis.call('HGET', KEYS[3], 'max_attempts') or ARGV[3]) then
+    redis.call('HSET', KEYS[3], 'status', 'failed', 'error', 'Worker lease expired')
+    return 'failed'
+end
+redis.call('HSET', KEYS[3], 'status', 'queued')
+redis.call('LPUSH', KEYS[2], ARGV[1])
+return 'queued'
+"""
+
+# Only the claim that holds the job (ARGV: id, worker, attempts) may change it
+_REDIS_FENCE = """
+if redis.call('HGET', KEYS[2], 'status') ~= 'running' or redis.call('HGET', KEYS[2], 'worker') ~= ARGV[2]
+        or redis.call('HGET', KEYS[2], 'attempts') ~= ARGV[3] then
+    return 0
+end
+"""
+
+_REDIS_RENEW = _REDIS_FENCE + """
+redis.call('ZADD', KEYS[1], 'XX', ARGV[4], ARGV[1])
+return 1
+"""
+
+# Leave the running set as ARGV[4] (done / failed / queued), setting field ARGV[5] to ARGV[6];
+# a queued job is delayed until ARGV[7]
+_REDIS_RELEASE = _REDIS_FENCE + """
+redis.call('ZREM', KEYS[1], ARGV[1])
+redis.call('HSET', KEYS[2], 'status', ARGV[4], ARGV[5], ARGV[6])
+if ARGV[4] == 'queued' then
+    redis.call('ZADD', KEYS[3], ARGV[7], ARGV[1])
+end
+return 1
+"""
+
+
+class RedisJobStore:
+    """
+    Jobs in Redis: a hash per job, a list of ready ids, and sorted sets for delayed retries
+    and running leases (scored by when the job becomes ready / the lease expires).
+    """
+
+    SAMPLES = 1000
+
+    def __init__(self, url: str):
+        import redis.asyncio as redis_asyncio
+        self._redis = redis_asyncio.from_url(url, decode_responses=True)
+        self._claim = self._redis.register_script(_REDIS_CLAIM)
+        self._expire = self._redis.register_script(_REDIS_EXPIRE)
+        self._renew = self._redis.register_script(_REDIS_RENEW)
+        self._release = self._redis.register_script(_REDIS_RELEASE)
+
+    @staticmethod
+    def _key(job_id: str) -> str:
+        return f"job:{job_id}"
+
+    async def submit(self, job_id: str, payload: str, max_depth: int) -> None:
+        if max_depth:
+            depth = await self._redis.llen("jobs:ready")
+            if depth >= max_depth:
+                raise QueueFull(f"{depth} jobs waiting")
+        now = time.time()
+        await self._redis.hset(self._key(job_id), mapping={
+            "id": job_id, "status": QUEUED, "payload": payload, "attempts": 0,
+            "max_attempts": JOB_MAX_ATTEMPTS, "created_at": now,
+        })
+        await self._redis.lpush("jobs:ready", job_id)
+
+    async def _expire_leases(self, now: float) -> None:
+        for job_id in await self._redis.zrangebyscore("jobs:running", "-inf", now):
+            outcome = await self._expire(
+                keys=["jobs:running", "jobs:ready", self._key(job_id)], args=[job_id, now, JOB_MAX_ATTEMPTS]
+            )
+            if outcome == FAILED:
+                await self._finish(job_id, FAILED, now, error="Worker lease expired")
+
+    async def claim(self, worker: str) -> Optional[Dict[str, Any]]:
+        now = time.time()
+        await self._expire_leases(now)
+        fields = await self._claim(
+            keys=["jobs:ready", "jobs:delayed", "jobs:running"], args=[now, now + JOB_LEASE_SECONDS, worker]
+        )
+        if not fields:
+            return None
+        return dict(zip(fields[::2], fields[1::2]))
+
+    async def _finish(self, job_id: str, status: str, now: float, result: Optional[str] = None,
+                      error: Optional[str] = None) -> None:
+        key = self._key(job_id)
+        job = await self._redis.hgetall(key)
+        update = {"status": status, "finished_at": now}
+        if result is not None:
+            update["result"] = result
+        if error is not None:
+            update["error"] = error
+        if job.get("started_at"):
+            update["run_seconds"] = now - float(job["started_at"])
+            await self._redis.lpush("jobs:run_samples", f"{now}:{update['run_seconds']}")
+        if job.get("wait_seconds"):
+            await self._redis.lpush("jobs:wait_samples", f"{now}:{job['wait_seconds']}")
+        await self._redis.ltrim("jobs:run_samples", 0, self.SAMPLES - 1)
+        await self._redis.ltrim("jobs:wait_samples", 0, self.SAMPLES - 1)
+        await self._redis.hset(key, mapping=update)
+        await self._redis.hdel(key, "payload")
+        await self._redis.expire(key, JOB_RESULT_TTL_SECONDS)
+        await self._redis.hincrby("jobs:stats", status, 1)
+        if int(job.get("attempts", 0)) > 1:
+            await self._redis.hincrby("jobs:stats", "retried", 1)
+
+    async def renew(self, job_id: str, worker: str, attempts: int) -> bool:
+        renewed = await self._renew(
+            keys=["jobs:running", self._key(job_id)], args=[job_id, worker, attempts, time.time() + JOB_LEASE_SECONDS]
+        )
+        return bool(renewed)
+
+    async def _release_job(self, job_id: str, worker: str, attempts: int, status: str, field: str, value: str,
+                           retry_at: float = 0.0) -> bool:
+        released = await self._release(
+            keys=["jobs:running", self._key(job_id), "jobs:delayed"],
+            args=[job_id, worker, attempts, status, field, value, retry_at]
+        )
+        return bool(released)
+
+    async def complete(self, job_id: str, worker: str, attempts: int, result: str) -> bool:
+        if not await self._release_job(job_id, worker, attempts, DONE, "result", result):
+            return False
+        await self._finish(job_id, DONE, time.time(), result=result)
+        return True
+
+    async def fail(self, job_id: str, worker: str, attempts: int, error: str, retry: bool) -> Optional[str]:
+        max_attempts = int(await self._redis.hget(self._key(job_id), "max_attempts") or JOB_MAX_ATTEMPTS)
+        if retry and attempts < max_attempts:
+            retry_at = time.time() + retry_delay(attempts)
+            released = await self._release_job(job_id, worker, attempts, QUEUED, "error", error, retry_at)
+            return QUEUED if released else None
+        if not await self._release_job(job_id, worker, attempts, FAILED, "error", error):
+            return None
+        await self._finish(job_id, FAILED, time.time(), error=error)
+        return FAILED
+
+    async def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        job = await self._redis.hgetall(self._key(job_id))
+        return job or None
+
+    async def stats(self) -> Dict[str, Any]:
+        now = time.time()
+        depth = await self._redis.llen("jobs:ready") + await self._redis.zcard("jobs:delayed")
+        counters = await self._redis.hgetall("jobs:stats")
+
+        async def samples(key):
+            values = []
+            for sample in await self._redis.lrange(key, 0, -1):
+                finished_at, seconds = sample.split(":")
+                if float(finished_at) >= now - JOB_STATS_WINDOW_SECONDS:
+                    values.append(float(seconds))
+            return values
+
+        return {
+            "depth": depth,
+            "running": await self._redis.zcard("jobs:running"),
+            # Totals since the counters were created, not per window
+            "completed": int(counters.get(DONE, 0)),
+            "failed": int(counters.get(FAILED, 0)),
+            "retried": int(counters.get("retried", 0)),
+            "wait_seconds": _summarize(await samples("jobs:wait_samples")),
+            "run_seconds": _summarize(await samples("jobs:run_samples")),
+        }
+
+
+class JobQueue:
+    def __init__(self):
+        self.store = None
+        try:
+            if REDIS_URL:
+                self.store = RedisJobStore(REDIS_URL)
+            else:
+                self.store = SQLiteJobStore(JOB_QUEUE_PATH)
+        except Exception as e:
+            log.warning("Job queue disabled", error=str(e))
+
+    async def _call(self, method: str, *args):
+        if self.store is None:
+            raise RuntimeError("Job queue is not available")
+        if isinstance(self.store, SQLiteJobStore):
+            return await asyncio.to_thread(getattr(self.store, method), *args)
+        return await getattr(self.store, method)(*args)
+
+    async def submit(self, payload: str) -> str:
+        """Enqueue a job; raises QueueFull when JOB_QUEUE_MAX_DEPTH jobs are already waiting"""
+        job_id = uuid.uuid4().hex
+        await self._call("submit", job_id, payload, JOB_QUEUE_MAX_DEPTH)
+        return job_id
+
+    async def claim(self, worker: str) -> Optional[Dict[str, Any]]:
+        """The next ready job (with its payload), leased to worker; None if there is none"""
+        return await self._call("claim", worker)
+
+    async def renew(self, job: Dict[str, Any]) -> bool:
+        """Extend the lease of a claimed job; False if the claim no longer holds it"""
+        return await self._call("renew", job["id"], job["worker"], int(job["attempts"]))
+
+    async def complete(self, job: Dict[str, Any], result: Dict[str, Any]) -> bool:
+        """Store the result of a claimed job; False (result dropped) if the claim no longer holds it"""
+        return await self._call("complete", job["id"], job["worker"], int(job["attempts"]),
+                                json.dumps(result, default=str))
+
+    async def fail(self, job: Dict[str, Any], error: str, retry: bool = True) -> Optional[str]:
+        """
+        Schedule a retry of a claimed job if attempts remain (returns "queued"), else mark it
+        failed; None if the claim no longer holds the job.
+        """
+        return await self._call("fail", job["id"], job["worker"], int(job["attempts"]), error, retry)
+
+    async def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        job = await self._call("get", job_id)
+        return _public(job) if job else None
+
+    async def get_stats(self) -> Optional[Dict[str, Any]]:
+        if self.store is None:
+            return None
+        try:
+            return {**await self._call("stats"), "backend": type(self.store).__name__}
+        except Exception as e:
+            log.error("Job queue stats error", error=str(e))
+            return None
+
+
+job_queue = JobQueue()
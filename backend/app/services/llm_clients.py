@@ -0,0 +1,102 @@
+# services/llm_clients.py
+from anthropic import AsyncAnthropic
+from openai import AsyncOpenAI
+import os
+import asyncio
+import time
+from typing import Dict, Optional
+from dotenv import load_dotenv
+from app.services.tokens import count_message_tokens, record_usage, reserve_budget
+from app.services.tracing import annotate
+
+"""
+Shared async clients for the LLM providers used by ocr.py, claude.py and perplexity.py.
+
+Every provider call goes through anthropic_create / perplexity_create so that the
+event loop is never blocked on a model call, each provider has its own cap on
+in-flight requests per worker, and every call's token usage and latency is recorded
+in tokens.py. A call holds a reservation on the request's token budget while in flight.
+Token counts are also added to the caller's current tracing span.
+"""
+
+load_dotenv()
+
+PERPLEXITY_BASE_URL = os.getenv("PERPLEXITY_BASE_URL", "https://api.perplexity.ai")
+
+# Max in-flight requests per provider (per worker process)
+PROVIDER_CONCURRENCY = {
+    "anthropic": int(os.getenv("ANTHROPIC_MAX_CONCURRENCY", "8")),
+    "perplexity": int(os.getenv("PERPLEXITY_MAX_CONCURRENCY", "4")),
+}
+
+_anthropic_client: Optional[AsyncAnthropic] = None
+_perplexity_client: Optional[AsyncOpenAI] = None
+_semaphores: Dict[str, asyncio.Semaphore] = {}
+
+
+def get_anthropic_client() -> AsyncAnthropic:
+    """Lazily create the process-wide AsyncAnthropic client"""
+    global _anthropic_client
+    if _anthropic_client is None:
+        _anthropic_client = AsyncAnthropic(api_key=os.getenv("ANTHROPIC_API_KEY"))
+    return _anthropic_client
+
+
+def get_perplexity_client() -> AsyncOpenAI:
+    """Lazily create the process-wide AsyncOpenAI client pointed at Perplexity"""
+    global _perplexity_client
+    if _perplexity_client is None:
+        _perplexity_client = AsyncOpenAI(
+            api_key=os.getenv("PERPLEXITY_API_KEY"),
+            base_url=PERPLEXITY_BASE_URL
+        )
+    return _perplexity_client
+
+
+def _get_semaphore(provider: str) -> asyncio.Semaphore:
+    # Created on first use so the semaphore belongs to the running loop (Python 3.9
+    # binds asyncio primitives to the loop that exists at construction time)
+    semaphore = _semaphores.get(provider)
+    if semaphore is None:
+        semaphore = asyncio.Semaphore(PROVIDER_CONCURRENCY[provider])
+        _semaphores[provider] = semaphore
+    return semaphore
+
+
+async def anthropic_create(purpose: str = "other", **kwargs):
+    """Call the Anthropic messages API without blocking the event loop"""
+    estimated = count_message_tokens(kwargs.get("messages", []), kwargs.get("system"))
+    # Reserve room for the longest completion the call may return, not just the prompt
+    with reserve_budget(estimated + kwargs.get("max_tokens", 0)):
+        async with _get_semaphore("anthropic"):
+            started = time.perf_counter()
+            try:
+                response = await get_anthropic_client().messages.create(**kwargs)
+            except Exception:
+                record_usage("anthropic", purpose, estimated, None, 0, started, error=True)
+                raise
+        usage = getattr(response, "usage", None)
+        input_tokens = getattr(usage, "input_tokens", None)
+        output_tokens = getattr(usage, "output_tokens", 0) or 0
+        record_usage("anthropic", purpose, estimated, input_tokens, output_tokens, started)
+    annotate(input_tokens=input_tokens if input_tokens is not None else estimated, output_tokens=output_tokens)
+    return response
+
+
+async def perplexity_create(purpose: str = "other", **kwargs):
+    """Call the Perplexity chat-completions API without blocking the event loop"""
+    estimated = count_message_tokens(kwargs.get("messages", []))
+    with reserve_budget(estimated + kwargs.get("max_tokens", 0)):
+        async with _get_semaphore("perplexity"):
+            started = time.perf_counter()
+            try:
+                response = await get_perplexity_client().chat.completions.create(**kwargs)
+            except Exception:
+                record_usage("perplexity", purpose, estimated, None, 0, started, error=True)
+                raise
+        usage = getattr(response, "usage", None)
+        input_tokens = getattr(usage, "prompt_tokens", None)
+        output_tokens = getattr(usage, "completion_tokens", 0) or 0
+        record_usage("perplexity", purpose, estimated, input_tokens, output_tokens, started)
+    annotate(input_tokens=input_tokens if input_tokens is not None else estimated, output_tokens=output_tokens)
+    return response
@@ -0,0 +1,183 @@
+# services/log.py
+import atexit
+import contextvars
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import time
+import uuid
+from typing import Any, Dict, Optional
+
+"""
+Structured, non-blocking logging for the app modules.
+
+    log = get_logger(__name__)
+    log.info("Rates found", found=3, requested=8)
+    log.debug("Perplexity result", sample=0.05, payload=result)
+
+Records go on a bounded queue and a background thread writes them to stdout, so a request
+never waits on stdout; when the queue is full, records are dropped and counted instead.
+Fields are serialized and truncated to LOG_MAX_FIELD_CHARS by that thread too. Messages can
+be sampled per call (sample=) or per message (LOG_SAMPLE), and every record carries the id
+of the request or job that logged it.
+"""
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+# "json" (one object per line) or "text"
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")
+LOG_MAX_FIELD_CHARS = int(os.getenv("LOG_MAX_FIELD_CHARS", "1000"))
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+# Per-message sample rates, e.g. "Perplexity result=0.01,OCR result=0.1"
+LOG_SAMPLE = os.getenv("LOG_SAMPLE", "")
+
+SAMPLE_RATES: Dict[str, float] = {}
+for _entry in filter(None, (entry.strip() for entry in LOG_SAMPLE.split(","))):
+    _message, _, _rate = _entry.rpartition("=")
+    SAMPLE_RATES[_message.strip()] = float(_rate)
+
+LOG_STATS = {"logged": 0, "dropped": 0, "sampled_out": 0}
+
+_request_id: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("request_id", default=None)
+
+
+def new_request_id() -> str:
+    return uuid.uuid4().hex[:16]
+
+
+def set_request_id(request_id: Optional[str]):
+    """Tag everything logged from this context (and tasks it spawns) with request_id"""
+    return _request_id.set(request_id)
+
+
+def reset_request_id(token) -> None:
+    try:
+        _request_id.reset(token)
+    except ValueError:
+        pass
+
+
+def get_request_id() -> Optional[str]:
+    return _request_id.get()
+
+
+def _field(value: Any) -> Any:
+    if value is None or isinstance(value, (bool, int, float)):
+        return value
+    if isinstance(value, str):
+        text = value
+    else:
+        try:
+            text = json.dumps(value, default=str, ensure_ascii=False, separators=(",", ":"))
+        except Exception:
+            text = repr(value)
+        if len(text) <= LOG_MAX_FIELD_CHARS:
+            return value
+    if len(text) > LOG_MAX_FIELD_CHARS:
+        return f"{text[:LOG_MAX_FIELD_CHARS]}...(+{len(text) - LOG_MAX_FIELD_CHARS} chars)"
+    return text
+
+
+class StructuredFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        timestamp = time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(record.created)) + f".{int(record.msecs):03d}Z"
+        fields = {key: _field(value) for key, value in getattr(record, "fields", {}).items()}
+        request_id = getattr(record, "request_id", None)
+        if record.exc_info:
+            fields["exc"] = _field(self.formatException(record.exc_info))
+        if LOG_FORMAT == "text":
+            parts = [timestamp, f"{record.levelname:<7}", record.name]
+            if request_id:
+                parts.append(f"[{request_id}]")
+            parts.append(record.getMessage())
+            parts.extend(f"{key}={json.dumps(value, default=str, ensure_ascii=False)}" for key, value in fields.items())
+            return " ".join(parts)
+        event = {"ts": timestamp, "level": record.levelname, "logger": record.name, "msg": record.getMessage()}
+        if request_id:
+            event["request_id"] = request_id
+        for key, value in fields.items():
+            # Fields never overwrite the record's own keys
+            event[key if key not in event else f"field_{key}"] = value
+        return json.dumps(event, default=str, ensure_ascii=False)
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Formatting (serializing and truncating fields) happens in the writer thread
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+            LOG_STATS["logged"] += 1
+        except queue.Full:
+            LOG_STATS["dropped"] += 1
+
+
+_root = logging.getLogger("app")
+_listener: Optional[logging.handlers.QueueListener] = None
+
+
+def _configure() -> None:
+    global _listener
+    if _listener is not None:
+        return
+    log_queue: queue.Queue = queue.Queue(LOG_QUEUE_SIZE)
+    writer = logging.StreamHandler(sys.stdout)
+    writer.setFormatter(StructuredFormatter())
+    _listener = logging.handlers.QueueListener(log_queue, writer)
+    _listener.start()
+    _root.addHandler(_QueueHandler(log_queue))
+    _root.setLevel(LOG_LEVEL)
+    _root.propagate = False
+    atexit.register(shutdown_logging)
+
+
+def shutdown_logging() -> None:
+    """Write out whatever is still queued"""
+    global _listener
+    if _listener is not None:
+        try:
+            _listener.stop()
+        except queue.Full:
+            pass
+        _listener = None
+
+
+class StructuredLogger:
+    def __init__(self, name: str):
+        # Modules run as scripts (python -m app.services.rate_warmup) are named __main__
+        self._logger = logging.getLogger(name if name == "app" or name.startswith("app.") else f"app.{name}")
+
+    def _log(self, level: int, msg: str, sample: Optional[float], fields: Dict[str, Any], exc_info=None) -> None:
+        if not self._logger.isEnabledFor(level):
+            return
+        rate = sample if sample is not None else SAMPLE_RATES.get(msg)
+        if rate is not None and random.random() >= rate:
+            LOG_STATS["sampled_out"] += 1
+            return
+        self._logger.log(level, msg, exc_info=exc_info, extra={"fields": fields, "request_id": _request_id.get()})
+
+    def debug(self, msg: str, sample: Optional[float] = None, **fields) -> None:
+        self._log(logging.DEBUG, msg, sample, fields)
+
+    def info(self, msg: str, sample: Optional[float] = None, **fields) -> None:
+        self._log(logging.INFO, msg, sample, fields)
+
+    def warning(self, msg: str, sample: Optional[float] = None, **fields) -> None:
+        self._log(logging.WARNING, msg, sample, fields)
+
+    def error(self, msg: str, sample: Optional[float] = None, exc_info=None, **fields) -> None:
+        self._log(logging.ERROR, msg, sample, fields, exc_info)
+
+
+def get_logger(name: str) -> StructuredLogger:
+    _configure()
+    return StructuredLogger(name)
+
+
+def get_log_stats() -> Dict[str, Any]:
+    return {**LOG_STATS, "queued": _listener.queue.qsize() if _listener else 0, "level": LOG_LEVEL}
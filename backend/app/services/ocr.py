@@ -1,81 +1,31 @@
 # ocr.py
 import base64
-from anthropic import Client
+import hashlib
 import os
 from dotenv import load_dotenv
 import json
-import io
 #from PyPDF2 import PdfReader
 import asyncio
 import re
-import time
 from functools import lru_cache
-from PIL import Image
-import cv2
-import numpy as np
-from io import BytesIO
-from pdf2image import convert_from_bytes
+from app.services.llm_clients import anthropic_create
+from app.services.tokens import TokenBudgetExceeded
+from app.services.ocr_cache import ocr_cache, make_cache_key
+from app.services.preprocess import run_preprocess, OCR_PREPROCESS_PRESET
+from app.services.pdf import open_pdf
+from app.services.text_layer import parse_text_layer, FAST_PATH_STATS
+from app.services.tracing import span
+from app.services.log import get_logger
 
 
 
 load_dotenv()
-client = Client(api_key=os.getenv('ANTHROPIC_API_KEY'))
 
-async def extract_text_from_document(file_content: bytes, file_type: str, max_retries=3) -> dict:
-    """
-    Extract text from PDF or image files using Claude's vision capabilities.
-    Returns structured data from the medical bill.
-    """
-    start_time = time.time()
-    
-    if file_type == "application/pdf":
-        try:
-            # Convert PDF to image
-            images = convert_from_bytes(file_content)
-            if not images:
-                raise Exception("Could not convert PDF to image")
-                
-            # Just use the first page
-            first_page = images[0]
-            
-            # Convert to PNG bytes
-            img_byte_arr = io.BytesIO()
-            first_page.save(img_byte_arr, format='PNG')
-            file_content = img_byte_arr.getvalue()
-            
-            # Set correct media type for Claude
-            media_type = "image/png"
-        except Exception as e:
-            print(f"PDF conversion error: {str(e)}")
-            raise
-    elif file_type.startswith('image/'):
-        file_content = await preprocess_image(file_content)
-        file_type = 'image/png'  # Use PNG for processed images
-            
-        
-    
-    for attempt in range(max_retries):
-        try:
-            encoded_content = base64.b64encode(file_content).decode('utf-8')
-            response = client.messages.create(
-                model="claude-3-haiku-20240307",
-                # model="claude-3-5-sonnet-20240620",
-                max_tokens=2000,
-                system="You're a text analyser that outputs only json array objects...",
-                messages=[{
-                    "role": "user",
-                    "content": [
-                        {
-                            "type": "image",
-                            "source": {
-                                "type": "base64",
-                                "media_type": media_type,
-                                "data": encoded_content
-                            }
-                        },
-                        {
-                            "type": "text",
-                            "text": """Extract medical bill text into this JSON structure:
+log = get_logger(__name__)
+
+OCR_MODEL = "claude-3-haiku-20240307"
+OCR_SYSTEM_PROMPT = "You're a text analyser that outputs only json array objects..."
+OCR_PROMPT = """Extract medical bill text into this JSON structure:
                             {
                                 "billing_details": {
                                     "procedure_codes": [
@@ -122,10 +72,205 @@ async def extract_text_from_document(file_content: bytes, file_type: str, max_re
                                
                                7. For each procedure, set is_subtotal=true if it's a category total or header
                             """
-                        }
-                    ]
-                }]
-            )
+
+# Cached OCR results are only reused while the model, prompts and preprocessing are unchanged
+OCR_CACHE_VERSION = hashlib.sha256(
+    (OCR_MODEL + OCR_SYSTEM_PROMPT + OCR_PROMPT + OCR_PREPROCESS_PRESET).encode("utf-8")
+).hexdigest()[:16]
+
+# Max pages/images sent to the vision model at the same time (per worker)
+OCR_MAX_CONCURRENCY = int(os.getenv("OCR_MAX_CONCURRENCY", "6"))
+_ocr_semaphore = None
+
+def _get_ocr_semaphore() -> asyncio.Semaphore:
+    # Created lazily so it binds to the running event loop
+    global _ocr_semaphore
+    if _ocr_semaphore is None:
+        _ocr_semaphore = asyncio.Semaphore(OCR_MAX_CONCURRENCY)
+    return _ocr_semaphore
+
+async def extract_text_from_document(file_content: bytes, file_type: str, max_retries=3) -> dict:
+    """
+    Extract text from PDF or image files using Claude's vision capabilities.
+    Every page of a PDF is OCR'd concurrently and the pages are merged into one result.
+    Returns structured data from the medical bill.
+    """
+    # Identical uploads skip preprocessing and the vision call entirely
+    cache_key = None
+    if ocr_cache is not None:
+        with span("ocr_cache_lookup", bytes=len(file_content)) as lookup:
+            cache_key = make_cache_key(file_content, file_type, OCR_CACHE_VERSION)
+            cached = await ocr_cache.get(cache_key)
+            lookup.set(cache_hit=cached is not None)
+        if cached is not None:
+            return cached
+    
+    if file_type == "application/pdf":
+        page_results = await _extract_pdf_pages(file_content, max_retries)
+        if not page_results:
+            raise Exception("Could not convert PDF to image")
+        result = merge_ocr_results(page_results)
+    elif file_type.startswith('image/'):
+        result = await _extract_page_limited(file_content, file_type, max_retries, preprocess=True)
+    else:
+        raise ValueError(f"Unsupported file type: {file_type}")
+    
+    if cache_key is not None and result.get("success"):
+        with span("ocr_cache_write"):
+            await ocr_cache.set(cache_key, result)
+    return result
+
+async def _extract_pdf_pages(file_content: bytes, max_retries: int) -> list:
+    """
+    OCR a PDF page by page. Pages with a usable text layer are parsed locally; the rest are
+    rasterized and start vision OCR as soon as they are rendered. Rendering pauses while
+    OCR_MAX_CONCURRENCY pages are already waiting, so memory stays bounded by the
+    concurrency limit rather than the page count.
+    """
+    page_slots = asyncio.Semaphore(OCR_MAX_CONCURRENCY)
+    pages = []  # parsed results or OCR tasks, in page order
+    
+    async def ocr_page(page: bytes) -> dict:
+        try:
+            return await _extract_page_limited(page, "image/png", max_retries)
+        finally:
+            page_slots.release()
+    
+    try:
+        async with open_pdf(file_content) as pdf:
+            for page_number in pdf.page_numbers:
+                parsed = parse_text_layer(await pdf.page_text(page_number))
+                if parsed is not None:
+                    FAST_PATH_STATS["pages_text_layer"] += 1
+                    pages.append({
+                        "success": True,
+                        "extracted_text": parsed,
+                        "file_type": "application/pdf",
+                        "source": "text_layer"
+                    })
+                    continue
+                
+                FAST_PATH_STATS["pages_vision"] += 1
+                await page_slots.acquire()
+                try:
+                    with span("pdf_rasterize", page=page_number) as rasterize:
+                        page = await pdf.render_page(page_number)
+                        rasterize.set(bytes=len(page))
+                except BaseException:
+                    page_slots.release()
+                    raise
+                pages.append(asyncio.create_task(ocr_page(page)))
+    except Exception as e:
+        log.error("PDF conversion error", error=str(e))
+        for page in pages:
+            if isinstance(page, asyncio.Task):
+                page.cancel()
+        raise
+    
+    return [await page if isinstance(page, asyncio.Task) else page for page in pages]
+
+async def _extract_page_limited(file_content: bytes, media_type: str, max_retries: int, preprocess: bool = False) -> dict:
+    """OCR a single page/image under the shared OCR concurrency limit"""
+    async with _get_ocr_semaphore():
+        if preprocess:
+            with span("preprocess", bytes=len(file_content)):
+                file_content = await preprocess_image(file_content)
+            media_type = 'image/png'  # Use PNG for processed images
+        return await _extract_from_image(file_content, media_type, max_retries)
+
+def merge_ocr_results(results: list) -> dict:
+    """
+    Merge per-page/per-file OCR results into a single billing_details.
+    A line item repeated on several pages (continuation headers, overlapping scans) is kept
+    once, while genuine repeats on the same page are preserved.
+    """
+    successful = [r for r in results if r.get("success")]
+    if not successful:
+        return {
+            "success": False,
+            "error": "Failed to extract text from any page",
+            "file_type": results[0].get("file_type") if results else None,
+            # Another attempt only helps if some page failed on a transient API error
+            "retryable": any(r.get("retryable", True) for r in results)
+        }
+    
+    merged_items = []
+    kept_counts = {}
+    for result in successful:
+        page_counts = {}
+        procedures = result["extracted_text"].get("billing_details", {}).get("procedure_codes", [])
+        for procedure in procedures:
+            key = _line_item_key(procedure)
+            page_counts[key] = page_counts.get(key, 0) + 1
+            # Keep as many copies as the page that lists the item most often
+            if page_counts[key] > kept_counts.get(key, 0):
+                kept_counts[key] = page_counts[key]
+                merged_items.append(procedure)
+    
+    total_cost = sum(
+        _to_number(item.get("cost")) for item in merged_items if not item.get("is_subtotal")
+    )
+    return {
+        "success": True,
+        "extracted_text": {
+            "billing_details": {
+                "procedure_codes": merged_items,
+                "total_cost": round(total_cost, 2)
+            }
+        },
+        "file_type": successful[0].get("file_type"),
+        "pages": len(results)
+    }
+
+def _line_item_key(procedure: dict) -> tuple:
+    return (
+        str(procedure.get("code", "")).strip().upper(),
+        " ".join(str(procedure.get("description", "")).lower().split()),
+        _to_number(procedure.get("quantity")),
+        round(_to_number(procedure.get("cost")), 2)
+    )
+
+def _to_number(value) -> float:
+    if isinstance(value, (int, float)):
+        return float(value)
+    try:
+        return float(str(value).replace("$", "").replace(",", "").strip())
+    except ValueError:
+        return 0.0
+
+async def _extract_from_image(file_content: bytes, media_type: str, max_retries: int) -> dict:
+    """Send one image to Claude and parse the billing JSON, retrying on bad output"""
+    # Whether the last attempt failed calling the API (worth retrying later) rather than on its output
+    api_error = False
+    for attempt in range(max_retries):
+        api_error = False
+        try:
+            encoded_content = base64.b64encode(file_content).decode('utf-8')
+            with span("vision_ocr", attempt=attempt + 1, bytes=len(file_content)):
+                response = await anthropic_create(
+                    purpose="ocr",
+                    model=OCR_MODEL,
+                    # model="claude-3-5-sonnet-20240620",
+                    max_tokens=2000,
+                    system=OCR_SYSTEM_PROMPT,
+                    messages=[{
+                        "role": "user",
+                        "content": [
+                            {
+                                "type": "image",
+                                "source": {
+                                    "type": "base64",
+                                    "media_type": media_type,
+                                    "data": encoded_content
+                                }
+                            },
+                            {
+                                "type": "text",
+                                "text": OCR_PROMPT
+                            }
+                        ]
+                    }]
+                )
             
             extracted_text = response.content[0].text
             
@@ -139,27 +284,33 @@ async def extract_text_from_document(file_content: bytes, file_type: str, max_re
                 
                 # Check if we got valid procedure codes
                 if parsed_json.get("billing_details", {}).get("procedure_codes", []):
-                    end_time = time.time()
-                    print(f"OCR Time taken: {end_time - start_time} seconds")
                     return {
                         "success": True,
                         "extracted_text": parsed_json,
                         "file_type": media_type
                     }
                 else:
-                    print(f"Attempt {attempt + 1}: No procedure codes found, retrying...")
+                    log.warning("No procedure codes found, retrying", attempt=attempt + 1)
                     if attempt < max_retries - 1:
                         await asyncio.sleep(2 ** attempt)  # Exponential backoff
                         continue
                         
             except json.JSONDecodeError as e:
-                print(f"Attempt {attempt + 1}: JSON Parse Error: {e}")
+                log.warning("OCR output was not valid JSON", attempt=attempt + 1, error=str(e))
                 if attempt < max_retries - 1:
                     await asyncio.sleep(2 ** attempt)
                     continue
                     
+        except TokenBudgetExceeded as e:
+            return {
+                "success": False,
+                "error": str(e),
+                "file_type": media_type,
+                "retryable": False
+            }
         except Exception as e:
-            print(f"Attempt {attempt + 1}: API Error: {e}")
+            api_error = True
+            log.warning("OCR API error", attempt=attempt + 1, error=str(e))
             if attempt < max_retries - 1:
                 await asyncio.sleep(2 ** attempt)
                 continue
@@ -168,36 +319,10 @@ async def extract_text_from_document(file_content: bytes, file_type: str, max_re
     return {
         "success": False,
         "error": "Failed to extract text after multiple attempts",
-        "file_type": media_type
+        "file_type": media_type,
+        "retryable": api_error
     }
 
 async def preprocess_image(file_content: bytes) -> bytes:
-    """Preprocess image for better OCR performance"""
-    # Convert bytes to PIL Image
-    image = Image.open(BytesIO(file_content))
-    
-    # Convert to numpy array for OpenCV processing
-    img = cv2.cvtColor(np.array(image), cv2.COLOR_RGB2BGR)
-    
-    # 1. Resize if image is too large (reduces tokens)
-    max_dimension = 2000
-    height, width = img.shape[:2]
-    if max(height, width) > max_dimension:
-        scale = max_dimension / max(height, width)
-        img = cv2.resize(img, None, fx=scale, fy=scale)
-    
-    # 2. Convert to grayscale
-    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-    
-    # 3. Apply thresholding to get black and white image
-    _, thresh = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
-    
-    # 4. Denoise
-    denoised = cv2.fastNlMeansDenoising(thresh)
-    
-    # 5. Increase contrast
-    contrast = cv2.convertScaleAbs(denoised, alpha=1.5, beta=0)
-    
-    # Convert back to bytes
-    is_success, buffer = cv2.imencode(".png", contrast)
-    return buffer.tobytes() 
\ No newline at end of file
+    """Preprocess image for better OCR performance (runs in the preprocessing pool)"""
+    return await run_preprocess(file_content)
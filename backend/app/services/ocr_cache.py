@@ -0,0 +1,182 @@
+# services/ocr_cache.py
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Dict, Optional
+from dotenv import load_dotenv
+from app.services.cache import MemoryLRU
+from app.services.log import get_logger
+
+"""
+Content-addressed cache for OCR results.
+
+Keys are a hash of the raw upload bytes, the file type and the OCR version (model +
+prompt), so a re-uploaded bill skips preprocessing and the vision call entirely.
+Two tiers: an in-process LRU and a persistent tier (Redis when REDIS_URL is set,
+otherwise a local SQLite file), both with TTL and size-based eviction.
+"""
+
+load_dotenv()
+
+log = get_logger(__name__)
+
+BASE_DIR = Path(__file__).resolve().parent.parent.parent
+
+OCR_CACHE_ENABLED = os.getenv("OCR_CACHE_ENABLED", "1") == "1"
+OCR_CACHE_TTL_SECONDS = int(os.getenv("OCR_CACHE_TTL_SECONDS", str(7 * 24 * 3600)))
+OCR_CACHE_MEMORY_ENTRIES = int(os.getenv("OCR_CACHE_MEMORY_ENTRIES", "256"))
+OCR_CACHE_MAX_ENTRIES = int(os.getenv("OCR_CACHE_MAX_ENTRIES", "10000"))
+OCR_CACHE_PATH = os.getenv("OCR_CACHE_PATH", str(BASE_DIR / "ocr_cache.sqlite3"))
+REDIS_URL = os.getenv("REDIS_URL")
+
+
+def make_cache_key(file_content: bytes, file_type: str, version: str) -> str:
+    """Hash of the upload bytes plus everything that changes the OCR output"""
+    digest = hashlib.sha256()
+    digest.update(version.encode("utf-8"))
+    digest.update(b"\0")
+    digest.update(file_type.encode("utf-8"))
+    digest.update(b"\0")
+    digest.update(file_content)
+    return digest.hexdigest()
+
+
+class SQLiteStore:
+    """Persistent tier backed by a local SQLite file. Blocking; call via asyncio.to_thread"""
+
+    def __init__(self, path: str, max_entries: int, ttl_seconds: int):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS ocr_cache ("
+            " key TEXT PRIMARY KEY, value TEXT NOT NULL,"
+            " created_at REAL NOT NULL, last_access REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS ocr_cache_last_access ON ocr_cache(last_access)")
+        self._conn.commit()
+
+    def get(self, key: str) -> Optional[str]:
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value, created_at FROM ocr_cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            if row[1] + self.ttl_seconds < now:
+                self._conn.execute("DELETE FROM ocr_cache WHERE key = ?", (key,))
+                self._conn.commit()
+                return None
+            self._conn.execute("UPDATE ocr_cache SET last_access = ? WHERE key = ?", (now, key))
+            self._conn.commit()
+            return row[0]
+
+    def set(self, key: str, value: str) -> None:
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO ocr_cache (key, value, created_at, last_access) VALUES (?, ?, ?, ?)",
+                (key, value, now, now)
+            )
+            # Drop expired rows, then the least recently used rows beyond the size limit
+            self._conn.execute("DELETE FROM ocr_cache WHERE created_at < ?", (now - self.ttl_seconds,))
+            self._conn.execute(
+                "DELETE FROM ocr_cache WHERE key IN ("
+                " SELECT key FROM ocr_cache ORDER BY last_access DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,)
+            )
+            self._conn.commit()
+
+
+class RedisStore:
+    """Persistent tier backed by Redis. TTL is enforced by Redis; size by its maxmemory policy"""
+
+    def __init__(self, url: str, ttl_seconds: int):
+        import redis.asyncio as redis_asyncio
+        self.ttl_seconds = ttl_seconds
+        self._redis = redis_asyncio.from_url(url)
+
+    async def get(self, key: str) -> Optional[str]:
+        value = await self._redis.get(f"ocr:{key}")
+        return value.decode("utf-8") if value is not None else None
+
+    async def set(self, key: str, value: str) -> None:
+        await self._redis.set(f"ocr:{key}", value, ex=self.ttl_seconds)
+
+
+class OCRCache:
+    def __init__(self):
+        self.memory = MemoryLRU(OCR_CACHE_MEMORY_ENTRIES, OCR_CACHE_TTL_SECONDS)
+        self.stats = {"memory_hits": 0, "persistent_hits": 0, "misses": 0, "stores": 0, "errors": 0}
+        self.store = None
+        try:
+            if REDIS_URL:
+                self.store = RedisStore(REDIS_URL, OCR_CACHE_TTL_SECONDS)
+            else:
+                self.store = SQLiteStore(OCR_CACHE_PATH, OCR_CACHE_MAX_ENTRIES, OCR_CACHE_TTL_SECONDS)
+        except Exception as e:
+            log.warning("OCR cache persistent tier disabled", error=str(e))
+
+    async def _store_get(self, key: str) -> Optional[str]:
+        if isinstance(self.store, SQLiteStore):
+            return await asyncio.to_thread(self.store.get, key)
+        return await self.store.get(key)
+
+    async def _store_set(self, key: str, value: str) -> None:
+        if isinstance(self.store, SQLiteStore):
+            await asyncio.to_thread(self.store.set, key, value)
+        else:
+            await self.store.set(key, value)
+
+    async def get(self, key: str) -> Optional[Dict]:
+        """Return a cached OCR result, checking memory then the persistent tier"""
+        value = self.memory.get(key)
+        if value is not None:
+            self.stats["memory_hits"] += 1
+            return value
+
+        if self.store is not None:
+            try:
+                raw = await self._store_get(key)
+                if raw is not None:
+                    value = json.loads(raw)
+                    self.memory.set(key, value)
+                    self.stats["persistent_hits"] += 1
+                    return value
+            except Exception as e:
+                self.stats["errors"] += 1
+                log.error("OCR cache retrieval error", error=str(e))
+
+        self.stats["misses"] += 1
+        return None
+
+    async def set(self, key: str, value: Dict) -> None:
+        """Store a successful OCR result in both tiers"""
+        self.memory.set(key, value)
+        self.stats["stores"] += 1
+        if self.store is not None:
+            try:
+                await self._store_set(key, json.dumps(value))
+            except Exception as e:
+                self.stats["errors"] += 1
+                log.error("OCR cache storage error", error=str(e))
+
+    def get_stats(self) -> Dict:
+        lookups = self.stats["memory_hits"] + self.stats["persistent_hits"] + self.stats["misses"]
+        hits = lookups - self.stats["misses"]
+        return {
+            **self.stats,
+            "memory_entries": len(self.memory),
+            "hit_ratio": hits / lookups if lookups else 0.0,
+            "persistent_tier": type(self.store).__name__ if self.store else None,
+        }
+
+
+ocr_cache = OCRCache() if OCR_CACHE_ENABLED else None
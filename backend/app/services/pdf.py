@@ -0,0 +1,142 @@
+# services/pdf.py
+import asyncio
+import os
+import shutil
+import tempfile
+from pathlib import Path
+from typing import AsyncIterator, List, Optional, Tuple
+from pdf2image import convert_from_path, pdfinfo_from_path
+from app.services.log import get_logger
+
+"""
+Page-at-a-time PDF access.
+
+The PDF is written to a temporary file once. Each page is rendered by poppler straight to a
+PNG file, so only the page currently being handed to OCR is held in memory, and the
+embedded text layer (if any) can be read with pdftotext without rendering at all.
+"""
+
+log = get_logger(__name__)
+
+PDF_DPI = int(os.getenv("PDF_DPI", "200"))
+PDF_MAX_PAGES = int(os.getenv("PDF_MAX_PAGES", "50"))
+PDF_GRAYSCALE = os.getenv("PDF_GRAYSCALE", "0") == "1"
+
+
+def _page_count(pdf_path: str) -> int:
+    return int(pdfinfo_from_path(pdf_path)["Pages"])
+
+
+def _render_page(pdf_path: str, page_number: int, output_dir: str, dpi: int, grayscale: bool) -> bytes:
+    """Render one page to a PNG file and return its bytes, deleting the file afterwards"""
+    paths = convert_from_path(
+        pdf_path,
+        dpi=dpi,
+        first_page=page_number,
+        last_page=page_number,
+        fmt="png",
+        grayscale=grayscale,
+        output_folder=output_dir,
+        paths_only=True
+    )
+    if not paths:
+        raise Exception(f"Could not convert PDF page {page_number} to image")
+    page_path = Path(paths[0])
+    try:
+        return page_path.read_bytes()
+    finally:
+        page_path.unlink(missing_ok=True)
+
+
+class PdfDocument:
+    """A PDF spilled to a temp directory; use via `async with open_pdf(...)`"""
+
+    def __init__(self, file_content: bytes, dpi: int, max_pages: int, grayscale: bool):
+        self.file_content = file_content
+        self.dpi = dpi
+        self.max_pages = max_pages
+        self.grayscale = grayscale
+        self.work_dir = None
+        self.pdf_path = None
+        self.page_count = 0
+        self._page_texts: Optional[List[str]] = None
+
+    async def __aenter__(self) -> "PdfDocument":
+        self.work_dir = tempfile.mkdtemp(prefix="advocare-pdf-")
+        self.pdf_path = os.path.join(self.work_dir, "document.pdf")
+        try:
+            await asyncio.to_thread(Path(self.pdf_path).write_bytes, self.file_content)
+            total_pages = await asyncio.to_thread(_page_count, self.pdf_path)
+        except BaseException:
+            shutil.rmtree(self.work_dir, ignore_errors=True)
+            raise
+        if total_pages > self.max_pages:
+            log.warning("PDF page limit reached", pages=total_pages, processed=self.max_pages)
+        self.page_count = min(total_pages, self.max_pages)
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb) -> None:
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    @property
+    def page_numbers(self) -> range:
+        return range(1, self.page_count + 1)
+
+    async def render_page(self, page_number: int) -> bytes:
+        """Render one page to PNG bytes in a worker thread"""
+        return await asyncio.to_thread(
+            _render_page, self.pdf_path, page_number, self.work_dir, self.dpi, self.grayscale
+        )
+
+    async def page_text(self, page_number: int) -> str:
+        """Embedded text layer of a page ("" for scanned pages or if pdftotext is unavailable)"""
+        if self._page_texts is None:
+            self._page_texts = await self._extract_text_layer()
+        if page_number - 1 < len(self._page_texts):
+            return self._page_texts[page_number - 1]
+        return ""
+
+    async def _extract_text_layer(self) -> List[str]:
+        # One pdftotext run for the whole document; pages are separated by form feeds
+        try:
+            process = await asyncio.create_subprocess_exec(
+                "pdftotext", "-layout", "-l", str(self.page_count), self.pdf_path, "-",
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.DEVNULL
+            )
+            stdout, _ = await process.communicate()
+        except FileNotFoundError:
+            log.warning("pdftotext not found, skipping PDF text layer")
+            return []
+        if process.returncode != 0:
+            return []
+        return stdout.decode("utf-8", errors="replace").split("\f")
+
+
+def open_pdf(
+    file_content: bytes,
+    dpi: Optional[int] = None,
+    max_pages: Optional[int] = None,
+    grayscale: Optional[bool] = None
+) -> PdfDocument:
+    return PdfDocument(
+        file_content,
+        dpi=dpi or PDF_DPI,
+        max_pages=max_pages or PDF_MAX_PAGES,
+        grayscale=PDF_GRAYSCALE if grayscale is None else grayscale
+    )
+
+
+async def rasterize_pdf_pages(
+    file_content: bytes,
+    dpi: Optional[int] = None,
+    max_pages: Optional[int] = None,
+    grayscale: Optional[bool] = None
+) -> AsyncIterator[Tuple[int, bytes]]:
+    """
+    Yield (page_number, png_bytes) one page at a time. Rendering runs in a thread and the
+    next page is only rendered when the consumer asks for it.
+    """
+    async with open_pdf(file_content, dpi, max_pages, grayscale) as pdf:
+        for page_number in pdf.page_numbers:
+            yield page_number, await pdf.render_page(page_number)
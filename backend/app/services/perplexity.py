@@ -1,24 +1,41 @@
-from openai import OpenAI
 import os
 from dotenv import load_dotenv
 import time
 import json
 import asyncio
+import contextvars
 import re
-import tiktoken
+from typing import Optional
 from app.services.cache import CacheService
+from app.services.code_index import extract_code
+from app.services.regions import Region, normalize_region
+from app.services.llm_clients import perplexity_create
+from app.services.tokens import TokenBudgetExceeded, check_budget, count_message_tokens, current_budget, start_request_budget
+from app.services.prompts import build_rate_search_messages
+from app.services.tracing import span
+from app.services.log import get_logger
 
 load_dotenv()
 
+log = get_logger(__name__)
+
 api_key = os.getenv("PERPLEXITY_API_KEY")
 
+# Uncached codes are searched in chunks of this size, concurrently
+UCR_CHUNK_SIZE = int(os.getenv("UCR_CHUNK_SIZE", "8"))
+# Completion cap for one rate search chunk; also what the token budget reserves for its output
+UCR_MAX_TOKENS = int(os.getenv("UCR_MAX_TOKENS", "2000"))
+# Collect misses from concurrent requests for this long and search them together (0 = off)
+UCR_BATCH_WINDOW_MS = int(os.getenv("UCR_BATCH_WINDOW_MS", "0"))
+# A stale rate is revalidated at most once per this many seconds, even if the refresh fails
+RATE_REVALIDATE_COOLDOWN_SECONDS = int(os.getenv("RATE_REVALIDATE_COOLDOWN_SECONDS", "300"))
+
 """
 This module provides the search_ucr_rates function through a PerplexityService instance (at the bottom of the file).
 The service handles caching and rate lookups for medical procedures.
 """
 
-# Initialize the OpenAI client with Perplexity's base URL
-client = OpenAI(api_key=api_key, base_url="https://api.perplexity.ai")
+# Perplexity is called through the shared AsyncOpenAI client in llm_clients.py
 
 # # remember to add location into input text. Functional search function
 # async def search_ucr_rates(input_text, max_retries=3):
@@ -140,206 +157,324 @@ client = OpenAI(api_key=api_key, base_url="https://api.perplexity.ai")
 #         }
 #     })
 
-def count_tokens(messages):
-    encoding = tiktoken.get_encoding("cl100k_base")
-    num_tokens = 0
-    
-    for message in messages:
-        # Add tokens for message role and content
-        num_tokens += 4  # Every message follows <im_start>{role/name}\n{content}<im_end>\n
-        for key, value in message.items():
-            num_tokens += len(encoding.encode(str(value)))
-    
-    return num_tokens
-
 class PerplexityService:
     def __init__(self):
         # Initialize cache service when PerplexityService is created
         self.cache_service = CacheService()
+        # (code, location) -> future with the rate (or None) from a search in progress
+        self._inflight: dict[tuple[str, str], asyncio.Future] = {}
+        # region -> misses waiting for the micro-batch window to close
+        self._batches: dict[Region, list[dict]] = {}
+        self._tasks: set[asyncio.Task] = set()
+        # (code, location) -> when a background revalidation of its stale rate last started
+        self._revalidated_at: dict[tuple[str, str], float] = {}
+        self.stats = {"lookups": 0, "coalesced": 0, "upstream_batches": 0, "revalidations": 0}
 
-    def extract_codes(self, input_text: str) -> list[str]:
-        """Extract CPT/HCPCS codes from Claude's output"""
+    def extract_procedures(self, bill) -> list[dict]:
+        """
+        Line items with a code from a bill dict ({"billing_details": ...}), its JSON string,
+        or a list of OCR results. One entry per code, with the code normalized.
+        """
         try:
-            input_text = json.loads(input_text)
-            codes = []
-            
-            # Navigate through Claude's response structure
-            for result in input_text:
-                if result.get('success'):
-                    procedure_codes = result.get('extracted_text', {}).get('billing_details', {}).get('procedure_codes', [])
-                    
-                    for procedure in procedure_codes:
-                        if code := procedure.get('code'):
-                            # Only add if it looks like a valid CPT/HCPCS code
-                            if (len(code) == 5 and code.isdigit()) or \
-                               (len(code) == 5 and code[0].isalpha() and code[1:].isdigit()):
-                                codes.append(code)
-            
-            print(f"Extracted codes: {codes}")
-            return codes
-            
+            if isinstance(bill, str):
+                bill = json.loads(bill)
+            results = bill if isinstance(bill, list) else [{"success": True, "extracted_text": bill}]
+
+            procedures = {}
+            for result in results:
+                if not result.get('success'):
+                    continue
+                billing_details = result.get('extracted_text', {}).get('billing_details', {})
+                for procedure in billing_details.get('procedure_codes', []):
+                    raw_code = str(procedure.get('code') or '').strip()
+                    if not raw_code or procedure.get('is_subtotal'):
+                        continue
+                    code = extract_code(raw_code) or raw_code
+                    procedures.setdefault(code, {**procedure, "code": code})
+
+            return list(procedures.values())
+
         except Exception as e:
-            print(f"Error extracting codes: {str(e)}")
+            log.error("Error extracting codes", error=str(e))
             return []
 
-    async def search_ucr_rates(self, input_text, max_retries=3):
-        start_time = time.time()
-        location = "Los Angeles, CA"
-        
-        # 1. Try cache first, but continue if it fails
-        try:
-            codes = self.extract_codes(input_text)
-            if codes is None or len(codes) == 0:
-                print("No codes to check in cache, proceeding with API call")
-                cached_rates = {}
-                codes_to_search = []
-            else:
-                cached_rates = await self.cache_service.bulk_get_cached_rates(codes, location)
-                codes_to_search = [code for code in codes if code not in cached_rates]
-                
-                if cached_rates and not codes_to_search:
-                    print("All rates found in cache!")
-                    return json.dumps({
-                        "ucr_validation": {
-                            "procedure_analysis": list(cached_rates.values())
-                        }
-                    })
-        except Exception as e:
-            print(f"Cache error: {str(e)}, proceeding with API call")
-            cached_rates = {}  # Reset to empty if cache fails
-            codes_to_search = codes  # Search all codes if cache fails
-        
-        messages = [
-                {
-                    "role": "system",
-                    "content": "You are a medical rate analyzer. Output ONLY valid JSON, no explanations or text outside JSON structure."
-                },
-                {
-                    "role": "user",
-                    "content": f'''Analyze rates for: {input_text}
-
-                        Return ONLY this JSON structure:
-                        {{
-                            "ucr_validation": {{
-                                "procedure_analysis": [
-                                    {{
-                                        "code": "exact code from input",
-                                        "description": "exact description from input",
-                                        "billed_cost": number (2 decimal places),
-                                        "standardized_rate": number (2 decimal places),
-                                        "sources": ["source used"]
-                                    }}
-                                ]
-                            }}
-                        }}
-
-                        STRICT RULES:
-                        1. ONLY output valid JSON
-                        2. NO text outside JSON structure
-                        3. Search Standardized / Usual Customary & Reasonable (UCR) Rates in this order: Medicare RVU → NC Medicaid → BetterCare → FAIR Health → Regional etc
-                        4. Location: Los Angeles, CA
-                        5. Codes are either of type CPT (5 digits) or HCPCS (first character is a letter, followed by 4 digits)
-                        6. ALL costs must be numbers
-                        7. For each procedure in the input:
-                           - Include ALL sources used in the sources array
-                           - If standardized_rate is None, 0 or 0.0, do not include the code, description, billed_cost, standardized_rate or sources for that procedure
-                        8. The procedure_analysis array should ONLY contain procedures with valid averaged rates from multiple sources
-                        9. CRITICAL: Do not make up any data
-                        '''
-                    }
-                ]
-
-        
-        # 4. If some codes aren't cached, search them with Perplexity
+    def extract_codes(self, bill) -> list[str]:
+        """Extract CPT/HCPCS codes from Claude's output"""
+        codes = [procedure["code"] for procedure in self.extract_procedures(bill)]
+        log.debug("Extracted codes", codes=codes)
+        return codes
+
+    def _build_messages(self, procedures: list[dict], location: str) -> list[dict]:
+        # Only code, description, quantity and cost go into the prompt (see prompts.py)
+        return build_rate_search_messages(procedures, location)
+
+    def _parse_result(self, result: str) -> list[dict]:
+        """Pull the procedure_analysis entries with a usable rate out of a raw response"""
+        # Remove markdown code blocks if present
+        result = re.sub(r'```json\s*|\s*```', '', result)
+        result = re.sub(r'\n*Note:.*$', '', result, flags=re.DOTALL)
+        result = re.sub(r'//.*$', '', result, flags=re.MULTILINE)
+
+        # Extract just the JSON object
+        json_match = re.search(r'\{.*\}', result, re.DOTALL)
+        if json_match:
+            result = json_match.group()
+
+        # Clean up any trailing commas
+        result = re.sub(r',\s*([}\]])', r'\1', result)
+
+        # Validate it's proper JSON
+        parsed = json.loads(result)
+        return [
+            proc for proc in parsed.get("ucr_validation", {}).get("procedure_analysis", [])
+            if isinstance(proc.get("standardized_rate"), (int, float)) and proc["standardized_rate"] > 0
+        ]
+
+    async def _search_chunk(self, procedures: list[dict], region: Region, max_retries: int) -> Optional[list[dict]]:
+        """
+        Search rates for one chunk of uncached procedures.
+        Returns the rates found ([] if the search ran but found none), or None if every attempt failed.
+        """
+        messages = self._build_messages(procedures, region.label)
+        requested = {procedure["code"] for procedure in procedures}
+        searched = False
+
         for attempt in range(max_retries):
             try:
-                # Your existing messages and API call here
-                 # Calculate tokens before making the API call
-                token_count = count_tokens(messages)
-                print(f"Token count for this request: {token_count}")
-                response = client.chat.completions.create(
-                    model="llama-3.1-sonar-large-128k-online",
-                    temperature=0.0,
-                    messages=messages,
-                )
+                with span("rate_search", attempt=attempt + 1, codes=len(procedures)):
+                    response = await perplexity_create(
+                        purpose="rate_search",
+                        model="llama-3.1-sonar-large-128k-online",
+                        temperature=0.0,
+                        max_tokens=UCR_MAX_TOKENS,
+                        messages=messages,
+                    )
 
                 result = response.choices[0].message.content
-                print(f"Perplexity result: {result}")
-                
-                # Clean the response to get only JSON
-                try:
-                    # Remove markdown code blocks if present
-                    result = re.sub(r'```json\s*|\s*```', '', result)
-                    result = re.sub(r'\n*Note:.*$', '', result, flags=re.DOTALL)
-                    result = re.sub(r'//.*$', '', result, flags=re.MULTILINE)
-                    
-                    # Extract just the JSON object
-                    json_match = re.search(r'\{.*\}', result, re.DOTALL)
-                    if json_match:
-                        result = json_match.group()
-                    
-                    # Clean up any trailing commas
-                    result = re.sub(r',\s*([}\]])', r'\1', result)
-                    
-                    # Validate it's proper JSON
-                    parsed = json.loads(result)
-                    print(f"Parsed JSON: {parsed}")
-                    
-                    # Filter out procedures with invalid standardized_rates
-                    if "ucr_validation" in parsed and "procedure_analysis" in parsed["ucr_validation"]:
-                        valid_procedures = [
-                            proc for proc in parsed["ucr_validation"]["procedure_analysis"]
-                            if proc.get("standardized_rate") and proc["standardized_rate"] > 0
-                        ]
-                        
-                        # Try to cache, but continue if it fails
-                        try:
-                            for proc in valid_procedures:
-                                await self.cache_service.cache_rate(
-                                    proc["code"],
-                                    location,
-                                    proc
-                                )
-                        except Exception as e:
-                            print(f"Failed to cache results: {str(e)}")
-                        
-                        # Continue with the API results even if caching failed
-                        all_procedures = list(cached_rates.values()) + valid_procedures
-                        parsed["ucr_validation"]["procedure_analysis"] = all_procedures
-                    
-                    if parsed.get("ucr_validation", {}).get("procedure_analysis", []):
-                        end_time = time.time()
-                        print(f"Success! Found {len(all_procedures)} total procedures")
-                        return json.dumps(parsed)
-                    else:
-                        print(f"Attempt {attempt + 1}: No UCR rates found, retrying...")
-                        if attempt < max_retries - 1:
-                            await asyncio.sleep(2 ** attempt)
-                            continue
-                            
-                except json.JSONDecodeError:
-                    if attempt < max_retries - 1:
-                        await asyncio.sleep(2 ** attempt)
-                        continue
-                    
+                log.debug("Perplexity result", payload=result)
+
+                # Only keep codes that were asked for; normalize the echoed code first
+                found = {}
+                for proc in self._parse_result(result):
+                    code = extract_code(str(proc.get("code", ""))) or str(proc.get("code", "")).strip()
+                    if code in requested:
+                        found.setdefault(code, {**proc, "code": code})
+                searched = True
+
+                if found:
+                    log.info("Rate search found rates", found=len(found), requested=len(procedures), attempt=attempt + 1)
+                    return list(found.values())
+
+                log.warning("No UCR rates found, retrying", attempt=attempt + 1)
+
+            except TokenBudgetExceeded as e:
+                log.warning("Rate search skipped", error=str(e))
+                return None
+            except json.JSONDecodeError:
+                log.warning("Rate search response was not valid JSON", attempt=attempt + 1)
             except Exception as e:
-                print(f"Attempt {attempt + 1}: Error: {str(e)}")
-                if attempt < max_retries - 1:
-                    await asyncio.sleep(2 ** attempt)
-                    continue
-        
-        # If all retries failed but we have cached results, return those
-        if cached_rates:
-            return json.dumps({
-                "ucr_validation": {
-                    "procedure_analysis": list(cached_rates.values())
-                }
+                log.warning("Rate search error", attempt=attempt + 1, error=str(e))
+
+            if attempt < max_retries - 1:
+                await asyncio.sleep(2 ** attempt)
+
+        return [] if searched else None
+
+    async def _search_batch(self, procedures: list[dict], region: Region, max_retries: int) -> dict:
+        """Search rates in fixed-size chunks, concurrently, and record the outcome in the cache"""
+        self.stats["upstream_batches"] += 1
+        chunks = [procedures[i:i + UCR_CHUNK_SIZE] for i in range(0, len(procedures), UCR_CHUNK_SIZE)]
+        results = await asyncio.gather(
+            *(self._search_chunk(chunk, region, max_retries) for chunk in chunks)
+        )
+        searched_rates = {}
+        for chunk, found in zip(chunks, results):
+            if found is None:
+                continue  # the search itself failed; leave these uncached so they are retried
+            for proc in found:
+                searched_rates[proc["code"]] = proc
+            for procedure in chunk:
+                if procedure["code"] not in searched_rates:
+                    self.cache_service.remember_no_rate(procedure["code"], region.key)
+
+        # Try to cache, but continue if it fails
+        try:
+            if searched_rates:
+                with span("rate_cache_write", rates=len(searched_rates)):
+                    await self.cache_service.save_rates(region.key, list(searched_rates.values()))
+        except Exception as e:
+            log.error("Failed to cache results", error=str(e))
+        return searched_rates
+
+    async def _run_search(self, procedures: list[dict], region: Region, max_retries: int) -> None:
+        """
+        Search a set of claimed codes and resolve everyone waiting on them with
+        (rate or None, tokens spent per code), so each waiter can charge its own budget.
+        """
+        # Shared work has a budget of its own (no limit); waiters are charged their share
+        budget = start_request_budget(0)
+        searched_rates = {}
+        try:
+            searched_rates = await self._search_batch(procedures, region, max_retries)
+        except Exception as e:
+            log.error("Rate search error", error=str(e))
+        finally:
+            tokens_per_code = budget.spent / len(procedures) if procedures else 0
+            for procedure in procedures:
+                future = self._inflight.pop((procedure["code"], region.key), None)
+                if future is not None and not future.done():
+                    future.set_result((searched_rates.get(procedure["code"]), tokens_per_code))
+
+    def _spawn(self, coro) -> None:
+        # A task of its own, so a disconnecting client doesn't cancel work others wait on.
+        # It starts from an empty context: shared work must not run under (or fail on) the
+        # token budget, trace or request id of whichever request happened to start it.
+        task = contextvars.Context().run(asyncio.create_task, coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def _start_search(self, procedures: list[dict], region: Region, max_retries: int) -> None:
+        self._spawn(self._run_search(procedures, region, max_retries))
+
+    def _revalidate(self, procedures: list[dict], region: Region, max_retries: int) -> None:
+        """Refresh stale rates in the background; the caller has already served them"""
+        now = time.time()
+        if len(self._revalidated_at) > 10000:
+            self._revalidated_at = {
+                key: started for key, started in self._revalidated_at.items()
+                if now - started < RATE_REVALIDATE_COOLDOWN_SECONDS
+            }
+        due = []
+        for procedure in procedures:
+            key = (procedure["code"], region.key)
+            if key in self._inflight or now - self._revalidated_at.get(key, 0) < RATE_REVALIDATE_COOLDOWN_SECONDS:
+                continue
+            self._revalidated_at[key] = now
+            due.append(procedure)
+        if due:
+            self.stats["revalidations"] += len(due)
+            self._spawn(self._lookup_rates(due, region, max_retries))
+
+    def _flush_batch(self, region: Region, max_retries: int) -> None:
+        procedures = self._batches.pop(region, [])
+        if procedures:
+            self._start_search(procedures, region, max_retries)
+
+    async def _lookup_rates(self, procedures: list[dict], region: Region, max_retries: int) -> dict:
+        """
+        Rates for uncached procedures. Each (code, location) is searched at most once at a
+        time: codes another request is already searching are awaited rather than searched
+        again. With UCR_BATCH_WINDOW_MS set, new misses from concurrent requests are
+        collected for that long and searched together.
+        """
+        # Each caller's own budget decides whether it takes part; the search itself is shared
+        try:
+            chunks = -(-len(procedures) // UCR_CHUNK_SIZE)
+            check_budget(count_message_tokens(self._build_messages(procedures, region.label)) + chunks * UCR_MAX_TOKENS)
+        except TokenBudgetExceeded as e:
+            log.warning("Rate search skipped", error=str(e))
+            return {}
+
+        loop = asyncio.get_running_loop()
+        futures = {}
+        claimed = []
+        for procedure in procedures:
+            key = (procedure["code"], region.key)
+            self.stats["lookups"] += 1
+            if key in self._inflight:
+                self.stats["coalesced"] += 1
+            else:
+                self._inflight[key] = loop.create_future()
+                claimed.append(procedure)
+            futures[procedure["code"]] = self._inflight[key]
+
+        if claimed:
+            if UCR_BATCH_WINDOW_MS > 0:
+                batch = self._batches.setdefault(region, [])
+                if not batch:
+                    loop.call_later(
+                        UCR_BATCH_WINDOW_MS / 1000, self._flush_batch, region, max_retries,
+                        context=contextvars.Context()
+                    )
+                batch.extend(claimed)
+            else:
+                self._start_search(claimed, region, max_retries)
+
+        searched_rates = {}
+        tokens = 0.0
+        for code, future in futures.items():
+            # shield: this request going away must not cancel the shared future
+            rate, tokens_per_code = await asyncio.shield(future)
+            tokens += tokens_per_code
+            if rate is not None:
+                searched_rates[code] = rate
+        budget = current_budget()
+        if budget is not None and tokens:
+            budget.charge("rate_search", round(tokens))
+        return searched_rates
+
+    def get_stats(self) -> dict:
+        return {
+            **self.stats,
+            "in_flight": len(self._inflight),
+        }
+
+    async def search_ucr_rates(self, input_text, max_retries=3, location=None, use_cache=True):
+        start_time = time.time()
+        # Cache entries are shared by everything in the same rate region
+        region = location if isinstance(location, Region) else normalize_region(location)
+        location = region.key
+
+        procedures = self.extract_procedures(input_text)
+        codes = [procedure["code"] for procedure in procedures]
+        log.debug("Extracted codes", codes=codes)
+
+        # 1. Try cache first, but continue if it fails
+        cached_rates = {}
+        if codes and use_cache:
+            try:
+                with span("rate_cache_lookup", codes=len(codes)) as lookup:
+                    cached_rates = await self.cache_service.bulk_get_cached_rates(codes, location)
+                    lookup.set(hits=len(cached_rates), misses=len(codes) - len(cached_rates))
+            except Exception as e:
+                log.error("Cache error, proceeding with API call", error=str(e))
+
+        # 2. Only codes that are neither cached nor recently found to have no rate are searched
+        to_search = [
+            procedure for procedure in procedures
+            if procedure["code"] not in cached_rates
+            and not (use_cache and self.cache_service.is_known_without_rate(procedure["code"], location))
+        ]
+        if cached_rates and not to_search:
+            log.debug("All rates found in cache")
+
+        # Stale rates are answered now and refreshed for the next request
+        stale = [procedure for procedure in procedures if cached_rates.get(procedure["code"], {}).get("stale")]
+        if stale:
+            self._revalidate(stale, region, max_retries)
+
+        # 3. Search the misses, sharing lookups already in flight for other requests
+        searched_rates = await self._lookup_rates(to_search, region, max_retries) if to_search else {}
+
+        # 4. Merge by code, in bill order; rates shared with other bills take this bill's billed cost
+        procedure_analysis = []
+        for procedure in procedures:
+            rate = cached_rates.get(procedure["code"]) or searched_rates.get(procedure["code"])
+            if rate is None:
+                continue
+            billed_cost = procedure.get("cost")
+            procedure_analysis.append({
+                **rate,
+                "billed_cost": billed_cost if isinstance(billed_cost, (int, float)) else rate.get("billed_cost"),
             })
-        
-        # If everything failed, return empty array
+
+        log.info(
+            "Rates resolved", rated=len(procedure_analysis), procedures=len(procedures),
+            cached=len(cached_rates), searched=len(to_search), seconds=round(time.time() - start_time, 3)
+        )
         return json.dumps({
             "ucr_validation": {
-                "procedure_analysis": []
+                "procedure_analysis": procedure_analysis
             }
         })
 
@@ -0,0 +1,158 @@
+# services/pricing.py
+import os
+from typing import Dict, List, NamedTuple, Optional, Sequence, Tuple
+import numpy as np
+from app.services.database import hcpcs_table, apc_table, DATABASES_DIR, DerivedTable, ReferenceArtifact
+from app.services.code_index import extract_code
+from app.services.log import get_logger
+
+"""
+Deterministic Medicare (OPPS) pricing from addendum_a.csv / addendum_b.csv.
+
+Each HCPCS code is joined to its APC (the same join map.py does) and its payment rate is
+parsed from strings like "$4,156.57 " into integer cents once. The result is a sorted NumPy
+record array (prebuilt by databases/map.py and memory-mapped at startup when available),
+so pricing a whole bill is one searchsorted call. Codes priced here never need an LLM
+rate search.
+"""
+
+log = get_logger(__name__)
+
+LOCAL_PRICING_ENABLED = os.getenv("LOCAL_PRICING_ENABLED", "1") == "1"
+PRICING_SOURCE = "CMS OPPS Addendum B"
+
+# Prebuilt artifact written by databases/map.py; bump the version whenever RATE_DTYPE changes
+RATE_ARTIFACT_VERSION = 2
+RATE_ARTIFACT_PATH = DATABASES_DIR / f"medicare_rates.v{RATE_ARTIFACT_VERSION}.npy"
+RATE_DTYPE = np.dtype([
+    ("code", "S5"),
+    ("apc", "S5"),
+    ("rate_cents", "<i8"),
+    ("desc_offset", "<i8"),   # into the artifact's UTF-8 descriptions blob
+    ("desc_length", "<i4"),
+])
+rate_artifact = ReferenceArtifact("Medicare rates", RATE_ARTIFACT_PATH, RATE_DTYPE, (hcpcs_table, apc_table))
+
+
+class PriceTable(NamedTuple):
+    codes: np.ndarray             # sorted, S5
+    rate_cents: np.ndarray        # int64, aligned with codes
+    apcs: np.ndarray              # S5, aligned with codes
+    descriptions: Sequence[str]   # aligned with codes
+
+    @classmethod
+    def from_records(cls, records: np.ndarray, descriptions: Sequence[str]) -> "PriceTable":
+        return cls(records["code"], records["rate_cents"], records["apc"], descriptions)
+
+
+def parse_rate_cents(value: str) -> Optional[int]:
+    """'$4,156.57 ' -> 415657; blank or malformed -> None"""
+    cleaned = value.replace("$", "").replace(",", "").strip()
+    if not cleaned:
+        return None
+    try:
+        dollars, _, cents = cleaned.partition(".")
+        return int(dollars or 0) * 100 + int((cents + "00")[:2])
+    except ValueError:
+        return None
+
+
+def build_rate_records() -> Tuple[np.ndarray, List[str]]:
+    """
+    Join addendum B codes to addendum A APC rates; one row per priced code, sorted by code,
+    and the descriptions aligned with it.
+    """
+    apc_rates = {}
+    for apc, record in apc_table.records().items():
+        cents = parse_rate_cents(record.payment_rate)
+        if cents:
+            apc_rates[apc] = cents
+
+    rows = []
+    for code, record in hcpcs_table.records().items():
+        if len(code) != 5 or not code.isascii():
+            continue  # a few addendum rows carry stray characters after the code
+        # Addendum B carries its own rate for most codes; fall back to the APC group rate
+        cents = parse_rate_cents(record.payment_rate) or apc_rates.get(record.apc)
+        if cents:
+            rows.append((code, record.apc, cents, record.description))
+    rows.sort()
+    records = np.zeros(len(rows), dtype=RATE_DTYPE)
+    if rows:
+        records["code"] = [row[0].encode("ascii") for row in rows]
+        records["apc"] = [row[1].encode("ascii") for row in rows]
+        records["rate_cents"] = [row[2] for row in rows]
+    return records, [row[3] for row in rows]
+
+
+def _table_from_addenda() -> PriceTable:
+    return PriceTable.from_records(*build_rate_records())
+
+
+_price_table = DerivedTable(rate_artifact, PriceTable.from_records, _table_from_addenda)
+
+
+def get_price_table() -> PriceTable:
+    """
+    The price table. Workers normally just mmap the prebuilt artifact, and map it again when
+    it is rebuilt; without a current artifact the table is built from the addenda and rebuilt
+    when either is reloaded.
+    """
+    return _price_table.get()
+
+
+def _quantity(value) -> float:
+    try:
+        quantity = float(value)
+    except (TypeError, ValueError):
+        return 1.0
+    return quantity if quantity > 0 else 1.0
+
+
+def _billed_cost(value) -> float:
+    if isinstance(value, (int, float)):
+        return float(value)
+    try:
+        return float(str(value).replace("$", "").replace(",", "").strip())
+    except ValueError:
+        return 0.0
+
+
+def price_procedures(procedures: List[Dict]) -> Tuple[List[Dict], List[Dict]]:
+    """
+    Price every line item that has a Medicare rate.
+    Returns (priced procedure_analysis entries, procedures that still need a rate search).
+    """
+    if not procedures:
+        return [], []
+
+    table = get_price_table()
+    if len(table.codes) == 0:
+        # No Medicare rates loaded (missing addenda/artifact); everything goes to the rate search
+        return [], procedures
+
+    codes = np.array([extract_code(p.get("code", "")) or "" for p in procedures], dtype="S5")
+    quantities = np.array([_quantity(p.get("quantity")) for p in procedures], dtype=np.float64)
+
+    positions = np.searchsorted(table.codes, codes)
+    positions = np.minimum(positions, len(table.codes) - 1)
+    found = (table.codes[positions] == codes) & (codes != b"")
+    unit_rates = np.where(found, table.rate_cents[positions], 0) / 100.0
+    line_rates = np.round(unit_rates * quantities, 2)
+
+    priced, unpriced = [], []
+    for i, procedure in enumerate(procedures):
+        if not found[i]:
+            unpriced.append(procedure)
+            continue
+        position = positions[i]
+        priced.append({
+            "code": codes[i].decode("ascii"),
+            "description": procedure.get("description") or table.descriptions[position],
+            "billed_cost": round(_billed_cost(procedure.get("cost")), 2),
+            "quantity": float(quantities[i]),
+            "unit_rate": float(unit_rates[i]),
+            "standardized_rate": float(line_rates[i]),
+            "sources": [f"{PRICING_SOURCE} (APC {table.apcs[position].decode('ascii')})"]
+        })
+    return priced, unpriced
@@ -0,0 +1,121 @@
+# services/prompts.py
+import json
+import os
+from typing import Dict, Iterable, List, Sequence
+
+"""
+Compact prompt payloads for the rate search and explanation stages.
+
+Only the fields a stage needs are projected out of the bill (empty values dropped), and
+line items are rendered as one compact JSON array or as a pipe-separated table with a
+single header row, which repeats no keys. Prompts are assembled with join, never by
+repeated string concatenation. benchmarks/bench_prompts.py reports the token savings.
+"""
+
+# "table" (fewest tokens) or "json"
+PROMPT_ITEM_FORMAT = os.getenv("PROMPT_ITEM_FORMAT", "table")
+
+RATE_SEARCH_FIELDS = ("code", "description", "quantity", "cost")
+EXPLANATION_FIELDS = ("code", "description", "quantity", "billed_cost", "standardized_rate")
+
+RATE_SEARCH_SYSTEM_PROMPT = "You are a medical rate analyzer. Output ONLY valid JSON, no explanations or text outside JSON structure."
+
+RATE_SEARCH_PROMPT = """Analyze rates for:
+{items}
+
+Return ONLY this JSON structure:
+{{"ucr_validation":{{"procedure_analysis":[{{"code":"exact code from input","description":"exact description from input","billed_cost":number (2 decimal places),"standardized_rate":number (2 decimal places),"sources":["source used"]}}]}}}}
+
+STRICT RULES:
+1. ONLY output valid JSON
+2. NO text outside JSON structure
+3. Search Standardized / Usual Customary & Reasonable (UCR) Rates in this order: Medicare RVU → NC Medicaid → BetterCare → FAIR Health → Regional etc
+4. Location: {location}
+5. Codes are either of type CPT (5 digits) or HCPCS (first character is a letter, followed by 4 digits)
+6. ALL costs must be numbers
+7. For each procedure in the input:
+   - Include ALL sources used in the sources array
+   - If standardized_rate is None, 0 or 0.0, do not include the code, description, billed_cost, standardized_rate or sources for that procedure
+8. The procedure_analysis array should ONLY contain procedures with valid averaged rates from multiple sources
+9. CRITICAL: Do not make up any data"""
+
+
+def compact_json(value) -> str:
+    return json.dumps(value, separators=(",", ":"), ensure_ascii=False)
+
+
+def _format_value(value) -> str:
+    if isinstance(value, float):
+        return f"{value:.2f}".rstrip("0").rstrip(".")
+    return str(value).replace("|", "/").replace("\n", " ")
+
+
+def project(items: Iterable[Dict], fields: Sequence[str]) -> List[Dict]:
+    """Keep only fields, dropping empty values (a quantity of 1 is the default and dropped too)"""
+    projected = []
+    for item in items:
+        row = {}
+        for field in fields:
+            value = item.get(field)
+            if value in (None, "", [], {}) or (field == "quantity" and value == 1):
+                continue
+            row[field] = value
+        projected.append(row)
+    return projected
+
+
+def format_items(items: Iterable[Dict], fields: Sequence[str], item_format: str = None) -> str:
+    """Line items as a compact JSON array or a pipe-separated table with one header row"""
+    rows = project(items, fields)
+    if (item_format or PROMPT_ITEM_FORMAT) == "json":
+        return compact_json(rows)
+    used = [field for field in fields if any(field in row for row in rows)]
+    lines = ["|".join(used)]
+    lines.extend("|".join(_format_value(row.get(field, "")) for field in used) for row in rows)
+    return "\n".join(lines)
+
+
+def build_rate_search_messages(procedures: List[Dict], location: str) -> List[Dict]:
+    return [
+        {"role": "system", "content": RATE_SEARCH_SYSTEM_PROMPT},
+        {
+            "role": "user",
+            "content": RATE_SEARCH_PROMPT.format(
+                items=format_items(procedures, RATE_SEARCH_FIELDS), location=location
+            ),
+        },
+    ]
+
+
+def build_explanation_report(code_result: Dict, ucr_result: Dict) -> str:
+    """The findings the explanation stage needs: invalid codes, and the priced line items"""
+    parts = ["Explanation Summary:"]
+
+    code_validation = code_result.get("code_validation", code_result)
+    if "error" in code_validation:
+        parts.append(f"code_validation error: {code_validation['error']}")
+    else:
+        parts.append(f"code_validation: {code_validation.get('summary', '')}")
+        invalid = [
+            {"code": result["code"], "billed_description": result.get("billed_description"), "reason": result.get("reason")}
+            for result in code_validation.get("validation_results", []) if not result.get("is_valid")
+        ]
+        if invalid:
+            parts.append("invalid codes:")
+            parts.append(format_items(invalid, ("code", "billed_description", "reason")))
+
+    ucr_validation = ucr_result.get("ucr_validation", {})
+    if isinstance(ucr_validation, str):
+        try:
+            ucr_validation = json.loads(ucr_validation)
+        except json.JSONDecodeError:
+            ucr_validation = {}
+    analysis = ucr_validation.get("ucr_validation", ucr_validation).get("procedure_analysis", [])
+    parts.append("ucr_validation:")
+    parts.append(format_items(analysis, EXPLANATION_FIELDS))
+
+    # Sources repeat across line items; list each once
+    references = list(dict.fromkeys(source for item in analysis for source in item.get("sources", [])))
+    if references:
+        parts.append("references: " + "; ".join(references))
+    return "\n".join(parts)
@@ -0,0 +1,174 @@
+# services/rate_warmup.py
+import argparse
+import asyncio
+import json
+import os
+from collections import Counter, defaultdict
+from typing import List, Optional
+from app.services.perplexity import perplexity_service
+from app.services.regions import normalize_region
+from app.services.code_index import lookup_code
+from app.services.pricing import price_procedures, LOCAL_PRICING_ENABLED
+from app.services.log import get_logger
+
+"""
+Keep the rate cache warm, so the first bills after a deploy or an expiry wave hit the cache
+instead of waiting on a rate search.
+
+Warm-up fills the cache for the most common codes in each region. Refresh-ahead re-searches
+entries shortly before they expire, most requested first, a bounded batch per interval.
+
+    python -m app.services.rate_warmup --regions "Los Angeles, CA" 77002 TX --top 50
+    python -m app.services.rate_warmup --refresh [--loop]
+"""
+
+log = get_logger(__name__)
+
+RATE_REFRESH_ENABLED = os.getenv("RATE_REFRESH_ENABLED", "0") == "1"
+# Refresh entries that expire within this window
+RATE_REFRESH_AHEAD_SECONDS = int(os.getenv("RATE_REFRESH_AHEAD_SECONDS", str(3 * 24 * 3600)))
+# At most this many codes are re-searched per interval
+RATE_REFRESH_BATCH_SIZE = int(os.getenv("RATE_REFRESH_BATCH_SIZE", "20"))
+RATE_REFRESH_INTERVAL_SECONDS = int(os.getenv("RATE_REFRESH_INTERVAL_SECONDS", "300"))
+
+# Frequently billed codes, used when the cache has no history to rank codes by
+COMMON_CODES = [
+    "99213", "99214", "99212", "99215", "99203", "99204", "99283", "99284", "99285", "99282",
+    "36415", "85025", "80053", "80048", "81001", "84443", "83036", "80061", "87086", "87880",
+    "93000", "71046", "71045", "73030", "72100", "74177", "70450", "76700", "76856", "77067",
+    "96372", "96374", "96375", "96360", "90471", "90686", "J1100", "J2405", "J3490", "J7030",
+    "J0696", "J1885", "J2550", "A4649", "A6402", "97110", "97140", "97530", "99232", "99233",
+]
+
+
+def _top_cached_codes(limit: int) -> List[str]:
+    """Codes cached most often across all regions, i.e. the ones bills actually contain"""
+    supabase = perplexity_service.cache_service.supabase
+    if supabase is None:
+        return []
+    try:
+        rows = supabase.table("standardized_rates").select("code").limit(10000).execute().data
+    except Exception as e:
+        log.warning("Could not rank codes from the rate cache", error=str(e))
+        return []
+    return [code for code, _ in Counter(row["code"] for row in rows).most_common(limit)]
+
+
+def top_codes(limit: int, lookup_counts: Optional[dict] = None) -> List[str]:
+    """The most common codes that still need a rate search (locally priced codes never do)"""
+    # Codes this process has been asked for, then the cache's history, then the static list
+    requested = Counter()
+    for (code, _), count in (lookup_counts or {}).items():
+        requested[code] += count
+    candidates = list(dict.fromkeys(
+        [code for code, _ in requested.most_common(limit * 2)] + _top_cached_codes(limit * 2) + COMMON_CODES
+    ))
+    if LOCAL_PRICING_ENABLED:
+        _, unpriced = price_procedures([{"code": code} for code in candidates])
+        candidates = [procedure["code"] for procedure in unpriced]
+    return candidates[:limit]
+
+
+async def warm_region(location: str, codes: List[str]) -> int:
+    """Search and cache rates for codes in one region; returns how many are now cached"""
+    region = normalize_region(location)
+    procedures = []
+    for code in codes:
+        record = lookup_code(code)
+        procedures.append({"code": code, "description": record.description if record else ""})
+    result = await perplexity_service.search_ucr_rates(
+        {"billing_details": {"procedure_codes": procedures}}, location=region
+    )
+    cached = len(json.loads(result)["ucr_validation"]["procedure_analysis"])
+    log.info("Region warmed", region=region.key, cached=cached, codes=len(codes))
+    return cached
+
+
+async def warm_up(locations: List[str], top: int = 50, codes: Optional[List[str]] = None) -> None:
+    lookup_counts = dict(perplexity_service.cache_service.lookup_counts)
+    codes = codes or await asyncio.to_thread(top_codes, top, lookup_counts)
+    # Locations in the same region share one cache key space; warm each region once
+    regions = {normalize_region(location).key: location for location in locations}
+    # Regions run concurrently; the provider semaphore in llm_clients bounds the API calls
+    await asyncio.gather(*(warm_region(location, codes) for location in regions.values()))
+
+
+async def refresh_expiring(limit: int = RATE_REFRESH_BATCH_SIZE) -> int:
+    """Re-search up to limit entries that are about to expire; returns how many were refreshed"""
+    rows = await perplexity_service.cache_service.expiring_rates(RATE_REFRESH_AHEAD_SECONDS, limit)
+    by_location = defaultdict(list)
+    for row in rows:
+        by_location[row["location"]].append({"code": row["code"], "description": row.get("description", "")})
+
+    refreshed = 0
+    for location, procedures in by_location.items():
+        # Stored keys are region keys; they resolve to themselves, so the refreshed rows
+        # are written back under the same key
+        region = normalize_region(location)
+        if region.key != location:
+            log.warning("Skipping rate cache entries with an unknown region key", location=location)
+            continue
+        result = await perplexity_service.search_ucr_rates(
+            {"billing_details": {"procedure_codes": procedures}}, location=region, use_cache=False
+        )
+        refreshed += len(json.loads(result)["ucr_validation"]["procedure_analysis"])
+    if rows:
+        log.info("Refreshed expiring rate cache entries", refreshed=refreshed, expiring=len(rows))
+    return refreshed
+
+
+async def run_refresh_loop() -> None:
+    """Refresh a bounded batch of expiring entries every RATE_REFRESH_INTERVAL_SECONDS"""
+    while True:
+        try:
+            await refresh_expiring()
+        except Exception as e:
+            log.error("Rate refresh error", error=str(e))
+        await asyncio.sleep(RATE_REFRESH_INTERVAL_SECONDS)
+
+
+_refresh_task: Optional[asyncio.Task] = None
+
+
+def start_refresh_job() -> None:
+    """Run the refresh-ahead loop inside the app (RATE_REFRESH_ENABLED=1, one worker only)"""
+    global _refresh_task
+    if RATE_REFRESH_ENABLED and _refresh_task is None:
+        _refresh_task = asyncio.create_task(run_refresh_loop())
+
+
+async def stop_refresh_job() -> None:
+    global _refresh_task
+    if _refresh_task is not None:
+        _refresh_task.cancel()
+        try:
+            await _refresh_task
+        except asyncio.CancelledError:
+            pass
+        _refresh_task = None
+
+
+async def _main(args) -> None:
+    if args.regions:
+        await warm_up(args.regions, args.top, args.codes)
+    if args.refresh:
+        if args.loop:
+            await run_refresh_loop()
+        else:
+            await refresh_expiring(args.limit)
+    await perplexity_service.cache_service.stop_write_behind()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pre-populate the rate cache for common codes")
+    parser.add_argument("--regions", nargs="+",
+                        help='Locations to warm, e.g. "Los Angeles, CA" 77002 TX')
+    parser.add_argument("--top", type=int, default=50, help="Number of codes per region")
+    parser.add_argument("--codes", nargs="+", help="Warm these codes instead of the most common ones")
+    parser.add_argument("--refresh", action="store_true", help="Re-search entries that are about to expire")
+    parser.add_argument("--limit", type=int, default=RATE_REFRESH_BATCH_SIZE, help="Entries to refresh (with --refresh)")
+    parser.add_argument("--loop", action="store_true", help="Keep refreshing every RATE_REFRESH_INTERVAL_SECONDS")
+    args = parser.parse_args()
+    if not args.regions and not args.refresh:
+        parser.error("nothing to do: pass --regions and/or --refresh")
+    asyncio.run(_main(args))
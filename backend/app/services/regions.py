@@ -0,0 +1,185 @@
+# services/regions.py
+import os
+import re
+from typing import NamedTuple, Optional
+
+"""
+Normalize a user-supplied location to the rate region used as the cache key.
+
+UCR/Medicare rates vary by payment locality, not by street address, so every location is
+reduced to the coarsest region that still prices the same: a metro locality when the ZIP
+(first three digits) or city is known, otherwise the whole state, and national rates when
+not even the state is known. Bills from nearby ZIPs therefore share cache entries. Keys
+keep the "City, ST" shape the rate cache already uses.
+"""
+
+DEFAULT_LOCATION = os.getenv("DEFAULT_RATE_LOCATION", "Los Angeles, CA")
+
+# Mirrors src/lib/locationData.ts on the frontend
+STATES = {
+    "AL": "Alabama", "AK": "Alaska", "AZ": "Arizona", "AR": "Arkansas", "CA": "California",
+    "CO": "Colorado", "CT": "Connecticut", "DE": "Delaware", "FL": "Florida", "GA": "Georgia",
+    "HI": "Hawaii", "ID": "Idaho", "IL": "Illinois", "IN": "Indiana", "IA": "Iowa",
+    "KS": "Kansas", "KY": "Kentucky", "LA": "Louisiana", "ME": "Maine", "MD": "Maryland",
+    "MA": "Massachusetts", "MI": "Michigan", "MN": "Minnesota", "MS": "Mississippi", "MO": "Missouri",
+    "MT": "Montana", "NE": "Nebraska", "NV": "Nevada", "NH": "New Hampshire", "NJ": "New Jersey",
+    "NM": "New Mexico", "NY": "New York", "NC": "North Carolina", "ND": "North Dakota", "OH": "Ohio",
+    "OK": "Oklahoma", "OR": "Oregon", "PA": "Pennsylvania", "RI": "Rhode Island", "SC": "South Carolina",
+    "SD": "South Dakota", "TN": "Tennessee", "TX": "Texas", "UT": "Utah", "VT": "Vermont",
+    "VA": "Virginia", "WA": "Washington", "WV": "West Virginia", "WI": "Wisconsin", "WY": "Wyoming",
+}
+STATE_BY_NAME = {name.lower(): abbr for abbr, name in STATES.items()}
+
+# Metro payment localities: (state, locality) -> (ZIP3 prefixes, city names that map to it)
+LOCALITIES = {
+    ("CA", "Los Angeles"): (
+        ("900", "901", "902", "903", "904", "905", "906", "907", "908",
+         "910", "911", "912", "913", "914", "915", "916", "918"),
+        ("los angeles", "long beach", "pasadena", "glendale", "burbank", "santa monica", "torrance"),
+    ),
+    ("CA", "Orange"): (("926", "927", "928"), ("anaheim", "santa ana", "irvine", "huntington beach")),
+    ("CA", "San Diego"): (("919", "920", "921"), ("san diego", "chula vista")),
+    ("CA", "Riverside"): (("922", "925"), ("riverside", "palm springs")),
+    ("CA", "San Bernardino"): (("917", "923", "924"), ("san bernardino", "ontario")),
+    ("CA", "San Francisco"): (("941",), ("san francisco",)),
+    ("CA", "San Mateo"): (("940", "944"), ("san mateo", "palo alto", "redwood city")),
+    ("CA", "Oakland/Berkeley"): (("945", "946", "947"), ("oakland", "berkeley")),
+    ("CA", "Santa Clara"): (("950", "951"), ("san jose", "santa clara", "sunnyvale")),
+    ("CA", "Sacramento"): (("956", "957", "958"), ("sacramento",)),
+    ("NY", "Manhattan"): (("100", "101", "102"), ("manhattan", "new york", "new york city", "nyc")),
+    ("NY", "Queens"): (("110", "111", "113", "114", "116"), ("queens",)),
+    ("NY", "NYC Suburbs/Long Island"): (
+        ("103", "104", "105", "107", "108", "112", "115", "117", "118", "119"),
+        ("brooklyn", "bronx", "staten island", "yonkers", "long island"),
+    ),
+    ("TX", "Houston"): (("770", "772", "773", "774", "775"), ("houston",)),
+    ("TX", "Dallas"): (("750", "751", "752", "753"), ("dallas", "plano", "irving")),
+    ("TX", "Fort Worth"): (("760", "761"), ("fort worth", "arlington")),
+    ("TX", "Austin"): (("786", "787"), ("austin",)),
+    ("IL", "Chicago"): (("606", "607", "608"), ("chicago",)),
+    ("IL", "Suburban Chicago"): (("600", "601", "602", "603", "604", "605"), ("evanston", "naperville")),
+    ("FL", "Miami"): (("330", "331", "332"), ("miami", "miami beach", "hialeah")),
+    ("FL", "Fort Lauderdale"): (("333",), ("fort lauderdale",)),
+    ("MA", "Metropolitan Boston"): (("021", "022", "024"), ("boston", "cambridge")),
+    ("PA", "Metropolitan Philadelphia"): (("190", "191", "193", "194"), ("philadelphia",)),
+    ("WA", "Seattle"): (("980", "981"), ("seattle", "bellevue")),
+    ("GA", "Atlanta"): (("300", "301", "303", "311"), ("atlanta",)),
+    ("MI", "Detroit"): (("480", "481", "482", "483"), ("detroit",)),
+}
+LOCALITY_BY_ZIP3 = {
+    zip3: (state, locality) for (state, locality), (zip3s, _) in LOCALITIES.items() for zip3 in zip3s
+}
+LOCALITY_BY_CITY = {
+    (state, city): locality for (state, locality), (_, cities) in LOCALITIES.items() for city in cities
+}
+
+# ZIP3 prefix ranges (inclusive) -> state, for ZIPs outside the metro localities above.
+# DC, the territories and military ZIPs have no state entry and resolve to national rates.
+ZIP3_STATE_RANGES = (
+    ("005", "005", "NY"), ("010", "027", "MA"), ("028", "029", "RI"), ("030", "038", "NH"),
+    ("039", "049", "ME"), ("050", "054", "VT"), ("055", "055", "MA"), ("056", "059", "VT"),
+    ("060", "069", "CT"), ("070", "089", "NJ"), ("100", "149", "NY"), ("150", "196", "PA"),
+    ("197", "199", "DE"), ("201", "201", "VA"), ("206", "219", "MD"), ("220", "246", "VA"),
+    ("247", "268", "WV"), ("270", "289", "NC"), ("290", "299", "SC"), ("300", "319", "GA"),
+    ("320", "339", "FL"), ("341", "349", "FL"), ("350", "369", "AL"), ("370", "385", "TN"),
+    ("386", "397", "MS"), ("398", "399", "GA"), ("400", "427", "KY"), ("430", "459", "OH"),
+    ("460", "479", "IN"), ("480", "499", "MI"), ("500", "528", "IA"), ("530", "549", "WI"),
+    ("550", "567", "MN"), ("570", "577", "SD"), ("580", "588", "ND"), ("590", "599", "MT"),
+    ("600", "629", "IL"), ("630", "658", "MO"), ("660", "679", "KS"), ("680", "693", "NE"),
+    ("700", "715", "LA"), ("716", "729", "AR"), ("730", "732", "OK"), ("733", "733", "TX"),
+    ("734", "749", "OK"), ("750", "799", "TX"), ("800", "816", "CO"), ("820", "831", "WY"),
+    ("832", "838", "ID"), ("840", "847", "UT"), ("850", "865", "AZ"), ("870", "884", "NM"),
+    ("885", "885", "TX"), ("889", "898", "NV"), ("900", "961", "CA"), ("967", "968", "HI"),
+    ("970", "979", "OR"), ("980", "994", "WA"), ("995", "999", "AK"),
+)
+STATE_BY_ZIP3 = {
+    f"{zip3:03d}": state
+    for start, end, state in ZIP3_STATE_RANGES for zip3 in range(int(start), int(end) + 1)
+}
+
+# Every locality cache key maps back to its own region, so stored keys round-trip
+LOCALITY_BY_KEY = {f"{locality}, {state}": (state, locality) for state, locality in LOCALITIES}
+
+ZIP_PATTERN = re.compile(r"\b(\d{5})(?:-\d{4})?\b")
+
+
+class Region(NamedTuple):
+    key: str    # cache key, e.g. "Los Angeles, CA" or "TX"
+    label: str  # what the rate search prompt is told
+    level: str  # "locality", "state", "national" or "default"
+
+
+# Known location whose state can't be determined (unknown ZIP, foreign address, ...)
+NATIONAL_REGION = Region("US", "United States (national)", "national")
+
+
+def _locality_region(state: str, locality: str) -> Region:
+    return Region(f"{locality}, {state}", f"{locality}, {state}", "locality")
+
+
+def _state_region(state: str) -> Region:
+    return Region(state, f"{STATES[state]} (statewide)", "state")
+
+
+def _parse_state(parts: list) -> Optional[str]:
+    for part in reversed(parts):
+        token = ZIP_PATTERN.sub("", part).strip()
+        if token.upper() in STATES:
+            return token.upper()
+        if token.lower() in STATE_BY_NAME:
+            return STATE_BY_NAME[token.lower()]
+    return None
+
+
+def _resolve(location: Optional[str], zip_code: Optional[str] = None) -> Optional[Region]:
+    text = (location or "").strip()
+    if text in LOCALITY_BY_KEY and not zip_code:
+        return _locality_region(*LOCALITY_BY_KEY[text])
+
+    zip_match = ZIP_PATTERN.search(zip_code or "") or ZIP_PATTERN.search(text)
+    if zip_match:
+        match = LOCALITY_BY_ZIP3.get(zip_match.group(1)[:3])
+        if match:
+            return _locality_region(*match)
+
+    parts = [part.strip() for part in text.split(",") if part.strip()]
+    state = _parse_state(parts)
+    if state:
+        city = ZIP_PATTERN.sub("", parts[0]).strip().lower() if len(parts) > 1 else ""
+        locality = LOCALITY_BY_CITY.get((state, city))
+        if locality:
+            return _locality_region(state, locality)
+        return _state_region(state)
+
+    # A ZIP outside the metro localities still tells us the state
+    if zip_match and zip_match.group(1)[:3] in STATE_BY_ZIP3:
+        return _state_region(STATE_BY_ZIP3[zip_match.group(1)[:3]])
+
+    if text:
+        # A bare city name is only trusted if it names exactly one known locality
+        matches = {(st, locality) for (st, city), locality in LOCALITY_BY_CITY.items() if city == text.lower()}
+        if len(matches) == 1:
+            return _locality_region(*matches.pop())
+    return None
+
+
+def default_region() -> Region:
+    region = _resolve(DEFAULT_LOCATION)
+    if region is None:
+        return Region(DEFAULT_LOCATION, DEFAULT_LOCATION, "default")
+    return region._replace(level="default")
+
+
+def normalize_region(location: Optional[str] = None, zip_code: Optional[str] = None) -> Region:
+    """
+    Resolve a location ("Houston, TX", "77002", "Chicago, Illinois 60611", "CA") to its
+    rate region: ZIP3 locality, then city locality, then state (named or from the ZIP).
+    A region's own key resolves to that region. A location that resolves to none of these
+    gets national rates; only a missing location falls back to DEFAULT_LOCATION.
+    """
+    region = _resolve(location, zip_code)
+    if region is not None:
+        return region
+    if (location or "").strip() or (zip_code or "").strip():
+        return NATIONAL_REGION
+    return default_region()
@@ -4,10 +4,11 @@ import base64
 from app.services.ocr import extract_text_from_document
 from app.services.bill_analyzer import code_validation, ucr_validation, explanation_handler
 import time
+from pathlib import Path
 
 async def test_ocr_and_save():
     # Load your test PDF/image
-    with open("/Users/dhruvywuvy/Documents/GitHub/advocare_demo_day/backend/databases/MedicalBill.jpeg", "rb") as f:
+    with open(Path(__file__).resolve().parents[2] / "databases" / "MedicalBill.jpeg", "rb") as f:
         file_content = f.read()
     
     # Time the extraction
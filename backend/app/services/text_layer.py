@@ -0,0 +1,107 @@
+# services/text_layer.py
+import os
+import re
+from typing import Dict, List, Optional
+
+"""
+Deterministic line-item parser for PDFs that already carry a text layer.
+
+Generated hospital statements are laid out one charge per line. When enough of a page's
+charge lines can be parsed into (code, description, quantity, cost) we skip the vision
+call for that page entirely; anything ambiguous falls back to OCR.
+"""
+
+# Share of charge lines that must carry a recognisable code for the page to be trusted
+TEXT_LAYER_MIN_CONFIDENCE = float(os.getenv("TEXT_LAYER_MIN_CONFIDENCE", "0.8"))
+# Pages with less text than this are treated as scanned
+TEXT_LAYER_MIN_CHARS = 40
+
+# CPT (5 digits, or 4 digits + F/T/U) and HCPCS Level II (letter A-V + 4 digits)
+CODE_PATTERN = re.compile(r"(?<![\w/.-])(\d{4}[0-9FTU]|[A-V]\d{4})(?![\w/-])")
+AMOUNT_PATTERN = re.compile(r"(?<![\w.])\(?-?\$?\s?\d{1,3}(?:,\d{3})*\.\d{2}\)?(?![\w])")
+# A quantity is its own column: marked (2 x, 2 units, 2 ea, x 2) or set off by column spacing.
+# A bare number ending the description ("ER Facility Level 3") is part of the description.
+QUANTITY_PATTERN = re.compile(
+    r"(?:(?:^|\s)(\d{1,3})\s*(?:x|units?|ea)|(?:^|\s)x\s*(\d{1,3})|(?:^\s*|\s{2,}|\t)(\d{1,3}))\s*$",
+    re.IGNORECASE
+)
+DATE_PATTERN = re.compile(r"\b\d{1,2}[/-]\d{1,2}[/-]\d{2,4}\b")
+SUBTOTAL_WORDS = re.compile(r"\b(total|subtotal)\b", re.IGNORECASE)
+# Payments, adjustments and balances are not charges at all
+NON_CHARGE_WORDS = re.compile(
+    r"\b(balance|payment|paid|adjustment|insurance|amount due|due date|credit)\b", re.IGNORECASE
+)
+
+# Counts of how each PDF page was handled
+FAST_PATH_STATS = {"pages_text_layer": 0, "pages_vision": 0}
+
+
+def _parse_amount(token: str) -> float:
+    negative = token.startswith("(") or "-" in token
+    value = float(re.sub(r"[^\d.]", "", token))
+    return -value if negative else value
+
+
+def _parse_charge_line(line: str) -> Optional[Dict]:
+    """Parse one layout line into a line item, or None if it is not a charge line"""
+    amounts = list(AMOUNT_PATTERN.finditer(line))
+    if not amounts:
+        return None
+
+    head = DATE_PATTERN.sub(" ", line[:amounts[0].start()])
+    if NON_CHARGE_WORDS.search(head):
+        return None
+    is_subtotal = bool(SUBTOTAL_WORDS.search(head))
+    code_match = CODE_PATTERN.search(head)
+    code = code_match.group(1) if code_match else ""
+
+    # Description is the text after the code ("CODE DESC [QTY]"), or before it when only a
+    # quantity column follows the code ("DESC CODE [QTY]"); the trailing quantity is dropped
+    description = head[code_match.end():] if code_match else head
+    quantity = 1
+    quantity_match = QUANTITY_PATTERN.search(description.rstrip())
+    if quantity_match:
+        quantity = int(next(group for group in quantity_match.groups() if group))
+        description = description[:quantity_match.start()]
+    if code_match and not description.strip():
+        description = head[:code_match.start()]
+    description = " ".join(description.replace("|", " ").split()).strip(" -:")
+
+    if not description and not code:
+        return None
+
+    return {
+        "code": code,
+        "description": description,
+        "quantity": quantity,
+        # The last amount on a line is the line total (unit price columns come first)
+        "cost": round(_parse_amount(amounts[-1].group()), 2),
+        "is_subtotal": is_subtotal
+    }
+
+
+def parse_text_layer(text: str) -> Optional[Dict]:
+    """
+    Parse a page's text layer into the same billing_details shape the vision OCR returns.
+    Returns None when the page has no usable text layer or the parse is low-confidence.
+    """
+    if len(text.strip()) < TEXT_LAYER_MIN_CHARS:
+        return None
+
+    items: List[Dict] = []
+    for line in text.splitlines():
+        item = _parse_charge_line(line)
+        if item is not None:
+            items.append(item)
+
+    charges = [item for item in items if not item["is_subtotal"]]
+    coded = [item for item in charges if item["code"]]
+    if not coded or len(coded) / len(charges) < TEXT_LAYER_MIN_CONFIDENCE:
+        return None
+
+    return {
+        "billing_details": {
+            "procedure_codes": items,
+            "total_cost": round(sum(item["cost"] for item in charges), 2)
+        }
+    }
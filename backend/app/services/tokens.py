@@ -0,0 +1,192 @@
+# services/tokens.py
+import contextvars
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from functools import lru_cache
+from typing import Any, Dict, List, Optional
+from app.services.log import get_logger
+
+"""
+Token accounting for every LLM call.
+
+Estimates are made with one process-wide tiktoken encoder (or a chars/4 approximation for
+large inputs, or when the encoding can't be loaded). Actual usage reported by the provider
+is recorded per provider and purpose (ocr, rate_search, explanation, ...), together with
+call latency, and charged to the current request's TokenBudget. The budget lives in a
+contextvar, so tasks spawned by a request (OCR pages, rate chunks) charge the same budget.
+"""
+
+log = get_logger(__name__)
+
+TOKEN_ENCODING = os.getenv("TOKEN_ENCODING", "cl100k_base")
+# Inputs longer than this many characters are estimated as chars/4 instead of tokenized
+TOKEN_APPROX_THRESHOLD_CHARS = int(os.getenv("TOKEN_APPROX_THRESHOLD_CHARS", "20000"))
+# Rough cost of one image block; the provider's reported usage replaces it after the call
+IMAGE_TOKEN_ESTIMATE = int(os.getenv("IMAGE_TOKEN_ESTIMATE", "1600"))
+# Max tokens (input + output) one /api/analyze request may spend; 0 disables the check
+REQUEST_TOKEN_BUDGET = int(os.getenv("REQUEST_TOKEN_BUDGET", "0"))
+
+
+class TokenBudgetExceeded(Exception):
+    pass
+
+
+@lru_cache(maxsize=None)
+def get_encoder(name: str = TOKEN_ENCODING):
+    """The tiktoken encoding, loaded once per process; None if it can't be loaded (e.g. offline)"""
+    try:
+        import tiktoken
+        return tiktoken.get_encoding(name)
+    except Exception as e:
+        log.warning("tiktoken encoding unavailable, using approximate token counts", encoding=name, error=str(e))
+        return None
+
+
+def count_text_tokens(text: str, approximate: Optional[bool] = None) -> int:
+    if approximate is None:
+        approximate = len(text) > TOKEN_APPROX_THRESHOLD_CHARS
+    encoder = None if approximate else get_encoder()
+    if encoder is None:
+        return (len(text) + 3) // 4
+    return len(encoder.encode(text, disallowed_special=()))
+
+
+def _content_tokens(content: Any, approximate: Optional[bool]) -> int:
+    if isinstance(content, str):
+        return count_text_tokens(content, approximate)
+    tokens = 0
+    for block in content or []:
+        if block.get("type") == "image":
+            tokens += IMAGE_TOKEN_ESTIMATE
+        elif block.get("type") == "text":
+            tokens += count_text_tokens(block.get("text", ""), approximate)
+    return tokens
+
+
+def count_message_tokens(messages: List[Dict], system: Optional[str] = None,
+                         approximate: Optional[bool] = None) -> int:
+    """Estimated prompt tokens for a chat/messages request"""
+    tokens = count_text_tokens(system, approximate) if system else 0
+    for message in messages:
+        # Every message follows <im_start>{role/name}\n{content}<im_end>\n
+        tokens += 4 + _content_tokens(message.get("content"), approximate)
+    return tokens
+
+
+class TokenBudget:
+    """
+    Tokens spent by one request, optionally capped. Calls in flight hold a reservation
+    (prompt estimate + max_tokens) until their actual usage is charged, so concurrent
+    calls can't all pass the check against the same remaining budget.
+    """
+
+    def __init__(self, limit: int = REQUEST_TOKEN_BUDGET):
+        self.limit = limit
+        self.spent = 0
+        self.reserved = 0
+        self.calls = 0
+        self.by_purpose: Dict[str, int] = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def _check(self, estimated_tokens: int) -> None:
+        if self.limit and self.spent + self.reserved + estimated_tokens > self.limit:
+            raise TokenBudgetExceeded(
+                f"Token budget exceeded: {self.spent} spent + {self.reserved} reserved"
+                f" + {estimated_tokens} estimated > {self.limit}"
+            )
+
+    def check(self, estimated_tokens: int) -> None:
+        with self._lock:
+            self._check(estimated_tokens)
+
+    def reserve(self, tokens: int) -> None:
+        """Check and hold tokens for a call about to be made, in one step"""
+        with self._lock:
+            self._check(tokens)
+            self.reserved += tokens
+
+    def release(self, tokens: int) -> None:
+        with self._lock:
+            self.reserved = max(self.reserved - tokens, 0)
+
+    def charge(self, purpose: str, tokens: int) -> None:
+        with self._lock:
+            self.spent += tokens
+            self.calls += 1
+            self.by_purpose[purpose] += tokens
+
+    def summary(self) -> Dict[str, Any]:
+        return {"limit": self.limit, "spent": self.spent, "calls": self.calls, "by_purpose": dict(self.by_purpose)}
+
+
+_current_budget: contextvars.ContextVar[Optional[TokenBudget]] = contextvars.ContextVar(
+    "token_budget", default=None
+)
+
+
+def start_request_budget(limit: int = REQUEST_TOKEN_BUDGET) -> TokenBudget:
+    """Give the current request (and every task it spawns from here on) its own budget"""
+    budget = TokenBudget(limit)
+    _current_budget.set(budget)
+    return budget
+
+
+def current_budget() -> Optional[TokenBudget]:
+    return _current_budget.get()
+
+
+# (provider, purpose) -> running totals for this process
+USAGE_STATS: Dict[str, Dict[str, Any]] = defaultdict(lambda: {
+    "calls": 0, "errors": 0, "input_tokens": 0, "output_tokens": 0,
+    "estimated_input_tokens": 0, "latency_ms_total": 0.0,
+})
+
+
+def check_budget(estimated_tokens: int) -> None:
+    budget = current_budget()
+    if budget is not None:
+        budget.check(estimated_tokens)
+
+
+@contextmanager
+def reserve_budget(tokens: int):
+    """
+    Hold tokens against the current budget for the duration of one call. Raises
+    TokenBudgetExceeded up front; record_usage then charges the actual usage, and the
+    reservation is released however the call ends.
+    """
+    budget = current_budget()
+    if budget is not None:
+        budget.reserve(tokens)
+    try:
+        yield
+    finally:
+        if budget is not None:
+            budget.release(tokens)
+
+
+def record_usage(provider: str, purpose: str, estimated_input_tokens: int,
+                 input_tokens: Optional[int], output_tokens: int, started: float,
+                 error: bool = False) -> None:
+    """Record one call; input_tokens is the provider-reported count, if any"""
+    stats = USAGE_STATS[f"{provider}:{purpose}"]
+    stats["calls"] += 1
+    stats["errors"] += int(error)
+    stats["estimated_input_tokens"] += estimated_input_tokens
+    stats["input_tokens"] += input_tokens if input_tokens is not None else estimated_input_tokens
+    stats["output_tokens"] += output_tokens
+    stats["latency_ms_total"] += (time.perf_counter() - started) * 1000
+
+    budget = current_budget()
+    if budget is not None and not error:
+        budget.charge(purpose, (input_tokens if input_tokens is not None else estimated_input_tokens) + output_tokens)
+
+
+def get_usage_stats() -> Dict[str, Dict[str, Any]]:
+    return {
+        key: {**stats, "avg_latency_ms": stats["latency_ms_total"] / stats["calls"] if stats["calls"] else 0.0}
+        for key, stats in USAGE_STATS.items()
+    }
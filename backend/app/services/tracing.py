@@ -0,0 +1,203 @@
+# services/tracing.py
+import asyncio
+import contextvars
+import os
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, List, Optional
+from app.services.log import get_logger
+
+"""
+Per-request spans for the analysis stages (upload read, preprocess, PDF rasterize, vision OCR,
+cache lookups and writes, rate search, explanation).
+
+    with span("vision_ocr", attempt=2, bytes=len(image)) as s:
+        ...
+        s.set(cache_hit=False)
+
+Every span is timed into the stage_duration_seconds Prometheus histogram (labels: stage,
+outcome) served on /metrics; token, byte and cache-hit attributes also feed counters. Spans
+opened while a trace is active (see trace()) are collected for that request, including those
+of tasks it spawns, since the trace lives in a contextvar. With OTEL_EXPORTER=console|otlp and
+the OpenTelemetry SDK installed, spans are exported there too.
+"""
+
+log = get_logger(__name__)
+
+TRACING_ENABLED = os.getenv("TRACING_ENABLED", "1") == "1"
+# "console" prints finished spans; "otlp" sends them to OTEL_EXPORTER_OTLP_ENDPOINT (a local collector)
+OTEL_EXPORTER = os.getenv("OTEL_EXPORTER", "")
+
+# Vision OCR and rate searches take seconds; cache hits take microseconds
+STAGE_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40, 80, 160)
+
+try:
+    import prometheus_client
+    from prometheus_client import Counter, Gauge, Histogram
+
+    STAGE_SECONDS = Histogram(
+        "advocare_stage_duration_seconds", "Duration of one analysis stage",
+        ["stage", "outcome"], buckets=STAGE_BUCKETS
+    )
+    STAGE_TOKENS = Counter("advocare_stage_tokens_total", "LLM tokens used per stage", ["stage", "kind"])
+    STAGE_BYTES = Counter("advocare_stage_bytes_total", "Bytes processed per stage", ["stage"])
+    CACHE_LOOKUPS = Counter("advocare_cache_lookups_total", "Cache lookups per stage", ["stage", "result"])
+    JOB_QUEUE_DEPTH = Gauge("advocare_job_queue_depth", "Jobs waiting in the analysis queue")
+    JOB_QUEUE_RUNNING = Gauge("advocare_job_queue_running", "Jobs being run by workers")
+except ImportError:
+    prometheus_client = None
+
+_tracer = None
+if OTEL_EXPORTER:
+    try:
+        from opentelemetry import trace as otel_trace
+        from opentelemetry.sdk.resources import Resource
+        from opentelemetry.sdk.trace import TracerProvider
+        from opentelemetry.sdk.trace.export import BatchSpanProcessor, ConsoleSpanExporter
+
+        if OTEL_EXPORTER == "otlp":
+            from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+            exporter = OTLPSpanExporter()
+        else:
+            exporter = ConsoleSpanExporter()
+        provider = TracerProvider(resource=Resource.create({"service.name": "advocare-backend"}))
+        provider.add_span_processor(BatchSpanProcessor(exporter))
+        otel_trace.set_tracer_provider(provider)
+        _tracer = otel_trace.get_tracer("advocare")
+    except Exception as e:
+        log.warning("OpenTelemetry export disabled", error=str(e))
+
+
+class Span:
+    def __init__(self, stage: str, parent: Optional["Span"], attributes: Dict[str, Any]):
+        self.stage = stage
+        self.parent = parent
+        self.attributes = attributes
+        self.outcome = "ok"
+        self.started = time.perf_counter()
+        self.duration = 0.0
+        self._otel = None
+
+    def set(self, **attributes) -> None:
+        self.attributes.update(attributes)
+
+    def to_dict(self, trace_started: float) -> Dict[str, Any]:
+        return {
+            "stage": self.stage,
+            "parent": self.parent.stage if self.parent else None,
+            "start_ms": round((self.started - trace_started) * 1000, 1),
+            "duration_ms": round(self.duration * 1000, 1),
+            "outcome": self.outcome,
+            **self.attributes,
+        }
+
+
+class Trace:
+    def __init__(self, name: str):
+        self.name = name
+        self.started = time.perf_counter()
+        self.spans: List[Span] = []
+
+    def summary(self) -> Dict[str, Any]:
+        """Time per stage (summed over pages/attempts) plus every span, for one log line"""
+        stages: Dict[str, Dict[str, float]] = {}
+        for finished in self.spans:
+            totals = stages.setdefault(finished.stage, {"count": 0, "total_ms": 0.0})
+            totals["count"] += 1
+            totals["total_ms"] = round(totals["total_ms"] + finished.duration * 1000, 1)
+        return {
+            "trace": self.name,
+            "duration_ms": round((time.perf_counter() - self.started) * 1000, 1),
+            "stages": stages,
+            "spans": [finished.to_dict(self.started) for finished in self.spans],
+        }
+
+
+_current_trace: contextvars.ContextVar[Optional[Trace]] = contextvars.ContextVar("trace", default=None)
+_current_span: contextvars.ContextVar[Optional[Span]] = contextvars.ContextVar("span", default=None)
+
+
+def _reset(var: contextvars.ContextVar, token) -> None:
+    # A streaming response closed from another task exits its spans in a different context
+    try:
+        var.reset(token)
+    except ValueError:
+        pass
+
+
+def _record(finished: Span) -> None:
+    if prometheus_client is None:
+        return
+    STAGE_SECONDS.labels(finished.stage, finished.outcome).observe(finished.duration)
+    attributes = finished.attributes
+    for kind in ("input_tokens", "output_tokens"):
+        if attributes.get(kind):
+            STAGE_TOKENS.labels(finished.stage, kind.split("_")[0]).inc(attributes[kind])
+    if attributes.get("bytes"):
+        STAGE_BYTES.labels(finished.stage).inc(attributes["bytes"])
+    if "cache_hit" in attributes:
+        CACHE_LOOKUPS.labels(finished.stage, "hit" if attributes["cache_hit"] else "miss").inc()
+    if "hits" in attributes:
+        CACHE_LOOKUPS.labels(finished.stage, "hit").inc(attributes["hits"])
+        CACHE_LOOKUPS.labels(finished.stage, "miss").inc(attributes.get("misses", 0))
+
+
+@contextmanager
+def span(stage: str, **attributes):
+    """Time one stage; an exception leaving the block marks the span's outcome as "error" """
+    if not TRACING_ENABLED:
+        yield Span(stage, None, attributes)
+        return
+    current = Span(stage, _current_span.get(), attributes)
+    token = _current_span.set(current)
+    otel_context = _tracer.start_as_current_span(stage) if _tracer is not None else None
+    if otel_context is not None:
+        current._otel = otel_context.__enter__()
+    try:
+        yield current
+    except BaseException as e:
+        current.outcome = "cancelled" if isinstance(e, (asyncio.CancelledError, GeneratorExit)) else "error"
+        current.set(error=str(e) or type(e).__name__)
+        raise
+    finally:
+        current.duration = time.perf_counter() - current.started
+        _reset(_current_span, token)
+        trace_ = _current_trace.get()
+        if trace_ is not None:
+            trace_.spans.append(current)
+        _record(current)
+        if otel_context is not None:
+            current._otel.set_attribute("outcome", current.outcome)
+            for key, value in current.attributes.items():
+                if isinstance(value, (str, bool, int, float)):
+                    current._otel.set_attribute(key, value)
+            otel_context.__exit__(None, None, None)
+
+
+@contextmanager
+def trace(name: str, **attributes):
+    """Start collecting spans for one request or job; the whole of it is a span too"""
+    current = Trace(name)
+    token = _current_trace.set(current)
+    try:
+        with span(name, **attributes) as root:
+            yield current, root
+    finally:
+        _reset(_current_trace, token)
+
+
+def annotate(**attributes) -> None:
+    """Add attributes to the innermost open span, e.g. token counts from the LLM client"""
+    current = _current_span.get()
+    if current is not None:
+        current.set(**attributes)
+
+
+def metrics_payload(queue_stats: Optional[Dict[str, Any]] = None):
+    """(body, content type) for /metrics, or None without prometheus_client"""
+    if prometheus_client is None:
+        return None
+    if queue_stats:
+        JOB_QUEUE_DEPTH.set(queue_stats.get("depth", 0))
+        JOB_QUEUE_RUNNING.set(queue_stats.get("running", 0))
+    return prometheus_client.generate_latest(), prometheus_client.CONTENT_TYPE_LATEST
@@ -0,0 +1,162 @@
+# app/worker.py
+import argparse
+import asyncio
+import os
+import signal
+import socket
+from typing import List, Optional
+from dotenv import load_dotenv
+from app.services.bill_analyzer import analyze_uploads, PermanentAnalysisError
+from app.services.database import load_all as load_reference_data
+from app.services.jobs import job_queue, decode_payload, JOB_LEASE_RENEW_SECONDS
+from app.services.perplexity import perplexity_service
+from app.services.preprocess import shutdown_executor
+from app.services.tokens import start_request_budget, get_encoder
+from app.services.tracing import trace
+from app.services.log import get_logger, set_request_id, reset_request_id
+
+"""
+Worker for queued analyses (POST /api/jobs). Each worker process runs JOB_WORKER_CONCURRENCY
+jobs at a time; run as many processes as the queue needs, independently of the web tier.
+
+    python -m app.worker [--concurrency 2]
+
+The web app can also run workers in-process (JOB_INPROCESS_WORKERS=n), e.g. on a single box.
+"""
+
+load_dotenv()
+
+log = get_logger(__name__)
+
+JOB_WORKER_CONCURRENCY = int(os.getenv("JOB_WORKER_CONCURRENCY", "2"))
+JOB_INPROCESS_WORKERS = int(os.getenv("JOB_INPROCESS_WORKERS", "0"))
+# How long an idle worker waits before polling the queue again
+JOB_POLL_INTERVAL_SECONDS = float(os.getenv("JOB_POLL_INTERVAL_SECONDS", "1"))
+
+
+async def run_job(job) -> None:
+    payload = decode_payload(job["payload"])
+    # Each job gets its own token budget, like a request to /api/analyze
+    budget = start_request_budget()
+    try:
+        with trace("job", attempt=int(job["attempts"])) as (job_trace, _):
+            analysis_result = await analyze_uploads(payload["uploads"], payload["location"], payload["zip_code"])
+    except Exception as e:
+        # An exhausted budget or unreadable bill fails the same way on every attempt; don't retry it
+        status = await job_queue.fail(job, str(e), retry=not isinstance(e, PermanentAnalysisError))
+        log.error("Job failed", attempt=int(job["attempts"]), status=status or "lease lost", error=str(e))
+        return
+    if not await job_queue.complete(job, {"analysis": analysis_result, "tokens": budget.summary()}):
+        log.warning("Job result dropped; its lease was taken over", attempt=int(job["attempts"]))
+        return
+    summary = job_trace.summary()
+    log.info("Job done", duration_ms=summary["duration_ms"], stages=summary["stages"], tokens=budget.spent)
+    log.debug("Job spans", spans=summary["spans"])
+
+
+async def renew_lease(job, running: asyncio.Task) -> None:
+    """Keep a running job's lease alive; cancel the job once another worker has taken it over"""
+    while not running.done():
+        await asyncio.sleep(JOB_LEASE_RENEW_SECONDS)
+        try:
+            renewed = await job_queue.renew(job)
+        except Exception as e:
+            # Transient; the lease only lapses after several missed renewals
+            log.warning("Job lease renewal error", error=str(e))
+            continue
+        if not renewed:
+            log.warning("Job lease lost; abandoning the job", attempt=int(job["attempts"]))
+            running.cancel()
+            return
+
+
+class Worker:
+    def __init__(self, concurrency: int = JOB_WORKER_CONCURRENCY, name: Optional[str] = None):
+        self.concurrency = concurrency
+        self.name = name or f"{socket.gethostname()}:{os.getpid()}"
+        self._stopping = asyncio.Event()
+        self._tasks: List[asyncio.Task] = []
+
+    async def _slot(self, slot: int) -> None:
+        worker = f"{self.name}/{slot}"
+        while not self._stopping.is_set():
+            try:
+                job = await job_queue.claim(worker)
+            except Exception as e:
+                log.error("Job queue claim error", error=str(e))
+                job = None
+            if job is None:
+                try:
+                    await asyncio.wait_for(self._stopping.wait(), JOB_POLL_INTERVAL_SECONDS)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            # Log lines of a job carry its id, like a request's carry the request id
+            token = set_request_id(job["id"])
+            running = asyncio.create_task(run_job(job))
+            heartbeat = asyncio.create_task(renew_lease(job, running))
+            try:
+                await running
+            except asyncio.CancelledError:
+                if not heartbeat.done():
+                    raise  # the worker itself is being cancelled
+            except Exception as e:
+                # Storing the result failed; the lease expiry hands the job to another worker
+                log.error("Job result could not be recorded", error=str(e))
+            finally:
+                heartbeat.cancel()
+                reset_request_id(token)
+
+    def start(self) -> None:
+        self._tasks = [asyncio.create_task(self._slot(slot)) for slot in range(self.concurrency)]
+        log.info("Job worker started", worker=self.name, slots=self.concurrency)
+
+    async def stop(self) -> None:
+        """Stop claiming jobs and let the running ones finish"""
+        self._stopping.set()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+
+_inprocess_worker: Optional[Worker] = None
+
+
+def start_inprocess_workers() -> None:
+    global _inprocess_worker
+    if JOB_INPROCESS_WORKERS and _inprocess_worker is None:
+        _inprocess_worker = Worker(JOB_INPROCESS_WORKERS)
+        _inprocess_worker.start()
+
+
+async def stop_inprocess_workers() -> None:
+    global _inprocess_worker
+    if _inprocess_worker is not None:
+        await _inprocess_worker.stop()
+        _inprocess_worker = None
+
+
+async def _main(concurrency: int) -> None:
+    await asyncio.to_thread(load_reference_data)
+    await asyncio.to_thread(get_encoder)
+    perplexity_service.cache_service.start_write_behind()
+
+    worker = Worker(concurrency)
+    loop = asyncio.get_running_loop()
+    stopped = asyncio.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stopped.set)
+    worker.start()
+    await stopped.wait()
+
+    log.info("Job worker stopping; finishing running jobs", worker=worker.name)
+    await worker.stop()
+    await perplexity_service.cache_service.stop_write_behind()
+    shutdown_executor()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run queued bill analyses")
+    parser.add_argument("--concurrency", type=int, default=JOB_WORKER_CONCURRENCY,
+                        help="Jobs this process runs at a time")
+    args = parser.parse_args()
+    asyncio.run(_main(args.concurrency))
@@ -0,0 +1,88 @@
+"""
+Peak memory of PDF rasterization: all pages at once vs page-at-a-time.
+
+Builds a synthetic multi-page PDF from a sample bill (or uses --pdf) and rasterizes it in a
+fresh subprocess per mode, reporting wall time and peak RSS (ru_maxrss) of that process.
+Requires poppler (pdftoppm/pdfinfo) on PATH.
+
+Usage (from backend/):
+    python benchmarks/bench_pdf_memory.py --pages 40 --dpi 200
+"""
+import argparse
+import json
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+
+from PIL import Image
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+
+CHILD = r"""
+import asyncio, json, resource, sys, time
+sys.path.insert(0, {backend!r})
+mode, pdf_path, dpi, grayscale = sys.argv[1], sys.argv[2], int(sys.argv[3]), sys.argv[4] == "1"
+data = open(pdf_path, "rb").read()
+start = time.perf_counter()
+pages = 0
+if mode == "all-at-once":
+    import io
+    from pdf2image import convert_from_bytes
+    images = convert_from_bytes(data, dpi=dpi, grayscale=grayscale)
+    pngs = []
+    for image in images:
+        buffer = io.BytesIO()
+        image.save(buffer, format="PNG")
+        pngs.append(buffer.getvalue())
+    pages = len(pngs)
+else:
+    from app.services.pdf import rasterize_pdf_pages
+    async def consume():
+        count = 0
+        async for _, png in rasterize_pdf_pages(data, dpi=dpi, max_pages=10**6, grayscale=grayscale):
+            count += 1
+        return count
+    pages = asyncio.run(consume())
+elapsed = time.perf_counter() - start
+peak_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+if sys.platform == "darwin":
+    peak_kb //= 1024
+print(json.dumps({{"pages": pages, "seconds": elapsed, "peak_rss_mb": peak_kb / 1024}}))
+"""
+
+
+def build_pdf(image_path: Path, pages: int, out_path: Path) -> None:
+    page = Image.open(image_path).convert("RGB")
+    page.save(out_path, format="PDF", save_all=True, append_images=[page] * (pages - 1), resolution=100)
+
+
+def run_mode(mode: str, pdf_path: Path, dpi: int, grayscale: bool) -> dict:
+    script = CHILD.format(backend=str(BACKEND_DIR))
+    output = subprocess.run(
+        [sys.executable, "-c", script, mode, str(pdf_path), str(dpi), "1" if grayscale else "0"],
+        check=True, capture_output=True, text=True
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        pdf_path = Path(args.pdf) if args.pdf else Path(tmp) / "bill.pdf"
+        if not args.pdf:
+            build_pdf(Path(args.image), args.pages, pdf_path)
+        print(f"{pdf_path.name}: {pdf_path.stat().st_size} bytes, dpi={args.dpi}, grayscale={args.grayscale}")
+        print(f"{'mode':<14} {'pages':>6} {'seconds':>8} {'peak RSS MB':>12}")
+        for mode in ("all-at-once", "streaming"):
+            r = run_mode(mode, pdf_path, args.dpi, args.grayscale)
+            print(f"{mode:<14} {r['pages']:>6} {r['seconds']:>8.2f} {r['peak_rss_mb']:>12.1f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare PDF rasterization peak memory")
+    parser.add_argument("--pdf", help="existing PDF to rasterize instead of a synthetic one")
+    parser.add_argument("--image", default=str(BACKEND_DIR / "databases" / "MedicalBill.jpeg"))
+    parser.add_argument("--pages", type=int, default=40)
+    parser.add_argument("--dpi", type=int, default=200)
+    parser.add_argument("--grayscale", action="store_true")
+    main(parser.parse_args())
@@ -0,0 +1,83 @@
+"""
+Micro-benchmark for OCR image preprocessing.
+
+Reports per-stage latency for the preprocessing pipeline and end-to-end images/sec
+inline, in a thread pool and in a process pool.
+
+Usage (from backend/):
+    python benchmarks/bench_preprocess.py --images databases/MedicalBill.jpeg --repeat 5
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import get_context
+from pathlib import Path
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(BACKEND_DIR))
+
+from app.services import preprocess  # noqa: E402
+
+STAGES = [
+    ("decode", lambda data: preprocess.decode(data)),
+    ("resize", preprocess.resize),
+    ("grayscale", preprocess.grayscale),
+    ("threshold", preprocess.threshold),
+    ("denoise", preprocess.denoise),
+    ("contrast", preprocess.contrast),
+    ("encode_png", preprocess.encode_png),
+]
+
+
+def time_stages(data: bytes, repeat: int) -> dict:
+    timings = {name: [] for name, _ in STAGES}
+    for _ in range(repeat):
+        value = data
+        for name, stage in STAGES:
+            start = time.perf_counter()
+            value = stage(value)
+            timings[name].append(time.perf_counter() - start)
+    return {name: statistics.median(values) for name, values in timings.items()}
+
+
+def throughput(executor_factory, images: list, workers: int) -> float:
+    with executor_factory(workers) as executor:
+        # Warm the workers so spawn/import cost is not counted
+        list(executor.map(preprocess.preprocess_image_sync, images[:workers]))
+        start = time.perf_counter()
+        list(executor.map(preprocess.preprocess_image_sync, images))
+        return len(images) / (time.perf_counter() - start)
+
+
+def main(args):
+    paths = [Path(p) for p in args.images]
+    for path in paths:
+        data = path.read_bytes()
+        stages = time_stages(data, args.repeat)
+        total = sum(stages.values())
+        print(f"\n{path.name} ({len(data)} bytes)")
+        for name, seconds in stages.items():
+            print(f"  {name:<11} {seconds * 1000:8.1f} ms  ({seconds / total * 100:4.1f}%)")
+        print(f"  {'total':<11} {total * 1000:8.1f} ms  -> {1 / total:.2f} images/sec inline")
+
+    images = [p.read_bytes() for p in paths] * args.batch
+    workers = args.workers
+    print(f"\nThroughput over {len(images)} images, {workers} workers:")
+    start = time.perf_counter()
+    for image in images:
+        preprocess.preprocess_image_sync(image)
+    print(f"  inline        {len(images) / (time.perf_counter() - start):6.2f} images/sec")
+    print(f"  thread pool   {throughput(lambda n: ThreadPoolExecutor(n), images, workers):6.2f} images/sec")
+    print(f"  process pool  {throughput(lambda n: ProcessPoolExecutor(n, mp_context=get_context('spawn')), images, workers):6.2f} images/sec")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark OCR image preprocessing")
+    parser.add_argument("--images", nargs="+", default=[str(BACKEND_DIR / "databases" / "MedicalBill.jpeg")])
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--batch", type=int, default=8, help="copies of each image for the throughput run")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    main(parser.parse_args())
@@ -0,0 +1,115 @@
+"""
+Compare OCR preprocessing presets.
+
+For each preset in app.services.preprocess.PRESETS, reports median latency, output PNG size
+and the estimated Claude image tokens (width * height / 750). With --ocr it also sends each
+preprocessed image to the vision model and scores the extraction against a reference OCR
+result (line items matched on cost, plus codes found).
+
+Usage (from backend/):
+    python benchmarks/bench_presets.py
+    python benchmarks/bench_presets.py --ocr --reference saved_ocr_result.json   # needs ANTHROPIC_API_KEY
+"""
+import argparse
+import asyncio
+import json
+import re
+import statistics
+import sys
+import time
+from io import BytesIO
+from pathlib import Path
+
+from PIL import Image
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(BACKEND_DIR))
+
+from app.services import preprocess  # noqa: E402
+
+CODE_PATTERN = re.compile(r"\b(\d{4}[0-9A-Z]|[A-V]\d{4})\b")
+
+
+def line_items(ocr_result: dict) -> list:
+    return ocr_result.get("extracted_text", {}).get("billing_details", {}).get("procedure_codes", [])
+
+
+def score(reference: dict, candidate: dict) -> dict:
+    """Fraction of reference costs and codes that the candidate extraction recovered"""
+    def costs(result):
+        values = []
+        for item in line_items(result):
+            try:
+                values.append(round(float(str(item.get("cost", 0)).replace("$", "").replace(",", "")), 2))
+            except ValueError:
+                continue
+        return values
+
+    def codes(result):
+        found = set()
+        for item in line_items(result):
+            found.update(CODE_PATTERN.findall(str(item.get("code", ""))))
+        return found
+
+    ref_costs, cand_costs = costs(reference), costs(candidate)
+    remaining = list(cand_costs)
+    matched = 0
+    for cost in ref_costs:
+        if cost in remaining:
+            remaining.remove(cost)
+            matched += 1
+    ref_codes = codes(reference)
+    return {
+        "cost_recall": matched / len(ref_costs) if ref_costs else 0.0,
+        "code_recall": len(ref_codes & codes(candidate)) / len(ref_codes) if ref_codes else 0.0,
+    }
+
+
+def bench_preset(data: bytes, preset: str, repeat: int) -> dict:
+    timings = []
+    output = b""
+    for _ in range(repeat):
+        start = time.perf_counter()
+        output = preprocess.preprocess_image_sync(data, preset)
+        timings.append(time.perf_counter() - start)
+    width, height = Image.open(BytesIO(output)).size
+    return {
+        "preset": preset,
+        "latency": statistics.median(timings),
+        "bytes": len(output),
+        "image_tokens": int(width * height / 750),
+        "output": output,
+    }
+
+
+async def ocr_scores(results: list, reference: dict) -> None:
+    from app.services.ocr import _extract_from_image
+    for result in results:
+        extraction = await _extract_from_image(result["output"], "image/png", 3)
+        result.update(score(reference, extraction))
+
+
+def main(args):
+    data = Path(args.image).read_bytes()
+    results = [bench_preset(data, preset, args.repeat) for preset in preprocess.PRESETS]
+
+    if args.ocr:
+        reference = json.loads(Path(args.reference).read_text())
+        asyncio.run(ocr_scores(results, reference))
+
+    print(f"{Path(args.image).name}: {len(data)} bytes in")
+    print(f"{'preset':<12} {'latency ms':>10} {'png bytes':>10} {'img tokens':>10} {'cost rec':>9} {'code rec':>9}")
+    for r in results:
+        cost_recall = f"{r['cost_recall']:.2f}" if "cost_recall" in r else "-"
+        code_recall = f"{r['code_recall']:.2f}" if "code_recall" in r else "-"
+        print(f"{r['preset']:<12} {r['latency'] * 1000:>10.1f} {r['bytes']:>10} {r['image_tokens']:>10} "
+              f"{cost_recall:>9} {code_recall:>9}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare OCR preprocessing presets")
+    parser.add_argument("--image", default=str(BACKEND_DIR / "databases" / "MedicalBill.jpeg"))
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--ocr", action="store_true", help="also score OCR accuracy (calls the Anthropic API)")
+    parser.add_argument("--reference", default=str(BACKEND_DIR / "saved_ocr_result.json"))
+    main(parser.parse_args())
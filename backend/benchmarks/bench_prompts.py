@@ -0,0 +1,111 @@
+"""
+Compare prompt sizes before and after the compact payloads in app/services/prompts.py.
+
+For a saved OCR result, builds the rate search prompt and the explanation report the way
+they used to be built (the whole OCR output / str(dict) dumps) and the compact versions
+(JSON and table item formats), and reports tokens and characters for each.
+
+Usage (from backend/):
+    python benchmarks/bench_prompts.py [--fixture saved_ocr_result.json]
+"""
+import argparse
+import asyncio
+import json
+import sys
+from pathlib import Path
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(BACKEND_DIR))
+
+from app.services.bill_analyzer import code_validation  # noqa: E402
+from app.services.database import load_all  # noqa: E402
+from app.services.pricing import price_procedures  # noqa: E402
+from app.services.prompts import build_explanation_report, build_rate_search_messages, PROMPT_ITEM_FORMAT  # noqa: E402
+from app.services import prompts  # noqa: E402
+from app.services.tokens import count_message_tokens, count_text_tokens  # noqa: E402
+
+# The rate search prompt as it was built before prompts.py (whole bill interpolated)
+LEGACY_RATE_PROMPT = '''Analyze rates for: {input_text}
+
+                        Return ONLY this JSON structure:
+                        {{
+                            "ucr_validation": {{
+                                "procedure_analysis": [
+                                    {{
+                                        "code": "exact code from input",
+                                        "description": "exact description from input",
+                                        "billed_cost": number (2 decimal places),
+                                        "standardized_rate": number (2 decimal places),
+                                        "sources": ["source used"]
+                                    }}
+                                ]
+                            }}
+                        }}
+
+                        STRICT RULES:
+                        1. ONLY output valid JSON
+                        2. NO text outside JSON structure
+                        3. Search Standardized / Usual Customary & Reasonable (UCR) Rates in this order: Medicare RVU → NC Medicaid → BetterCare → FAIR Health → Regional etc
+                        4. Location: Los Angeles, CA
+                        5. Codes are either of type CPT (5 digits) or HCPCS (first character is a letter, followed by 4 digits)
+                        6. ALL costs must be numbers
+                        7. For each procedure in the input:
+                           - Include ALL sources used in the sources array
+                           - If standardized_rate is None, 0 or 0.0, do not include the code, description, billed_cost, standardized_rate or sources for that procedure
+                        8. The procedure_analysis array should ONLY contain procedures with valid averaged rates from multiple sources
+                        9. CRITICAL: Do not make up any data
+                        '''
+
+
+def legacy_explanation_report(results) -> str:
+    report = "Explanation Summary:\n"
+    for result in results:
+        for key, value in result.items():
+            report += f"{key}: {value}\n"
+    return report
+
+
+def row(name: str, text_tokens: int, chars: int, baseline: int) -> None:
+    saved = 100 * (1 - text_tokens / baseline) if baseline else 0.0
+    print(f"  {name:<28} {text_tokens:>7} tokens {chars:>8} chars   {saved:5.1f}% fewer tokens")
+
+
+async def main(fixture: Path) -> None:
+    load_all()
+    ocr_result = json.loads(fixture.read_text())
+    bill = ocr_result["extracted_text"]
+    procedures = bill["billing_details"]["procedure_codes"]
+
+    print(f"{fixture.name}: {len(procedures)} line items")
+
+    print("Rate search prompt")
+    legacy = [
+        {"role": "system", "content": prompts.RATE_SEARCH_SYSTEM_PROMPT},
+        {"role": "user", "content": LEGACY_RATE_PROMPT.format(input_text=bill)},
+    ]
+    baseline = count_message_tokens(legacy)
+    row("legacy (whole OCR output)", baseline, sum(len(m["content"]) for m in legacy), baseline)
+    for item_format in ("json", "table"):
+        prompts.PROMPT_ITEM_FORMAT = item_format
+        messages = build_rate_search_messages(procedures, "Los Angeles, CA")
+        row(f"compact ({item_format})", count_message_tokens(messages), sum(len(m["content"]) for m in messages), baseline)
+
+    print("Explanation report")
+    code_result = await code_validation(bill)
+    priced, _ = price_procedures(procedures)
+    ucr_result = {"ucr_validation": json.dumps({"ucr_validation": {"procedure_analysis": priced}})}
+    legacy_report = legacy_explanation_report([code_result, ucr_result])
+    baseline = count_text_tokens(legacy_report)
+    row("legacy (str(dict) dumps)", baseline, len(legacy_report), baseline)
+    for item_format in ("json", "table"):
+        prompts.PROMPT_ITEM_FORMAT = item_format
+        report = build_explanation_report(code_result, ucr_result)
+        row(f"compact ({item_format})", count_text_tokens(report), len(report), baseline)
+    prompts.PROMPT_ITEM_FORMAT = PROMPT_ITEM_FORMAT
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--fixture", type=Path, default=BACKEND_DIR / "saved_ocr_result.json")
+    args = parser.parse_args()
+    asyncio.run(main(args.fixture))
@@ -1,27 +1,59 @@
-import pandas as pd
+"""
+Build the Medicare rate data from the OPPS addenda.
 
-# Read the CSV files
-addendum_a = pd.read_csv('addendum_a.csv')
-addendum_b = pd.read_csv('addendum_b.csv')
+Writes:
+  medicare_rates.v<N>.npy  one row per HCPCS code with numeric rates (cents), sorted by code,
+                           loaded by app/services/pricing.py with np.load(mmap_mode="r")
+  code_index.v<N>.npy      every CPT/HCPCS code, sorted, loaded by app/services/code_index.py
+  *.descriptions.npy       next to each of the above: its full UTF-8 descriptions
+  medicare_rates.csv       (with --csv) the grouped-by-APC text export used by database.py
 
-# Merge the datasets on the APC column
-merged_data = pd.merge(addendum_a, addendum_b, on='APC', how='inner')
+Run from anywhere (it is also part of the deploy build step):
+    python databases/map.py [--csv]
+"""
+import csv
+import sys
+from collections import OrderedDict
+from pathlib import Path
 
-# Group the data by APC and aggregate HCPCS Codes, Descriptions, and Payment Rates
-grouped_data = merged_data.groupby('APC').agg({
-    'HCPCS Code': lambda x: '; '.join(x),
-    'Short Descriptor': lambda x: '; '.join(x),
-    'Payment Rate': 'first'  # Assuming Payment Rate is the same for each APC
-}).reset_index()
+DATABASES_DIR = Path(__file__).resolve().parent
+sys.path.insert(0, str(DATABASES_DIR.parent))
 
-# Rename the columns to match final requirements
-grouped_data = grouped_data.rename(columns={'Short Descriptor': 'Description'})
+from app.services.pricing import build_rate_records, rate_artifact  # noqa: E402
+from app.services.code_index import build_code_records, code_artifact  # noqa: E402
+from app.services.database import hcpcs_table, apc_table  # noqa: E402
 
-# Reorder columns to desired order
-final_data = grouped_data[['APC', 'HCPCS Code', 'Description', 'Payment Rate']]
 
-# Save the final merged data to a new CSV file
-final_data.to_csv('medicare_rates.csv', index=False)
+def write_grouped_csv() -> int:
+    # Inner join of addendum B and addendum A on APC, grouped by APC
+    grouped = OrderedDict()
+    apcs = apc_table.records()
+    for code, record in hcpcs_table.records().items():
+        if record.apc in apcs:
+            group = grouped.setdefault(record.apc, {"codes": [], "descriptions": []})
+            group["codes"].append(code)
+            group["descriptions"].append(record.description)
 
-# Print the final grouped data
-print(final_data)
\ No newline at end of file
+    with open(DATABASES_DIR / "medicare_rates.csv", "w", newline="") as file:
+        writer = csv.writer(file)
+        writer.writerow(["APC", "HCPCS Code", "Description", "Payment Rate"])
+        for apc in sorted(grouped, key=int):
+            writer.writerow([
+                apc,
+                "; ".join(grouped[apc]["codes"]),
+                "; ".join(grouped[apc]["descriptions"]),
+                apcs[apc].payment_rate
+            ])
+    return len(grouped)
+
+
+if __name__ == "__main__":
+    for artifact, build in ((rate_artifact, build_rate_records), (code_artifact, build_code_records)):
+        records, descriptions = build()
+        # Each file is written to a temp file and renamed, so running workers never load a half-written one
+        artifact.write(records, descriptions)
+        size = artifact.path.stat().st_size + artifact.descriptions_path.stat().st_size
+        print(f"Wrote {artifact.path.name}: {len(records)} codes, {size} bytes")
+    if "--csv" in sys.argv[1:]:
+        groups = write_grouped_csv()
+        print(f"Wrote medicare_rates.csv: {groups} APC groups")
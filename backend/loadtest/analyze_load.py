@@ -0,0 +1,111 @@
+"""
+Load test for /api/analyze.
+
+Fires requests at increasing concurrency levels against a running backend and reports
+throughput and latency per level, so we can check that throughput scales with
+concurrency instead of serialising behind one blocked event loop.
+
+Usage (from backend/):
+    uvicorn app.main:app --port 10000 &
+    python loadtest/analyze_load.py --url http://localhost:10000 --levels 1,2,4,8 --requests 16
+"""
+import argparse
+import asyncio
+import statistics
+import time
+from pathlib import Path
+
+import httpx
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+DEFAULT_BILL = BACKEND_DIR / "databases" / "MedicalBill.jpeg"
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100 * len(ordered))) - 1))
+    return ordered[index]
+
+
+async def send_one(client, url, filename, bill_bytes, content_type):
+    files = {"files": (filename, bill_bytes, content_type)}
+    data = {"firstName": "Load", "lastName": "Test", "dateOfBirth": "1990-01-01"}
+    start = time.perf_counter()
+    response = await client.post(url, files=files, data=data)
+    latency = time.perf_counter() - start
+    # A failed analysis can also come back as 200 with a null "analysis"
+    try:
+        ok = response.status_code == 200 and response.json().get("analysis") is not None
+    except ValueError:
+        ok = False
+    return latency, ok
+
+
+async def run_level(url, filename, bill_bytes, content_type, concurrency, total_requests, timeout):
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    errors = 0
+
+    async with httpx.AsyncClient(timeout=timeout) as client:
+        async def worker():
+            nonlocal errors
+            async with semaphore:
+                try:
+                    latency, ok = await send_one(client, url, filename, bill_bytes, content_type)
+                    latencies.append(latency)
+                    if not ok:
+                        errors += 1
+                except httpx.HTTPError:
+                    errors += 1
+
+        start = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(total_requests)))
+        elapsed = time.perf_counter() - start
+
+    return {
+        "concurrency": concurrency,
+        "requests": total_requests,
+        "errors": errors,
+        "elapsed": elapsed,
+        "throughput": total_requests / elapsed if elapsed else 0.0,
+        "p50": percentile(latencies, 50),
+        "p95": percentile(latencies, 95),
+        "p99": percentile(latencies, 99),
+        "mean": statistics.mean(latencies) if latencies else 0.0,
+    }
+
+
+def print_report(results):
+    print(f"{'conc':>5} {'reqs':>5} {'errs':>5} {'req/s':>8} {'p50 s':>8} {'p95 s':>8} {'p99 s':>8}")
+    for r in results:
+        print(f"{r['concurrency']:>5} {r['requests']:>5} {r['errors']:>5} {r['throughput']:>8.2f} "
+              f"{r['p50']:>8.2f} {r['p95']:>8.2f} {r['p99']:>8.2f}")
+
+
+async def main(args):
+    bill_path = Path(args.bill)
+    bill_bytes = bill_path.read_bytes()
+    content_type = "application/pdf" if bill_path.suffix.lower() == ".pdf" else "image/jpeg"
+    url = args.url.rstrip("/") + "/api/analyze"
+
+    results = []
+    for level in [int(x) for x in args.levels.split(",")]:
+        total = max(args.requests, level)
+        result = await run_level(url, bill_path.name, bill_bytes, content_type, level, total, args.timeout)
+        results.append(result)
+        print(f"concurrency={level}: {result['throughput']:.2f} req/s, p95={result['p95']:.2f}s")
+
+    print_report(results)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test /api/analyze")
+    parser.add_argument("--url", default="http://localhost:10000")
+    parser.add_argument("--bill", default=str(DEFAULT_BILL))
+    parser.add_argument("--levels", default="1,2,4,8")
+    parser.add_argument("--requests", type=int, default=16, help="requests per concurrency level")
+    parser.add_argument("--timeout", type=float, default=300.0)
+    asyncio.run(main(parser.parse_args()))
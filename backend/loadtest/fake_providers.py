@@ -0,0 +1,294 @@
+"""
+Local stand-ins for the Anthropic messages API, the Perplexity chat-completions API and the
+Supabase REST API, so /api/analyze can be load tested without paying for real calls.
+
+Each fake answers with canned responses after a configurable latency, and fails a
+configurable fraction of LLM calls the way the real API does (529 overloaded / 500), so the
+SDKs' retries are exercised too:
+
+- Anthropic: vision (OCR) requests get the bill in saved_ocr_result.json, text requests get
+  a canned explanation.
+- Perplexity: every code in the prompt's item list gets a deterministic rate, except a
+  --no-rate-fraction share of codes, which it finds no rate for.
+- Supabase: an in-memory standardized_rates table (select with in/eq/lt/lte/gte filters and order, upsert).
+
+Point the backend at them with ANTHROPIC_BASE_URL, PERPLEXITY_BASE_URL and SUPABASE_URL;
+run_offline.py does this for you. To run them by hand (from backend/):
+    python loadtest/fake_providers.py --port 8900
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import operator
+import random
+import re
+import time
+import uuid
+from collections import defaultdict
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from aiohttp import web
+
+# PostgREST comparison filters, applied to the values as strings (ISO timestamps sort as text)
+COMPARISONS = {"lt": operator.lt, "lte": operator.le, "gt": operator.gt, "gte": operator.ge}
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+DEFAULT_OCR_RESPONSE = BACKEND_DIR / "saved_ocr_result.json"
+# Shape of a valid Supabase anon key; the client rejects anything else
+FAKE_SUPABASE_KEY = "fake.supabase.key"
+
+DEFAULT_EXPLANATION = {
+    "summary": "Two procedures are billed well above typical rates.",
+    "code_validation": {"overcharge": "Yes", "amount": "120.00", "details": ["Office visit billed above the standard range"]},
+    "ucr_validation": {"procedure_analysis": [], "references": ["Fake Medicare RVU"]},
+    "recommendations": ["Ask the provider for an itemized bill"],
+}
+
+
+class ProviderConfig:
+    def __init__(self, latency_ms: float, jitter: float = 0.2, error_rate: float = 0.0):
+        self.latency_ms = latency_ms
+        self.jitter = jitter
+        self.error_rate = error_rate
+
+    async def delay(self) -> None:
+        if self.latency_ms > 0:
+            spread = self.latency_ms * self.jitter
+            await asyncio.sleep(max(0.0, random.uniform(self.latency_ms - spread, self.latency_ms + spread)) / 1000)
+
+    def should_fail(self) -> bool:
+        return self.error_rate > 0 and random.random() < self.error_rate
+
+
+class FakeProviders:
+    def __init__(self, anthropic: ProviderConfig, perplexity: ProviderConfig, supabase: ProviderConfig,
+                 ocr_response: Optional[Dict] = None, explanation_response: Optional[Dict] = None,
+                 no_rate_fraction: float = 0.1):
+        self.config = {"anthropic": anthropic, "perplexity": perplexity, "supabase": supabase}
+        self.ocr_response = ocr_response or _default_ocr_response()
+        self.explanation_response = explanation_response or DEFAULT_EXPLANATION
+        self.no_rate_fraction = no_rate_fraction
+        self.rates: Dict[tuple, Dict] = {}
+        self.stats: Dict[str, Dict[str, int]] = defaultdict(lambda: {"requests": 0, "errors": 0})
+        self._runners: List[web.AppRunner] = []
+
+    # Anthropic
+
+    async def messages(self, request: web.Request) -> web.Response:
+        config = self.config["anthropic"]
+        body = await request.json()
+        await config.delay()
+        self.stats["anthropic"]["requests"] += 1
+        if config.should_fail():
+            self.stats["anthropic"]["errors"] += 1
+            return web.json_response(
+                {"type": "error", "error": {"type": "overloaded_error", "message": "Overloaded (fake)"}}, status=529
+            )
+
+        content = body["messages"][-1]["content"]
+        is_ocr = isinstance(content, list) and any(block.get("type") == "image" for block in content)
+        text = json.dumps(self.ocr_response if is_ocr else self.explanation_response)
+        return web.json_response({
+            "id": f"msg_{uuid.uuid4().hex[:24]}",
+            "type": "message",
+            "role": "assistant",
+            "model": body.get("model"),
+            "content": [{"type": "text", "text": text}],
+            "stop_reason": "end_turn",
+            "stop_sequence": None,
+            "usage": {"input_tokens": (1600 if is_ocr else 0) + len(json.dumps(body)) // 4, "output_tokens": len(text) // 4},
+        })
+
+    # Perplexity
+
+    def _rate_for(self, code: str) -> Optional[float]:
+        digest = int(hashlib.md5(code.encode("utf-8")).hexdigest(), 16)
+        if (digest % 1000) / 1000 < self.no_rate_fraction:
+            return None
+        return round(20 + (digest % 20000) / 10, 2)
+
+    async def chat_completions(self, request: web.Request) -> web.Response:
+        config = self.config["perplexity"]
+        body = await request.json()
+        await config.delay()
+        self.stats["perplexity"]["requests"] += 1
+        if config.should_fail():
+            self.stats["perplexity"]["errors"] += 1
+            return web.json_response({"error": {"message": "Internal error (fake)", "type": "server_error"}}, status=500)
+
+        prompt = body["messages"][-1]["content"]
+        analysis = []
+        for item in _prompt_items(prompt):
+            rate = self._rate_for(item["code"])
+            if rate is None:
+                continue
+            analysis.append({
+                "code": item["code"],
+                "description": item.get("description", ""),
+                "billed_cost": item.get("cost", 0),
+                "standardized_rate": rate,
+                "sources": ["Fake Medicare RVU", "Fake FAIR Health"],
+            })
+        text = json.dumps({"ucr_validation": {"procedure_analysis": analysis}})
+        return web.json_response({
+            "id": uuid.uuid4().hex,
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model"),
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": len(prompt) // 4, "completion_tokens": len(text) // 4, "total_tokens": (len(prompt) + len(text)) // 4},
+        })
+
+    # Supabase (PostgREST)
+
+    async def select_rates(self, request: web.Request) -> web.Response:
+        config = self.config["supabase"]
+        await config.delay()
+        self.stats["supabase"]["requests"] += 1
+        rows = list(self.rates.values())
+        for column, condition in request.query.items():
+            if column in ("select", "order", "limit", "offset"):
+                continue
+            op, _, value = condition.partition(".")
+            if op == "eq":
+                rows = [row for row in rows if str(row.get(column)) == _unquote(value)]
+            elif op == "in":
+                values = {_unquote(part) for part in value.strip("()").split(",")}
+                rows = [row for row in rows if str(row.get(column)) in values]
+            elif op in COMPARISONS:
+                rows = [
+                    row for row in rows
+                    if row.get(column) is not None and COMPARISONS[op](str(row[column]), _unquote(value))
+                ]
+        order = request.query.get("order", "").split(".")[0]
+        if order:
+            rows.sort(key=lambda row: str(row.get(order, "")))
+        if "limit" in request.query:
+            rows = rows[:int(request.query["limit"])]
+        columns = request.query.get("select", "*")
+        if columns != "*":
+            wanted = columns.split(",")
+            rows = [{column: row.get(column) for column in wanted} for row in rows]
+        return web.json_response(rows)
+
+    async def upsert_rates(self, request: web.Request) -> web.Response:
+        config = self.config["supabase"]
+        body = await request.json()
+        await config.delay()
+        self.stats["supabase"]["requests"] += 1
+        for row in body if isinstance(body, list) else [body]:
+            self.rates[(row["code"], row["location"])] = row
+        return web.json_response(body, status=201)
+
+    def app(self, provider: str) -> web.Application:
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        if provider == "anthropic":
+            app.router.add_post("/v1/messages", self.messages)
+        elif provider == "perplexity":
+            app.router.add_post("/chat/completions", self.chat_completions)
+        else:
+            app.router.add_get("/rest/v1/standardized_rates", self.select_rates)
+            app.router.add_post("/rest/v1/standardized_rates", self.upsert_rates)
+        return app
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> Dict[str, str]:
+        """Serve each provider on its own port (consecutive from port, or free ports); returns the backend env"""
+        urls = {}
+        for offset, provider in enumerate(("anthropic", "perplexity", "supabase")):
+            runner = web.AppRunner(self.app(provider), access_log=None)
+            await runner.setup()
+            site = web.TCPSite(runner, host, port + offset if port else 0)
+            await site.start()
+            self._runners.append(runner)
+            bound_port = runner.addresses[0][1]
+            urls[provider] = f"http://{host}:{bound_port}"
+        return {
+            "ANTHROPIC_BASE_URL": urls["anthropic"],
+            "ANTHROPIC_API_KEY": "fake-anthropic-key",
+            "PERPLEXITY_BASE_URL": urls["perplexity"],
+            "PERPLEXITY_API_KEY": "fake-perplexity-key",
+            "SUPABASE_URL": urls["supabase"],
+            "SUPABASE_KEY": FAKE_SUPABASE_KEY,
+        }
+
+    async def stop(self) -> None:
+        for runner in self._runners:
+            await runner.cleanup()
+        self._runners = []
+
+    def snapshot(self) -> Dict[str, Dict[str, int]]:
+        return {provider: dict(counts) for provider, counts in self.stats.items()}
+
+
+def _unquote(value: str) -> str:
+    return value.strip().strip('"')
+
+
+def _prompt_items(prompt: str) -> List[Dict]:
+    """The line items of a rate search prompt (table or JSON item format, see prompts.py)"""
+    match = re.search(r"Analyze rates for:\s*(.*?)\n\s*\nReturn ONLY", prompt, re.DOTALL)
+    if not match:
+        return []
+    items = match.group(1).strip()
+    if items.startswith("["):
+        return json.loads(items)
+    lines = items.splitlines()
+    header = lines[0].split("|")
+    return [dict(zip(header, line.split("|"))) for line in lines[1:]]
+
+
+def _default_ocr_response() -> Dict:
+    if DEFAULT_OCR_RESPONSE.exists():
+        return json.loads(DEFAULT_OCR_RESPONSE.read_text())["extracted_text"]
+    return {"billing_details": {"procedure_codes": [
+        {"code": "99213", "description": "Office visit, established patient", "quantity": 1, "cost": 250.0, "is_subtotal": False},
+        {"code": "85025", "description": "Complete blood count", "quantity": 1, "cost": 85.0, "is_subtotal": False},
+        {"code": "J1100", "description": "Dexamethasone injection", "quantity": 1, "cost": 40.0, "is_subtotal": False},
+    ], "total_cost": 375.0}}
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--anthropic-latency-ms", type=float, default=1500, help="Fake Anthropic response time")
+    parser.add_argument("--perplexity-latency-ms", type=float, default=2500, help="Fake Perplexity response time")
+    parser.add_argument("--supabase-latency-ms", type=float, default=30, help="Fake Supabase response time")
+    parser.add_argument("--jitter", type=float, default=0.2, help="Latency varies by +/- this fraction")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of LLM calls that fail")
+    parser.add_argument("--no-rate-fraction", type=float, default=0.1, help="Fraction of codes without a rate")
+    parser.add_argument("--ocr-response", type=Path, help="JSON file with the billing_details OCR returns")
+    parser.add_argument("--explanation-response", type=Path, help="JSON file with the explanation returned")
+
+
+def from_arguments(args) -> FakeProviders:
+    return FakeProviders(
+        anthropic=ProviderConfig(args.anthropic_latency_ms, args.jitter, args.error_rate),
+        perplexity=ProviderConfig(args.perplexity_latency_ms, args.jitter, args.error_rate),
+        supabase=ProviderConfig(args.supabase_latency_ms, args.jitter),
+        ocr_response=json.loads(args.ocr_response.read_text()) if args.ocr_response else None,
+        explanation_response=json.loads(args.explanation_response.read_text()) if args.explanation_response else None,
+        no_rate_fraction=args.no_rate_fraction,
+    )
+
+
+async def _serve(args) -> None:
+    fakes = from_arguments(args)
+    env = await fakes.start(args.host, args.port)
+    print("Fake providers running; start the backend with:")
+    for key, value in env.items():
+        print(f"export {key}={value}")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await fakes.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8900, help="Anthropic on port, Perplexity on +1, Supabase on +2")
+    add_arguments(parser)
+    try:
+        asyncio.run(_serve(parser.parse_args()))
+    except KeyboardInterrupt:
+        pass
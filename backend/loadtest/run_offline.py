@@ -0,0 +1,227 @@
+"""
+Offline end-to-end load test for /api/analyze.
+
+Starts the fake Anthropic / Perplexity / Supabase servers from fake_providers.py, starts the
+backend (uvicorn) pointed at them, then drives /api/analyze at increasing concurrency and
+reports, per level: throughput, p50/p95/p99 latency, CPU used by the backend (all of its
+processes, so 200% = two cores busy), peak RSS, and the calls each fake provider received.
+No real provider is called, so runs are free and repeatable.
+
+Usage (from backend/):
+    python loadtest/run_offline.py --levels 1,2,4,8,16 --requests 32
+    python loadtest/run_offline.py --anthropic-latency-ms 800 --error-rate 0.05 --workers 2
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import httpx
+
+LOADTEST_DIR = Path(__file__).resolve().parent
+BACKEND_DIR = LOADTEST_DIR.parent
+sys.path.insert(0, str(LOADTEST_DIR))
+
+from analyze_load import DEFAULT_BILL, print_report, run_level  # noqa: E402
+import fake_providers  # noqa: E402
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+
+class ProcessSampler:
+    """CPU seconds and RSS of a process and all of its descendants (uvicorn workers, OCR pool)"""
+
+    CLOCK_TICKS = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+
+    def __init__(self, pid: int):
+        self.pid = pid
+
+    def _pids(self) -> List[int]:
+        if psutil is not None:
+            root = psutil.Process(self.pid)
+            return [self.pid] + [child.pid for child in root.children(recursive=True)]
+        parents = {}
+        for entry in Path("/proc").iterdir():
+            if entry.name.isdigit():
+                try:
+                    stat = (entry / "stat").read_text()
+                    parents[int(entry.name)] = int(stat.rsplit(")", 1)[1].split()[1])
+                except (OSError, IndexError, ValueError):
+                    continue
+        pids, frontier = [self.pid], [self.pid]
+        while frontier:
+            children = [pid for pid, parent in parents.items() if parent in frontier]
+            pids.extend(children)
+            frontier = children
+        return pids
+
+    def sample(self) -> Optional[Dict[str, float]]:
+        """{"cpu_seconds", "rss_mb"} summed over the process tree, or None if unsupported"""
+        cpu_seconds = rss_bytes = 0.0
+        try:
+            pids = self._pids()
+        except Exception:
+            return None
+        for pid in pids:
+            try:
+                if psutil is not None:
+                    process = psutil.Process(pid)
+                    times = process.cpu_times()
+                    cpu_seconds += times.user + times.system
+                    rss_bytes += process.memory_info().rss
+                else:
+                    fields = Path(f"/proc/{pid}/stat").read_text().rsplit(")", 1)[1].split()
+                    cpu_seconds += (int(fields[11]) + int(fields[12])) / self.CLOCK_TICKS
+                    rss_bytes += int(fields[21]) * os.sysconf("SC_PAGE_SIZE")
+            except Exception:
+                continue  # exited between listing and reading
+        return {"cpu_seconds": cpu_seconds, "rss_mb": rss_bytes / (1024 * 1024)}
+
+
+async def measure(sampler: ProcessSampler, stop: asyncio.Event, interval: float = 0.25) -> Dict[str, float]:
+    """CPU % and peak RSS of the backend until stop is set"""
+    first = sampler.sample()
+    if first is None:
+        return {}
+    started = time.perf_counter()
+    peak_rss = first["rss_mb"]
+    last = first
+    while not stop.is_set():
+        try:
+            await asyncio.wait_for(stop.wait(), interval)
+        except asyncio.TimeoutError:
+            pass
+        current = sampler.sample()
+        if current is not None:
+            last = current
+            peak_rss = max(peak_rss, current["rss_mb"])
+    elapsed = time.perf_counter() - started
+    return {
+        "cpu_percent": 100 * (last["cpu_seconds"] - first["cpu_seconds"]) / elapsed if elapsed else 0.0,
+        "peak_rss_mb": peak_rss,
+    }
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def wait_until_ready(url: str, server: subprocess.Popen, timeout: float) -> None:
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient(timeout=2) as client:
+        while time.monotonic() < deadline:
+            if server.poll() is not None:
+                raise RuntimeError(f"Backend exited with code {server.returncode} during startup")
+            try:
+                if (await client.get(url)).status_code == 200:
+                    return
+            except httpx.HTTPError:
+                pass
+            await asyncio.sleep(0.25)
+    raise RuntimeError(f"Backend did not become ready within {timeout:.0f}s")
+
+
+def backend_env(provider_env: Dict[str, str], args, scratch: Path) -> Dict[str, str]:
+    env = dict(os.environ)
+    env.update(provider_env)
+    env.update({
+        # Every request OCRs the same bill; the OCR cache would answer all but the first
+        "OCR_CACHE_ENABLED": "1" if args.ocr_cache else "0",
+        "OCR_CACHE_PATH": str(scratch / "ocr_cache.sqlite3"),
+        "JOB_QUEUE_PATH": str(scratch / "jobs.sqlite3"),
+        "RATE_REFRESH_ENABLED": "0",
+        "LOG_LEVEL": args.log_level,
+        "PYTHONPATH": str(BACKEND_DIR),
+    })
+    return env
+
+
+def print_resources(results: List[Dict]) -> None:
+    print(f"{'conc':>5} {'cpu %':>8} {'rss MB':>8}   provider calls (errors)")
+    for r in results:
+        calls = "  ".join(
+            f"{provider} {counts['requests']} ({counts['errors']})" for provider, counts in sorted(r["providers"].items())
+        )
+        cpu = f"{r['cpu_percent']:>8.1f}" if "cpu_percent" in r else f"{'n/a':>8}"
+        rss = f"{r['peak_rss_mb']:>8.1f}" if "peak_rss_mb" in r else f"{'n/a':>8}"
+        print(f"{r['concurrency']:>5} {cpu} {rss}   {calls}")
+
+
+async def main(args) -> List[Dict]:
+    fakes = fake_providers.from_arguments(args)
+    provider_env = await fakes.start()
+    port = free_port()
+    base_url = f"http://127.0.0.1:{port}"
+    bill_path = Path(args.bill)
+    bill_bytes = bill_path.read_bytes()
+    content_type = "application/pdf" if bill_path.suffix.lower() == ".pdf" else "image/jpeg"
+
+    results = []
+    with tempfile.TemporaryDirectory() as scratch:
+        server = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "app.main:app", "--host", "127.0.0.1", "--port", str(port),
+             "--workers", str(args.workers), "--log-level", "warning"],
+            cwd=BACKEND_DIR, env=backend_env(provider_env, args, Path(scratch)),
+        )
+        try:
+            await wait_until_ready(base_url + "/", server, args.startup_timeout)
+            sampler = ProcessSampler(server.pid)
+            for level in [int(x) for x in args.levels.split(",")]:
+                total = max(args.requests, level)
+                before = fakes.snapshot()
+                stop = asyncio.Event()
+                monitor = asyncio.create_task(measure(sampler, stop))
+                result = await run_level(
+                    base_url + "/api/analyze", bill_path.name, bill_bytes, content_type, level, total, args.timeout
+                )
+                stop.set()
+                result.update(await monitor)
+                after = fakes.snapshot()
+                result["providers"] = {
+                    provider: {key: counts[key] - before.get(provider, {}).get(key, 0) for key in counts}
+                    for provider, counts in after.items()
+                }
+                results.append(result)
+                print(f"concurrency={level}: {result['throughput']:.2f} req/s, p95={result['p95']:.2f}s, "
+                      f"cpu={result.get('cpu_percent', 0):.0f}%")
+        finally:
+            server.terminate()
+            try:
+                server.wait(timeout=15)
+            except subprocess.TimeoutExpired:
+                server.kill()
+            await fakes.stop()
+
+    print_report(results)
+    print()
+    print_resources(results)
+    if args.output:
+        Path(args.output).write_text(json.dumps(results, indent=2))
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--bill", default=str(DEFAULT_BILL))
+    parser.add_argument("--levels", default="1,2,4,8")
+    parser.add_argument("--requests", type=int, default=16, help="requests per concurrency level")
+    parser.add_argument("--timeout", type=float, default=300.0)
+    parser.add_argument("--workers", type=int, default=1, help="uvicorn worker processes")
+    parser.add_argument("--ocr-cache", action="store_true", help="Leave the OCR cache on")
+    parser.add_argument("--log-level", default="WARNING", help="Backend LOG_LEVEL")
+    parser.add_argument("--startup-timeout", type=float, default=120.0)
+    parser.add_argument("--output", help="Also write the results to this JSON file")
+    fake_providers.add_arguments(parser)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,159 @@
+import asyncio
+import os
+
+os.environ["SUPABASE_URL"] = ""
+os.environ["RATE_CACHE_WRITE_BEHIND"] = "0"
+
+from app.services.cache import CacheService  # noqa: E402
+
+
+def test_cancelled_waiter_does_not_strand_inflight_lookups():
+    async def scenario():
+        service = CacheService()
+        service.supabase = object()  # anything non-None; _fetch_rates is replaced below
+        release = asyncio.Event()
+
+        async def fetch_rates(codes, location):
+            await release.wait()
+            return {code: {"code": code, "standardized_rate": 10.0} for code in codes}
+
+        service._fetch_rates = fetch_rates
+
+        owner = asyncio.create_task(service.bulk_get_cached_rates(["99213", "36415"], "LA"))
+        await asyncio.sleep(0)
+        waiter = asyncio.create_task(service.bulk_get_cached_rates(["99213"], "LA"))
+        await asyncio.sleep(0)
+        waiter.cancel()
+        await asyncio.sleep(0)
+        release.set()
+
+        assert set(await owner) == {"99213", "36415"}
+        assert not service._inflight
+        # Later lookups that miss memory must not hang on a future nobody resolves
+        service.memory._entries.clear()
+        rates = await asyncio.wait_for(service.bulk_get_cached_rates(["36415"], "LA"), timeout=1)
+        assert "36415" in rates
+
+    asyncio.run(scenario())
+
+
+def test_expiring_rates_selects_by_expiry(monkeypatch):
+    import sys
+    from datetime import datetime, timedelta, timezone
+    from pathlib import Path
+
+    sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "loadtest"))
+    from fake_providers import FakeProviders, ProviderConfig
+
+    async def scenario():
+        fakes = FakeProviders(ProviderConfig(0), ProviderConfig(0), ProviderConfig(0))
+        for name, value in (await fakes.start()).items():
+            monkeypatch.setenv(name, value)
+        try:
+            service = CacheService()
+            now = datetime.now(timezone.utc)
+            # Old rows that expired long ago must not crowd out rows about to expire
+            for i in range(20):
+                fakes.rates[(f"9{i:04d}", "TX")] = {
+                    "code": f"9{i:04d}", "location": "TX",
+                    "created_at": (now - timedelta(days=60)).isoformat(),
+                    "expires_at": (now - timedelta(days=30)).isoformat(),
+                }
+            for code, days in (("99213", 2), ("99214", 1), ("99215", 10)):
+                fakes.rates[(code, "TX")] = {
+                    "code": code, "location": "TX",
+                    "created_at": (now - timedelta(days=29)).isoformat(),
+                    "expires_at": (now + timedelta(days=days)).isoformat(),
+                }
+            return await service.expiring_rates(3 * 24 * 3600, limit=2)
+        finally:
+            await fakes.stop()
+
+    rows = asyncio.run(scenario())
+    assert [row["code"] for row in rows] == ["99214", "99213"]
+
+
+def _fake_supabase(monkeypatch):
+    import sys
+    from pathlib import Path
+
+    sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "loadtest"))
+    from fake_providers import FakeProviders, ProviderConfig
+
+    fakes = FakeProviders(ProviderConfig(0), ProviderConfig(0), ProviderConfig(0))
+
+    async def start():
+        for name, value in (await fakes.start()).items():
+            monkeypatch.setenv(name, value)
+        return fakes
+
+    return start
+
+
+def test_memory_tier_never_outlives_the_row(monkeypatch):
+    import time
+    from datetime import datetime, timedelta, timezone
+
+    start = _fake_supabase(monkeypatch)
+
+    async def scenario():
+        fakes = await start()
+        try:
+            service = CacheService()
+            now = datetime.now(timezone.utc)
+            # Created so that the row expires a minute from now, well inside the memory TTL
+            created_at = now - (service.expires_at("99213", "TX", now) - now) + timedelta(seconds=60)
+            fakes.rates[("99213", "TX")] = {
+                "code": "99213", "location": "TX", "description": "Office visit",
+                "standardized_rate": 100.0, "sources": [], "created_at": created_at.isoformat(),
+            }
+            rates = await service.bulk_get_cached_rates(["99213"], "TX")
+            return service, rates
+        finally:
+            await fakes.stop()
+
+    service, rates = asyncio.run(scenario())
+    assert rates["99213"]["standardized_rate"] == 100.0
+    expires_at, _ = service.memory._entries[("99213", "TX")]
+    assert expires_at <= time.time() + 61
+
+
+def test_lookup_counts_stay_bounded(monkeypatch):
+    from app.services import cache
+
+    monkeypatch.setattr(cache, "RATE_LOOKUP_COUNTS_MAX", 10)
+    service = CacheService()
+    for _ in range(5):
+        asyncio.run(service.bulk_get_cached_rates(["99213"], "TX"))
+    for i in range(100):
+        asyncio.run(service.bulk_get_cached_rates([f"9{i:04d}"], "TX"))
+
+    assert len(service.lookup_counts) <= 10
+    assert service.lookup_counts[("99213", "TX")] == 5
+
+
+def test_stale_rows_leave_memory_at_the_stale_max_age(monkeypatch):
+    import time
+    from datetime import datetime, timedelta, timezone
+    from app.services.cache import RATE_STALE_MAX_AGE_SECONDS
+
+    start = _fake_supabase(monkeypatch)
+
+    async def scenario():
+        fakes = await start()
+        try:
+            service = CacheService()
+            created_at = datetime.now(timezone.utc) - timedelta(seconds=RATE_STALE_MAX_AGE_SECONDS - 60)
+            fakes.rates[("99213", "TX")] = {
+                "code": "99213", "location": "TX", "description": "Office visit",
+                "standardized_rate": 100.0, "sources": [], "created_at": created_at.isoformat(),
+            }
+            rates = await service.bulk_get_cached_rates(["99213"], "TX")
+            return service, rates
+        finally:
+            await fakes.stop()
+
+    service, rates = asyncio.run(scenario())
+    assert rates["99213"]["stale"]
+    expires_at, _ = service.memory._entries[("99213", "TX")]
+    assert expires_at <= time.time() + 61
@@ -0,0 +1,99 @@
+import asyncio
+import os
+
+os.environ["SUPABASE_URL"] = ""
+
+from app import worker  # noqa: E402
+from app.services import jobs  # noqa: E402
+from app.services.jobs import DONE, FAILED, QUEUED, RUNNING, SQLiteJobStore  # noqa: E402
+
+
+def _store(tmp_path, job_ids=("job-1",)):
+    store = SQLiteJobStore(str(tmp_path / "jobs.sqlite3"))
+    for job_id in job_ids:
+        store.submit(job_id, "{}", 0)
+    return store
+
+
+def _status(store, job_id="job-1"):
+    return store.get(job_id)["status"]
+
+
+def test_claim_leases_each_job_once(tmp_path):
+    store = _store(tmp_path, ("job-1", "job-2"))
+    first, second = store.claim("a"), store.claim("b")
+    assert {first["id"], second["id"]} == {"job-1", "job-2"}
+    assert first["status"] == RUNNING and first["attempts"] == 1
+    assert store.claim("c") is None
+
+
+def test_complete_and_fail_are_fenced_on_the_claim(tmp_path):
+    store = _store(tmp_path)
+    job = store.claim("a")
+    assert not store.complete("job-1", "b", job["attempts"], "{}")
+    assert store.fail("job-1", "a", job["attempts"] + 1, "boom", retry=True) is None
+    assert not store.renew("job-1", "b", job["attempts"])
+    assert _status(store) == RUNNING
+
+    assert store.renew("job-1", "a", job["attempts"])
+    assert store.complete("job-1", "a", job["attempts"], '{"ok": true}')
+    assert _status(store) == DONE
+    assert not store.complete("job-1", "a", job["attempts"], "{}")
+
+
+def test_expired_lease_is_reclaimed_and_the_stale_worker_fenced_out(tmp_path, monkeypatch):
+    store = _store(tmp_path)
+    monkeypatch.setattr(jobs, "JOB_LEASE_SECONDS", -1)
+    stale = store.claim("a")
+    monkeypatch.setattr(jobs, "JOB_LEASE_SECONDS", 60)
+
+    fresh = store.claim("b")
+    assert fresh["id"] == "job-1" and fresh["attempts"] == 2
+    assert not store.renew("job-1", "a", stale["attempts"])
+    assert not store.complete("job-1", "a", stale["attempts"], "{}")
+    assert store.complete("job-1", "b", fresh["attempts"], "{}")
+
+
+def test_expired_lease_without_attempts_left_fails(tmp_path, monkeypatch):
+    monkeypatch.setattr(jobs, "JOB_MAX_ATTEMPTS", 1)
+    store = _store(tmp_path)
+    monkeypatch.setattr(jobs, "JOB_LEASE_SECONDS", -1)
+    store.claim("a")
+
+    assert store.claim("b") is None
+    assert _status(store) == FAILED
+    assert store.get("job-1")["error"] == "Worker lease expired"
+
+
+def test_failures_retry_with_backoff_until_attempts_run_out(tmp_path, monkeypatch):
+    monkeypatch.setattr(jobs, "JOB_MAX_ATTEMPTS", 2)
+    monkeypatch.setattr(jobs, "JOB_RETRY_BACKOFF_SECONDS", 0)
+    store = _store(tmp_path)
+
+    job = store.claim("a")
+    assert store.fail("job-1", "a", job["attempts"], "boom", retry=True) == QUEUED
+    job = store.claim("a")
+    assert job["attempts"] == 2
+    assert store.fail("job-1", "a", job["attempts"], "boom", retry=True) == FAILED
+    assert _status(store) == FAILED
+
+
+def test_worker_renews_the_lease_and_abandons_a_lost_job(monkeypatch):
+    renewals = []
+
+    class Queue:
+        async def renew(self, job):
+            renewals.append(job["id"])
+            return len(renewals) < 3
+
+    async def scenario():
+        running = asyncio.create_task(asyncio.sleep(10))
+        await worker.renew_lease({"id": "job-1", "attempts": 1}, running)
+        await asyncio.sleep(0)
+        return running
+
+    monkeypatch.setattr(worker, "job_queue", Queue())
+    monkeypatch.setattr(worker, "JOB_LEASE_RENEW_SECONDS", 0)
+    running = asyncio.run(scenario())
+    assert renewals == ["job-1"] * 3
+    assert running.cancelled()
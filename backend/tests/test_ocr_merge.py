@@ -0,0 +1,56 @@
+import os
+
+os.environ["SUPABASE_URL"] = ""
+
+from app.services.ocr import merge_ocr_results  # noqa: E402
+
+
+def _page(*procedures, file_type="pdf"):
+    return {
+        "success": True,
+        "file_type": file_type,
+        "extracted_text": {"billing_details": {"procedure_codes": list(procedures)}},
+    }
+
+
+def _item(code, cost, description="Line", quantity=1, is_subtotal=False):
+    return {"code": code, "description": description, "quantity": quantity, "cost": cost, "is_subtotal": is_subtotal}
+
+
+def _codes(merged):
+    return [item["code"] for item in merged["extracted_text"]["billing_details"]["procedure_codes"]]
+
+
+def test_items_repeated_across_pages_and_files_are_kept_once():
+    visit = _item("99283", "$1,250.00", "ER  visit")
+    merged = merge_ocr_results([
+        _page(visit, _item("36415", 12.0)),
+        # Continuation header repeating the last line, with different spacing/case/formatting
+        _page(_item("99283", 1250, "er visit"), _item("70450", 2100.0)),
+        # A second upload of the same statement
+        _page(visit, file_type="image"),
+    ])
+    assert _codes(merged) == ["99283", "36415", "70450"]
+    assert merged["extracted_text"]["billing_details"]["total_cost"] == 3362.0
+    assert merged["pages"] == 3 and merged["file_type"] == "pdf"
+
+
+def test_repeats_on_one_page_are_genuine():
+    draw = _item("36415", 12.0)
+    merged = merge_ocr_results([_page(draw, draw), _page(draw), _page(draw, draw, draw)])
+    assert _codes(merged) == ["36415"] * 3
+
+
+def test_subtotals_are_kept_but_not_summed():
+    merged = merge_ocr_results([_page(_item("99283", 100.0), _item("", 100.0, "Subtotal", is_subtotal=True))])
+    assert len(_codes(merged)) == 2
+    assert merged["extracted_text"]["billing_details"]["total_cost"] == 100.0
+
+
+def test_failed_pages_are_skipped_and_retryability_reported():
+    merged = merge_ocr_results([{"success": False, "retryable": True}, _page(_item("99283", 100.0))])
+    assert merged["success"] and _codes(merged) == ["99283"]
+
+    permanent = merge_ocr_results([{"success": False, "retryable": False, "file_type": "pdf"}])
+    assert not permanent["success"] and not permanent["retryable"]
+    assert merge_ocr_results([{"success": False, "retryable": False}, {"success": False}])["retryable"]
@@ -0,0 +1,62 @@
+import os
+
+os.environ["SUPABASE_URL"] = ""
+
+import numpy as np  # noqa: E402
+
+from app.services import pricing  # noqa: E402
+from app.services.pricing import RATE_DTYPE, PriceTable, parse_rate_cents, price_procedures  # noqa: E402
+
+
+def _table(rows):
+    records = np.zeros(len(rows), dtype=RATE_DTYPE)
+    if rows:
+        records["code"] = [code.encode("ascii") for code, _, _, _ in rows]
+        records["apc"] = [apc.encode("ascii") for _, apc, _, _ in rows]
+        records["rate_cents"] = [cents for _, _, cents, _ in rows]
+    return PriceTable.from_records(records, [description for _, _, _, description in rows])
+
+
+def test_parse_rate_cents():
+    assert parse_rate_cents("$4,156.57 ") == 415657
+    assert parse_rate_cents("$12.5") == 1250
+    assert parse_rate_cents("$7") == 700
+    assert parse_rate_cents(" ") is None
+    assert parse_rate_cents("n/a") is None
+
+
+def test_prices_known_codes_and_passes_the_rest_on(monkeypatch):
+    table = _table([("36415", "5734", 300, "Routine venipuncture"), ("99283", "5023", 41234, "Emergency dept visit")])
+    monkeypatch.setattr(pricing, "get_price_table", lambda: table)
+    unknown = {"code": "A9999", "description": "Misc supply", "cost": "$10.00"}
+
+    priced, unpriced = price_procedures([
+        {"code": "ER Facility Level 3 - 99283 (CPT)", "description": "", "cost": "$1,250.00"},
+        {"code": "36415", "description": "Blood draw", "quantity": "2", "cost": 24},
+        unknown,
+        {"code": "", "description": "Pharmacy", "cost": 5},
+    ])
+
+    assert [p["code"] for p in priced] == ["99283", "36415"]
+    er, draw = priced
+    assert er["description"] == "Emergency dept visit"
+    assert er["billed_cost"] == 1250.0 and er["standardized_rate"] == 412.34
+    assert er["sources"] == ["CMS OPPS Addendum B (APC 5023)"]
+    assert draw["description"] == "Blood draw"
+    assert draw["quantity"] == 2.0 and draw["unit_rate"] == 3.0 and draw["standardized_rate"] == 6.0
+    assert unpriced[0] is unknown and [p["description"] for p in unpriced] == ["Misc supply", "Pharmacy"]
+
+
+def test_empty_price_table_prices_nothing(monkeypatch):
+    monkeypatch.setattr(pricing, "get_price_table", lambda: _table([]))
+    procedures = [{"code": "99283", "cost": 100}]
+    assert price_procedures(procedures) == ([], procedures)
+    assert price_procedures([]) == ([], [])
+
+
+def test_bundled_price_table_is_sorted_and_priced():
+    table = pricing.get_price_table()
+    assert len(table.codes) > 0
+    assert list(table.codes) == sorted(table.codes)
+    priced, _ = price_procedures([{"code": "0071T", "cost": 100}])
+    assert priced and priced[0]["standardized_rate"] > 0
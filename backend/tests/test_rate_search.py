@@ -0,0 +1,88 @@
+import asyncio
+import json
+import os
+import time
+from types import SimpleNamespace
+
+os.environ["SUPABASE_URL"] = ""
+
+from app.services import perplexity  # noqa: E402
+from app.services.regions import normalize_region  # noqa: E402
+from app.services.tokens import record_usage, start_request_budget  # noqa: E402
+
+
+def fake_perplexity(calls):
+    async def create(purpose="other", **kwargs):
+        started = time.perf_counter()
+        calls.append(kwargs["messages"])
+        await asyncio.sleep(0.01)
+        record_usage("perplexity", purpose, 100, 100, 50, started)
+        content = json.dumps({"ucr_validation": {"procedure_analysis": [
+            {"code": "99213", "description": "Office visit", "standardized_rate": 120.0, "sources": ["test"]}
+        ]}})
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))], usage=None)
+    return create
+
+
+def test_one_callers_budget_does_not_fail_a_shared_search(monkeypatch):
+    calls = []
+    monkeypatch.setattr(perplexity, "perplexity_create", fake_perplexity(calls))
+    service = perplexity.PerplexityService()
+    region = normalize_region("Houston, TX")
+    procedures = [{"code": "99213", "description": "Office visit", "cost": 200.0}]
+
+    async def lookup(limit):
+        budget = start_request_budget(limit)
+        rates = await service._lookup_rates(procedures, region, max_retries=1)
+        return rates, budget
+
+    async def scenario():
+        # B joins the search A would have started; A's tiny budget only skips A
+        return await asyncio.gather(lookup(10), lookup(0))
+
+    (rates_a, budget_a), (rates_b, budget_b) = asyncio.run(scenario())
+    assert rates_a == {}
+    assert rates_b["99213"]["standardized_rate"] == 120.0
+    assert len(calls) == 1
+    assert budget_a.spent == 0
+    assert budget_b.spent == 150
+
+
+def test_coalesced_waiters_are_each_charged(monkeypatch):
+    calls = []
+    monkeypatch.setattr(perplexity, "perplexity_create", fake_perplexity(calls))
+    service = perplexity.PerplexityService()
+    region = normalize_region("Houston, TX")
+    procedures = [{"code": "99213", "description": "Office visit", "cost": 200.0}]
+
+    async def lookup():
+        budget = start_request_budget(0)
+        rates = await service._lookup_rates(procedures, region, max_retries=1)
+        return rates, budget
+
+    async def scenario():
+        return await asyncio.gather(lookup(), lookup())
+
+    results = asyncio.run(scenario())
+    assert len(calls) == 1
+    assert all("99213" in rates and budget.spent == 150 for rates, budget in results)
+
+
+def test_revalidation_runs_outside_the_callers_budget(monkeypatch):
+    calls = []
+    monkeypatch.setattr(perplexity, "perplexity_create", fake_perplexity(calls))
+    service = perplexity.PerplexityService()
+    region = normalize_region("Houston, TX")
+    procedures = [{"code": "99213", "description": "Office visit", "cost": 200.0}]
+
+    async def scenario():
+        # Too small for the search; the background refresh must neither fail on nor charge it
+        budget = start_request_budget(10)
+        service._revalidate(procedures, region, max_retries=1)
+        while service._tasks:
+            await asyncio.gather(*service._tasks)
+        return budget
+
+    budget = asyncio.run(scenario())
+    assert len(calls) == 1
+    assert budget.spent == 0
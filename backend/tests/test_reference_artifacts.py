@@ -0,0 +1,95 @@
+import os
+
+os.environ["SUPABASE_URL"] = ""
+
+import numpy as np  # noqa: E402
+
+from app.services import database  # noqa: E402
+from app.services.code_index import _code_index, _index_from_tables  # noqa: E402
+from app.services.database import DerivedTable, ReferenceArtifact, ReferenceTable  # noqa: E402
+from app.services.pricing import _price_table, _table_from_addenda  # noqa: E402
+
+DTYPE = np.dtype([("code", "S5"), ("desc_offset", "<i8"), ("desc_length", "<i4")])
+
+
+def _parse_lines(path):
+    with open(path, encoding="utf-8") as file:
+        return dict(line.rstrip("\n").split("|", 1) for line in file if "|" in line)
+
+
+def _from_artifact(records, descriptions):
+    return {records["code"][i].decode("ascii"): descriptions[i] for i in range(len(records))}
+
+
+def _artifact_table(tmp_path, lines):
+    source_path = tmp_path / "codes.txt"
+    source_path.write_text("".join(f"{code}|{text}\n" for code, text in lines), encoding="utf-8")
+    source = ReferenceTable("Codes", source_path, _parse_lines)
+    artifact = ReferenceArtifact("Codes", tmp_path / "codes.v1.npy", DTYPE, (source,))
+    built_from_tables = []
+
+    def from_tables():
+        built_from_tables.append(True)
+        return dict(source.records())
+
+    return source, artifact, DerivedTable(artifact, _from_artifact, from_tables), built_from_tables
+
+
+def _write(artifact, lines):
+    records = np.zeros(len(lines), dtype=DTYPE)
+    records["code"] = [code.encode("ascii") for code, _ in lines]
+    artifact.write(records, [text for _, text in lines])
+
+
+def test_artifacts_match_the_tables_they_are_built_from():
+    index, rebuilt = _code_index.get(), _index_from_tables()
+    assert index.sorted_codes == rebuilt.sorted_codes
+    assert dict(index.records) == dict(rebuilt.records)
+
+    table, rebuilt_table = _price_table.get(), _table_from_addenda()
+    assert (table.codes == rebuilt_table.codes).all()
+    assert (table.rate_cents == rebuilt_table.rate_cents).all()
+    assert (table.apcs == rebuilt_table.apcs).all()
+    assert [table.descriptions[i] for i in range(len(table.codes))] == list(rebuilt_table.descriptions)
+
+
+def test_descriptions_round_trip_untruncated(tmp_path):
+    lines = [("99283", "Emergency dept visit, moderate severity " * 10), ("J1885", "Ketorolac – 15 mg, Ménière’s")]
+    _, artifact, table, built_from_tables = _artifact_table(tmp_path, lines)
+    _write(artifact, lines)
+
+    assert table.get() == dict(lines)
+    assert not built_from_tables
+
+
+def test_rewritten_artifact_is_reloaded(tmp_path, monkeypatch):
+    monkeypatch.setattr(database, "REFERENCE_RELOAD_INTERVAL", 0.0)
+    _, artifact, table, _ = _artifact_table(tmp_path, [("99283", "old")])
+    _write(artifact, [("99283", "old")])
+    assert table.get() == {"99283": "old"}
+
+    _write(artifact, [("99283", "new"), ("99284", "added")])
+    os.utime(artifact.path, (artifact.path.stat().st_mtime + 1,) * 2)
+    assert table.get() == {"99283": "new", "99284": "added"}
+
+
+def test_stale_or_missing_artifact_falls_back_to_tables(tmp_path, monkeypatch):
+    monkeypatch.setattr(database, "REFERENCE_RELOAD_INTERVAL", 0.0)
+    source, artifact, table, built_from_tables = _artifact_table(tmp_path, [("99283", "from source")])
+    assert table.get() == {"99283": "from source"}
+
+    _write(artifact, [("99283", "from artifact")])
+    assert table.get() == {"99283": "from artifact"}
+
+    # A source edited after the artifact was built wins until the artifact is rebuilt
+    source.path.write_text("99283|edited\n", encoding="utf-8")
+    os.utime(source.path, (artifact.path.stat().st_mtime + 1,) * 2)
+    assert table.get() == {"99283": "edited"}
+    assert len(built_from_tables) == 2
+
+
+def test_empty_artifact_loads(tmp_path):
+    _, artifact, table, built_from_tables = _artifact_table(tmp_path, [])
+    _write(artifact, [])
+    assert table.get() == {}
+    assert not built_from_tables
@@ -0,0 +1,51 @@
+import pytest
+
+from app.services.regions import LOCALITIES, NATIONAL_REGION, STATES, STATE_BY_ZIP3, normalize_region
+
+
+@pytest.mark.parametrize("state, locality", sorted(LOCALITIES))
+def test_locality_keys_round_trip(state, locality):
+    region = normalize_region(f"{locality}, {state}")
+    assert region.key == f"{locality}, {state}"
+    assert region.level == "locality"
+    assert normalize_region(region.key) == region
+
+
+@pytest.mark.parametrize("state", sorted(STATES))
+def test_state_keys_round_trip(state):
+    region = normalize_region(state)
+    assert region.key == state
+    assert normalize_region(region.key) == region
+
+
+@pytest.mark.parametrize("location, zip_code, key", [
+    ("Houston, TX", None, "Houston, TX"),
+    ("77002", None, "Houston, TX"),
+    ("Chicago, Illinois 60611", None, "Chicago, IL"),
+    ("Evanston, IL", None, "Suburban Chicago, IL"),
+    ("Fresno, CA", None, "CA"),
+    ("Texas", None, "TX"),
+    (None, "92602", "Orange, CA"),
+    ("Irvine, CA", "92602", "Orange, CA"),
+    # ZIPs outside the metro localities resolve to their state, not the default region
+    ("97201", None, "OR"),
+    (None, "97201", "OR"),
+    ("Billings, MT 59101", None, "MT"),
+    ("Fresno, CA", "93721", "CA"),
+    # Nothing tells us the state: national rates
+    ("20001", None, "US"),
+    ("Paris, France", None, "US"),
+    ("US", None, "US"),
+])
+def test_normalize_region(location, zip_code, key):
+    assert normalize_region(location, zip_code).key == key
+
+
+def test_missing_location_uses_the_default_region():
+    assert normalize_region(None).level == "default"
+    assert normalize_region("").level == "default"
+
+
+def test_every_state_has_zip_prefixes():
+    assert set(STATE_BY_ZIP3.values()) == set(STATES)
+    assert NATIONAL_REGION.key not in STATES
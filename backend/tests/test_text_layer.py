@@ -0,0 +1,61 @@
+from app.services.text_layer import _parse_charge_line, parse_text_layer
+
+
+def _item(line):
+    item = _parse_charge_line(line)
+    return item and (item["code"], item["description"], item["quantity"], item["cost"])
+
+
+def test_code_then_description():
+    assert _item("99283  ER FACILITY LEVEL 3   $1,250.00") == ("99283", "ER FACILITY LEVEL 3", 1, 1250.0)
+    assert _item("01/02/2024 85025 CBC W/AUTO DIFF  2   $45.00  $90.00") == ("85025", "CBC W/AUTO DIFF", 2, 90.0)
+
+
+def test_description_then_code_then_quantity():
+    assert _item("CT HEAD W/O CONTRAST 70450   1   $2,100.00") == ("70450", "CT HEAD W/O CONTRAST", 1, 2100.0)
+    assert _item("CT HEAD W/O CONTRAST 70450   2   $4,200.00") == ("70450", "CT HEAD W/O CONTRAST", 2, 4200.0)
+    assert _item("CT HEAD W/O CONTRAST 70450 $2,100.00") == ("70450", "CT HEAD W/O CONTRAST", 1, 2100.0)
+
+
+def test_marked_quantities():
+    assert _item("J1885 KETOROLAC INJ 3 x $30.00") == ("J1885", "KETOROLAC INJ", 3, 30.0)
+    assert _item("J1885 KETOROLAC INJ 2 units $30.00") == ("J1885", "KETOROLAC INJ", 2, 30.0)
+    assert _item("J1885 KETOROLAC INJ 4 ea $30.00") == ("J1885", "KETOROLAC INJ", 4, 30.0)
+    assert _item("J1885 KETOROLAC INJ x 5 $30.00") == ("J1885", "KETOROLAC INJ", 5, 30.0)
+
+
+def test_tab_separated_columns():
+    assert _item("36415\tROUTINE VENIPUNCTURE\t2\t$24.00") == ("36415", "ROUTINE VENIPUNCTURE", 2, 24.0)
+
+
+def test_number_ending_the_description_is_not_a_quantity():
+    assert _item("99283 ER Facility Level 3 $1,250.00") == ("99283", "ER Facility Level 3", 1, 1250.0)
+
+
+def test_subtotal_and_non_charge_lines():
+    subtotal = _parse_charge_line("Subtotal Laboratory   $114.00")
+    assert subtotal["is_subtotal"] and subtotal["cost"] == 114.0
+    assert _parse_charge_line("Insurance payment   ($500.00)") is None
+    assert _parse_charge_line("Balance due   $1,364.00") is None
+    assert _parse_charge_line("Patient name: Jane Doe") is None
+
+
+def test_parse_text_layer_requires_coded_charges():
+    page = "\n".join([
+        "STATEMENT OF SERVICES",
+        "99283  ER FACILITY LEVEL 3   $1,250.00",
+        "CT HEAD W/O CONTRAST 70450   1   $2,100.00",
+        "Subtotal   $3,350.00",
+    ])
+    details = parse_text_layer(page)["billing_details"]
+    assert [item["code"] for item in details["procedure_codes"]] == ["99283", "70450", ""]
+    assert details["total_cost"] == 3350.0
+
+    uncoded = "\n".join([
+        "STATEMENT OF SERVICES AND CHARGES",
+        "Pharmacy   $100.00",
+        "Supplies   $50.00",
+        "99283  ER FACILITY LEVEL 3   $1,250.00",
+    ])
+    assert parse_text_layer(uncoded) is None
+    assert parse_text_layer("too short") is None
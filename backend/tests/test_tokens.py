@@ -0,0 +1,71 @@
+import asyncio
+import os
+from types import SimpleNamespace
+
+import pytest
+
+os.environ.setdefault("ANTHROPIC_API_KEY", "test")
+
+from app.services import llm_clients  # noqa: E402
+from app.services.tokens import TokenBudget, TokenBudgetExceeded, start_request_budget  # noqa: E402
+
+
+class FakeMessages:
+    def __init__(self, fail=False):
+        self.calls = 0
+        self.fail = fail
+
+    async def create(self, **kwargs):
+        self.calls += 1
+        await asyncio.sleep(0.01)
+        if self.fail:
+            raise RuntimeError("overloaded")
+        return SimpleNamespace(content=[], usage=SimpleNamespace(input_tokens=20, output_tokens=300))
+
+
+def call():
+    return llm_clients.anthropic_create(
+        model="test", max_tokens=500, messages=[{"role": "user", "content": "hi"}]
+    )
+
+
+def test_concurrent_calls_cannot_overspend(monkeypatch):
+    messages = FakeMessages()
+    monkeypatch.setattr(llm_clients, "get_anthropic_client", lambda: SimpleNamespace(messages=messages))
+
+    async def scenario():
+        budget = start_request_budget(1500)
+        results = await asyncio.gather(*(call() for _ in range(6)), return_exceptions=True)
+        return budget, results
+
+    budget, results = asyncio.run(scenario())
+    # Each call reserves its prompt + max_tokens (~510), so only two fit at once
+    assert messages.calls == 2
+    assert sum(isinstance(result, TokenBudgetExceeded) for result in results) == 4
+    assert budget.spent == 640
+    assert budget.reserved == 0
+
+
+def test_reservation_is_released_when_the_call_fails(monkeypatch):
+    messages = FakeMessages(fail=True)
+    monkeypatch.setattr(llm_clients, "get_anthropic_client", lambda: SimpleNamespace(messages=messages))
+
+    async def scenario():
+        budget = start_request_budget(1500)
+        with pytest.raises(RuntimeError):
+            await call()
+        return budget
+
+    budget = asyncio.run(scenario())
+    assert budget.reserved == 0
+    assert budget.spent == 0
+
+
+def test_reserve_counts_tokens_already_reserved():
+    budget = TokenBudget(1000)
+    budget.reserve(600)
+    with pytest.raises(TokenBudgetExceeded):
+        budget.reserve(500)
+    budget.release(600)
+    budget.reserve(500)
+    assert budget.reserved == 500
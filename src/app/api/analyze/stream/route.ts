@@ -0,0 +1,28 @@
+// app/api/analyze/stream/route.ts
+import { NextRequest, NextResponse } from 'next/server';
+
+// Proxies the backend's NDJSON progress stream without buffering it
+export async function POST(request: NextRequest) {
+  try {
+    const formData = await request.formData();
+    const response = await fetch(`${process.env.NEXT_PUBLIC_API_URL}api/analyze/stream`, {
+      method: "POST",
+      body: formData,
+    });
+
+    if (!response.ok || !response.body) {
+      const error = await response.json();
+      return NextResponse.json({ error: error.detail }, { status: response.status });
+    }
+
+    return new Response(response.body, {
+      headers: {
+        "Content-Type": "application/x-ndjson",
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no",
+      },
+    });
+  } catch (error) {
+    return NextResponse.json({ error: 'Invalid form data' }, { status: 400 });
+  }
+}
@@ -129,6 +129,10 @@ export default function UploadInfo() {
     formData.append("lastName", (document.getElementById("last-name") as HTMLInputElement).value);
     formData.append("dateOfBirth", (document.getElementById("date-of-birth") as HTMLInputElement).value);
     formData.append("email", email);
+    // Used by the backend to pick the regional rates the bill is compared against
+    const city = (document.getElementById("city") as HTMLInputElement).value.trim();
+    const state = (document.getElementById("state") as HTMLInputElement).value.trim();
+    formData.append("location", [city, state].filter(Boolean).join(", "));
 
     setLoading(true);
     setError(null);
@@ -2,5 +2,7 @@ export interface AnalysisFormData {
   firstName: string;
   lastName: string;
   dateOfBirth: string;
+  location?: string;
+  zipCode?: string;
   files: File[];
 } 
\ No newline at end of file